@@ -1,8 +1,46 @@
+import argparse
 from src.worker import run_worker
+from src import commands
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="RoboMigra - Worker de Migração")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("worker", help="Executa o worker de migração (padrão)")
+    sub.add_parser("build-queue", help="Materializa a fila persistente de pacientes pendentes")
+    pr = sub.add_parser("prepare", help="Cria/atualiza o mapa de chaves img_rcl e os índices de apoio")
+    pr.add_argument("--rebuild", action="store_true", help="Descarta e reconstrói o mapa")
+    sub.add_parser("stats", help="Calcula o progresso exato (varredura completa)")
+    q = sub.add_parser("quarantine", help="Lista ou libera pacientes em quarentena")
+    q.add_argument("action", choices=["list", "release"], nargs="?", default="list")
+    q.add_argument("patients", nargs="*", help="Pacientes a liberar (vazio = todos)")
+    p = sub.add_parser("plan", help="Pré-calcula agrupamento/IDs fora da janela (só metadados)")
+    p.add_argument("--limit", type=int, help="Máximo de pacientes a planejar")
+    p.add_argument("--reset", action="store_true", help="Descarta o plano existente antes")
+    a = sub.add_parser("audit", help="Auditoria em massa (origem x controle x destino)")
+    a.add_argument("--from", dest="first", type=int, help="Primeiro código de paciente da faixa")
+    a.add_argument("--to", dest="last", type=int, help="Último código de paciente da faixa")
+    a.add_argument("--workers", type=int, default=1, help="Conexões paralelas (partições por código)")
+    a.add_argument("--incremental", action="store_true", help="Só pacientes migrados desde a última auditoria")
+    a.add_argument("--output", help="Arquivo CSV de divergências")
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        run_worker()
+        if args.command == "build-queue":
+            commands.build_queue()
+        elif args.command == "prepare":
+            commands.prepare(args.rebuild)
+        elif args.command == "stats":
+            commands.show_stats()
+        elif args.command == "quarantine":
+            commands.quarantine(args.action, args.patients)
+        elif args.command == "plan":
+            commands.plan(args.limit, args.reset)
+        elif args.command == "audit":
+            commands.audit(args.first, args.last, args.workers, args.incremental, args.output)
+        else:
+            run_worker()
     except KeyboardInterrupt:
         print("\n🛑 Worker interrompido pelo usuário.")
     except Exception as e:
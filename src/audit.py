@@ -0,0 +1,110 @@
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from src.database import get_db_connection
+from src.repository import Repository
+
+class BulkAudit:
+    """
+    Auditoria em massa (versão set-based do tests/validate_patient.py).
+
+    Compara por paciente os itens da origem, as marcações no controle e os itens do
+    destino (imagens + PDFs pela cadeia atendimento -> fatura -> laudo) com consultas
+    agregadas: todos os pacientes, uma faixa de códigos ou, no modo incremental, só
+    os migrados desde o início da última auditoria concluída. Com workers > 1 o
+    conjunto é particionado (código % N) e cada parte roda em uma conexão própria.
+    No destino só contam as linhas gravadas pela migração; as preexistentes do
+    cliente e as cópias descartadas pelo dedupe saem em colunas próprias do relatório.
+    """
+    # Pacientes por consulta no modo incremental (#auditoria_pacientes)
+    CHUNK_PATIENTS = 1000
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+
+    @staticmethod
+    def classify(row):
+        """Status do paciente: FALTANDO / EXCEDENTE / PENDENTE / OK."""
+        found = row.intImagens + row.intPdfs
+        if found < row.intEsperados:
+            return 'FALTANDO'
+        if found > row.intEsperados:
+            return 'EXCEDENTE'
+        if row.intMarcados < row.intItens:
+            return 'PENDENTE'
+        return 'OK'
+
+    @staticmethod
+    def _range_filters(first, last):
+        if first is None and last is None:
+            return "", "", (), ()
+        first = first if first is not None else 0
+        last = last if last is not None else 2**31 - 1
+        return ("AND TRY_CAST(m.strCodigoPaciente AS BIGINT) BETWEEN ? AND ?",
+                "AND A.intClienteId BETWEEN ? AND ?", (first, last), (first, last))
+
+    def _run_partition(self, first, last, part):
+        """Uma partição (código % workers = part) da faixa, em conexão própria."""
+        conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+        try:
+            cursor = conn.cursor()
+            source_filter, dest_filter, source_params, dest_params = self._range_filters(first, last)
+            if self.workers > 1:
+                # Códigos não numéricos (sem cliente no destino) ficam na partição 0 e aparecem como FALTANDO
+                source_filter += " AND ISNULL(TRY_CAST(m.strCodigoPaciente AS BIGINT) % ?, 0) = ?"
+                dest_filter += " AND A.intClienteId % ? = ?"
+                source_params += (self.workers, part)
+                dest_params += (self.workers, part)
+            rows = Repository.reconcile_patients(cursor, source_filter=source_filter, dest_filter=dest_filter,
+                                                 source_params=source_params, dest_params=dest_params)
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def _run_patients(self, patient_ids):
+        """Lista explícita de pacientes (incremental), em blocos via tabela temporária."""
+        conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+        try:
+            cursor = conn.cursor()
+            rows = []
+            for i in range(0, len(patient_ids), self.CHUNK_PATIENTS):
+                Repository.load_audit_patients(cursor, patient_ids[i:i + self.CHUNK_PATIENTS])
+                rows.extend(Repository.reconcile_patients(
+                    cursor,
+                    source_join="INNER JOIN #auditoria_pacientes AP ON AP.strCodigoPaciente = m.strCodigoPaciente",
+                    dest_join="INNER JOIN #auditoria_pacientes AP ON AP.intClienteId = A.intClienteId",
+                ))
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def run(self, first=None, last=None, patient_ids=None):
+        """Executa a reconciliação. Retorna as linhas agregadas de todos os pacientes."""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if patient_ids is not None:
+                slices = [patient_ids[k::self.workers] for k in range(self.workers)]
+                futures = [pool.submit(self._run_patients, s) for s in slices if s]
+            else:
+                futures = [pool.submit(self._run_partition, first, last, k) for k in range(self.workers)]
+            rows = []
+            for future in futures:
+                rows.extend(future.result())
+        return rows
+
+    def write_report(self, rows, path):
+        """Relatório compacto (CSV) apenas com os pacientes divergentes. Retorna o nº de linhas."""
+        mismatches = 0
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            out = csv.writer(f, delimiter=";")
+            out.writerow(["paciente", "status", "itens", "marcados", "duplicados", "esperados", "imagens", "pdfs",
+                          "diferenca", "preexistentes"])
+            for row in sorted(rows, key=lambda r: str(r.strCodigoPaciente)):
+                status = self.classify(row)
+                if status == 'OK':
+                    continue
+                mismatches += 1
+                out.writerow([row.strCodigoPaciente, status, row.intItens, row.intMarcados, row.intDuplicados,
+                              row.intEsperados, row.intImagens, row.intPdfs,
+                              row.intImagens + row.intPdfs - row.intEsperados, row.intPreexistentes])
+        return mismatches
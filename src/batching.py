@@ -0,0 +1,50 @@
+from src.config import Config
+
+class BatchComposer:
+    """
+    Composição de lotes por orçamento de payload.
+
+    Objetivo: Lotes de custo parecido (transação, memória e duração), em vez de
+    TOP BATCH_SIZE pacientes que podem somar 5 KB ou 5 GB.
+    Estratégia: Percorre os candidatos na ordem de prioridade somando os bytes
+    (DATALENGTH) e itens pendentes; para ao atingir BATCH_MAX_BYTES ou
+    BATCH_MAX_ITEMS. BATCH_MAX_PATIENTS é só um teto secundário. Um paciente
+    maior que o orçamento sempre entra sozinho, para a fila nunca travar.
+    """
+    def __init__(self, max_bytes=None, max_items=None, max_patients=None):
+        self.max_bytes = Config.BATCH_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_items = Config.BATCH_MAX_ITEMS if max_items is None else max_items
+        self.max_patients = max_patients or Config.BATCH_MAX_PATIENTS
+        self.enabled = self.max_bytes > 0 or self.max_items > 0
+        # Totais do último lote composto
+        self.bytes = 0
+        self.items = 0
+        self.full = False
+
+    def compose(self, candidates, costs, scale=1.0):
+        """
+        Seleciona os pacientes do lote. `costs` = { str(paciente): (itens, bytes) };
+        `scale` ajusta o orçamento (throttle adaptativo).
+        """
+        byte_budget = self.max_bytes * scale
+        item_budget = self.max_items * scale
+        selected = []
+        self.bytes = self.items = 0
+        self.full = False
+        for patient_id in candidates:
+            items, size = costs.get(str(patient_id), (0, 0))
+            over_bytes = byte_budget > 0 and self.bytes + size > byte_budget
+            over_items = item_budget > 0 and self.items + items > item_budget
+            if selected and (over_bytes or over_items):
+                self.full = True
+                break
+            selected.append(patient_id)
+            self.bytes += size
+            self.items += items
+            if len(selected) >= self.max_patients:
+                self.full = True
+                break
+        return selected
+
+    def summary(self):
+        return f"{self.bytes / (1024 * 1024):.1f} MB | {self.items} itens"
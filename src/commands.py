@@ -0,0 +1,122 @@
+from src.config import Config
+from src.database import get_db_connection, BlockIdAllocator
+from src.repository import Repository
+from src.planner import MigrationPlanner
+from src.audit import BulkAudit
+
+def build_queue():
+    """Materializa (do zero) a fila de pacientes pendentes em tbl_fila_migracao_python."""
+    conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+    cursor = conn.cursor()
+    print("📋 Construindo fila de pacientes pendentes...")
+    total = Repository.build_queue(cursor)
+    conn.commit()
+    print(f"✅ Fila construída: {total} pacientes.")
+
+def prepare(rebuild=False):
+    """Cria/atualiza o mapa de chaves img_rcl e os índices de apoio das consultas quentes."""
+    conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+    cursor = conn.cursor()
+    if rebuild or not Repository.has_key_map(cursor):
+        print("🔑 Construindo mapa de chaves (tbl_mapa_img_rcl_python)...")
+        total = Repository.build_key_map(cursor)
+        conn.commit()
+        print(f"✅ Mapa construído: {total} linhas de img_rcl.")
+    else:
+        added = Repository.refresh_key_map(cursor)
+        conn.commit()
+        print(f"✅ Mapa de chaves atualizado: +{added} linhas de img_rcl.")
+
+    created = Repository.ensure_support_indexes(cursor)
+    conn.commit()
+    if created:
+        print(f"📇 Índices criados: {', '.join(created)}")
+    else:
+        print("📇 Índices de apoio já existentes.")
+
+def show_stats():
+    """Reconciliação explícita: varredura exata do progresso (controle x origem)."""
+    conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+    cursor = conn.cursor()
+    stats = Repository.get_stats(cursor)
+    print(f"📊 STATUS (exato): Migrados [{stats['migrated_imgs']} Imgs | {stats['migrated_pdfs']} PDFs] | Pendentes [{stats['pending_imgs']} Imgs | {stats['pending_pdfs']} PDFs]")
+
+def quarantine(action, patient_ids=None):
+    """Lista ou libera pacientes em quarentena."""
+    conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+    cursor = conn.cursor()
+    Repository.ensure_quarantine_table(cursor)
+
+    if action == "release":
+        if patient_ids:
+            Repository.clear_quarantine(cursor, patient_ids)
+            released = len(patient_ids)
+        else:
+            released = Repository.release_all_quarantine(cursor)
+        conn.commit()
+        print(f"✅ {released} paciente(s) liberado(s) da quarentena.")
+        return
+
+    rows = Repository.list_quarantine(cursor)
+    conn.commit()
+    print(f"🧪 QUARENTENA: {len(rows)} paciente(s)")
+    for row in rows:
+        print(f"   - Paciente {row.strCodigoPaciente} | {row.intTentativas} falha(s) | {row.strErroClasse} | "
+              f"Última: {row.datUltimaFalha} | Próxima: {row.datProximaTentativa}")
+        print(f"     {row.strErroMensagem}")
+
+def plan(limit=None, reset=False):
+    """Planejamento offline: agrupamento e IDs dos pacientes pendentes (somente metadados)."""
+    conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+    cursor = conn.cursor()
+    if reset:
+        Repository.clear_plan(cursor)
+        conn.commit()
+        print("🧹 Plano anterior descartado.")
+
+    # IDs só são pré-reservados no modo por blocos (faixas duráveis, seguras até o replay)
+    allocator = BlockIdAllocator() if Config.ID_ALLOCATION == 'block' else None
+    planner = MigrationPlanner(cursor, allocator)
+    print(f"🗺️  Planejando pacientes pendentes{' (IDs reservados por blocos)' if allocator else ''}...")
+    try:
+        patients, items = planner.build(limit)
+    finally:
+        if allocator:
+            allocator.release()
+    print(f"✅ Plano gravado: {patients} pacientes | {items} itens.")
+
+def audit(first=None, last=None, workers=1, incremental=False, output=None):
+    """Auditoria em massa: reconciliação set-based origem x controle x destino por paciente."""
+    conn = get_db_connection(timeout=0) # Manutenção: varreduras longas
+    cursor = conn.cursor()
+    Repository.ensure_audit_tables(cursor)
+    Repository.ensure_hash_table(cursor) # Cópias do dedupe são contadas pelo índice de hashes
+    conn.commit()
+
+    patient_ids = None
+    if incremental:
+        since = Repository.last_audit_start(cursor)
+        if since is None:
+            print("ℹ️  Nenhuma auditoria concluída anteriormente. Executando auditoria completa.")
+        else:
+            patient_ids = Repository.fetch_patients_migrated_since(cursor, since)
+            print(f"🔎 Incremental: {len(patient_ids)} paciente(s) migrado(s) desde {since}.")
+    if patient_ids is not None:
+        scope = "incremental"
+    elif first is not None or last is not None:
+        scope = f"faixa {first if first is not None else '*'}-{last if last is not None else '*'}"
+    else:
+        scope = "completa"
+    audit_id, started = Repository.start_audit(cursor, scope)
+    conn.commit()
+
+    print(f"🔎 Auditoria {scope} ({workers} conexão(ões))...")
+    auditor = BulkAudit(workers)
+    rows = auditor.run(first, last, patient_ids) if patient_ids != [] else []
+    path = output or f"auditoria_{started:%Y%m%d_%H%M}.csv"
+    mismatches = auditor.write_report(rows, path)
+
+    Repository.finish_audit(cursor, audit_id, len(rows), mismatches)
+    conn.commit()
+    icon = "✅" if mismatches == 0 else "⚠️ "
+    print(f"{icon} {len(rows)} paciente(s) auditado(s) | {mismatches} divergente(s). Relatório: {path}")
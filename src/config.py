@@ -26,8 +26,132 @@ class Config:
         f"PWD={os.getenv('DB_PWD')};"
         "Trusted_Connection=no;"
     )
+
+    # Conexões (s): login, timeout por instrução (0 = infinito) e por fase/papel
+    DB_LOGIN_TIMEOUT = int(os.getenv('DB_LOGIN_TIMEOUT', 15))
+    DB_QUERY_TIMEOUT = int(os.getenv('DB_QUERY_TIMEOUT', 600))
+    DB_FETCH_TIMEOUT = int(os.getenv('DB_FETCH_TIMEOUT', 1800))
+    DB_MONITOR_TIMEOUT = int(os.getenv('DB_MONITOR_TIMEOUT', 300))
+    # Intervalo do teste de vida (SELECT 1) das conexões antes do uso
+    DB_HEALTHCHECK_SECONDS = float(os.getenv('DB_HEALTHCHECK_SECONDS', 60.0))
+    # Reconexão com backoff exponencial e jitter (tentativas 0 = indefinidamente)
+    DB_RECONNECT_BASE_SECONDS = float(os.getenv('DB_RECONNECT_BASE_SECONDS', 1.0))
+    DB_RECONNECT_MAX_SECONDS = float(os.getenv('DB_RECONNECT_MAX_SECONDS', 60.0))
+    DB_RECONNECT_ATTEMPTS = int(os.getenv('DB_RECONNECT_ATTEMPTS', 0))
     
     BATCH_SIZE = int(os.getenv('BATCH_SIZE', 5))
     SLEEP_BATCH = float(os.getenv('SLEEP_BATCH', 60.0))
     SLEEP_PATIENT = float(os.getenv('SLEEP_PATIENT', 5.0))
     CHECK_OPERATING_HOURS = os.getenv('CHECK_OPERATING_HOURS', 'true').lower() == 'true'
+
+    # Calendário de funcionamento: "<dia>[-<dia>] HH:MM-HH:MM; ..." (fim < início atravessa a meia-noite)
+    # Padrão: noites (18h às 05h) e fim de semana inteiro (Sex 18h até Seg 05h)
+    OPERATING_WINDOWS = os.getenv('OPERATING_WINDOWS', 'dom-sex 18:00-05:00; sab-dom 00:00-24:00')
+    OPERATING_TIMEZONE = os.getenv('OPERATING_TIMEZONE', 'America/Sao_Paulo')
+    # Admissão: só inicia pacientes cuja duração estimada termina WINDOW_SAFETY_SECONDS antes do fechamento
+    WINDOW_SAFETY_SECONDS = float(os.getenv('WINDOW_SAFETY_SECONDS', 300))
+    WINDOW_INITIAL_MBPS = float(os.getenv('WINDOW_INITIAL_MBPS', 2.0))
+    WINDOW_INITIAL_ITEMS_PER_SECOND = float(os.getenv('WINDOW_INITIAL_ITEMS_PER_SECOND', 1.0))
+    # Candidatos extras por lote para escolher os maiores que ainda cabem na janela
+    WINDOW_OVERFETCH = int(os.getenv('WINDOW_OVERFETCH', 3))
+
+    # Modo servidor: o Python envia apenas metadados (IDs/agrupamento) e os blobs
+    # são copiados de tblmigracao via INSERT ... SELECT dentro do próprio SQL Server.
+    SERVER_SIDE_BLOBS = os.getenv('SERVER_SIDE_BLOBS', 'false').lower() == 'true'
+
+    # Escrita em lote (BulkWriter): linhas por tabela e teto de bytes (blobs) antes do flush
+    WRITER_FLUSH_ROWS = int(os.getenv('WRITER_FLUSH_ROWS', 500))
+    WRITER_FLUSH_BYTES = int(os.getenv('WRITER_FLUSH_BYTES', 64 * 1024 * 1024))
+    FAST_EXECUTEMANY = os.getenv('FAST_EXECUTEMANY', 'true').lower() == 'true'
+
+    # Fila persistente de pacientes (substitui o anti-join do fetch_batch a cada ciclo)
+    USE_WORK_QUEUE = os.getenv('USE_WORK_QUEUE', 'false').lower() == 'true'
+    QUEUE_REFRESH_SECONDS = float(os.getenv('QUEUE_REFRESH_SECONDS', 1800.0))
+
+    # Mapa de chaves img_rcl (python main.py prepare): linhas novas entram a cada intervalo
+    KEY_MAP_REFRESH_SECONDS = float(os.getenv('KEY_MAP_REFRESH_SECONDS', 900.0))
+
+    # Monitoramento: 'exact' semeia os contadores com get_stats; 'approx' usa metadados do catálogo.
+    # STATS_REFRESH_SECONDS = 0 semeia apenas na inicialização (depois só incrementa).
+    STATS_MODE = os.getenv('STATS_MODE', 'exact').lower()
+    STATS_REFRESH_SECONDS = float(os.getenv('STATS_REFRESH_SECONDS', 0))
+
+    # Multi-worker: cada paciente é assumido via lease com expiração (tbl_lease_migracao_python)
+    MULTI_WORKER = os.getenv('MULTI_WORKER', 'false').lower() == 'true'
+    WORKER_ID = os.getenv('WORKER_ID', '')
+    LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', 1800))
+    LEASE_OVERFETCH = int(os.getenv('LEASE_OVERFETCH', 3))
+
+    # Alocação de IDs: 'max' (MAX + incremento local, worker único) ou 'block' (faixas hi/lo atômicas)
+    ID_ALLOCATION = os.getenv('ID_ALLOCATION', 'block' if MULTI_WORKER else 'max').lower()
+    ID_BLOCK_SIZE = int(os.getenv('ID_BLOCK_SIZE', 100))
+    ID_PREFETCH_RATIO = float(os.getenv('ID_PREFETCH_RATIO', 0.2))
+
+    # Cache de MAX(intAtendimentoId) por cliente entre lotes (segundos; 0 = sem expiração)
+    ATEND_CACHE_TTL = float(os.getenv('ATEND_CACHE_TTL', 3600.0))
+
+    # De-para/procedimentos em memória: a consulta por paciente devolve só o código bruto
+    PROCEDURE_CACHE = os.getenv('PROCEDURE_CACHE', 'true').lower() == 'true'
+    PROCEDURE_CACHE_TTL = float(os.getenv('PROCEDURE_CACHE_TTL', 3600.0))
+
+    # Loader de lote: carrega as imagens de todos os pacientes do lote em uma única consulta
+    # (mantém o lote inteiro em memória; ideal junto com SERVER_SIDE_BLOBS)
+    BATCH_LOADER = os.getenv('BATCH_LOADER', 'false').lower() == 'true'
+
+    # Pipeline leitura/escrita: thread leitora com conexão própria e fila limitada
+    PIPELINE = os.getenv('PIPELINE', 'false').lower() == 'true'
+    PIPELINE_DEPTH = int(os.getenv('PIPELINE_DEPTH', 2))
+    PIPELINE_MAX_BYTES = int(os.getenv('PIPELINE_MAX_BYTES', 512 * 1024 * 1024))
+
+    # Throttle: 'fixed' (SLEEP_PATIENT/SLEEP_BATCH) ou 'adaptive' (ajusta lote e pausas pela latência)
+    THROTTLE_MODE = os.getenv('THROTTLE_MODE', 'fixed').lower()
+    THROTTLE_TARGET_LATENCY_MS = float(os.getenv('THROTTLE_TARGET_LATENCY_MS', 250.0))
+    THROTTLE_MAX_PAUSE = float(os.getenv('THROTTLE_MAX_PAUSE', 60.0))
+    THROTTLE_MAX_BATCH_SIZE = int(os.getenv('THROTTLE_MAX_BATCH_SIZE', 50))
+    THROTTLE_SERVER_STATS = os.getenv('THROTTLE_SERVER_STATS', 'false').lower() == 'true'
+    THROTTLE_MAX_ACTIVE_REQUESTS = int(os.getenv('THROTTLE_MAX_ACTIVE_REQUESTS', 20))
+
+    # Granularidade de commit: a cada N pacientes (0 = fim do lote) e/ou por bytes gravados (0 = desativado)
+    COMMIT_EVERY_PATIENTS = int(os.getenv('COMMIT_EVERY_PATIENTS', 1))
+    COMMIT_EVERY_BYTES = int(os.getenv('COMMIT_EVERY_BYTES', 0))
+
+    # Quarentena de pacientes com falha: retry em BASE * 2^(tentativas-1) s, até MAX_BACKOFF;
+    # após MAX_ATTEMPTS o paciente fica retido até liberação manual
+    QUARANTINE = os.getenv('QUARANTINE', 'true').lower() == 'true'
+    QUARANTINE_BASE_SECONDS = int(os.getenv('QUARANTINE_BASE_SECONDS', 300))
+    QUARANTINE_MAX_BACKOFF = int(os.getenv('QUARANTINE_MAX_BACKOFF', 86400))
+    QUARANTINE_MAX_ATTEMPTS = int(os.getenv('QUARANTINE_MAX_ATTEMPTS', 8))
+
+    # Streaming em duas fases: metadados primeiro, blobs sob demanda em blocos de até STREAM_MAX_BYTES
+    STREAM_BLOBS = os.getenv('STREAM_BLOBS', 'false').lower() == 'true'
+    STREAM_MAX_BYTES = int(os.getenv('STREAM_MAX_BYTES', 32 * 1024 * 1024))
+
+    # Blobs vêm junto com a consulta do paciente apenas fora dos modos servidor/streaming
+    INLINE_BLOBS = not (SERVER_SIDE_BLOBS or STREAM_BLOBS)
+
+    # Dedupe por conteúdo: não regrava payloads idênticos (SHA-256) do mesmo paciente/procedimento
+    DEDUPE_CONTENT = os.getenv('DEDUPE_CONTENT', 'false').lower() == 'true'
+
+    # Métricas (formato Prometheus): porta HTTP do /metrics (0 = desativado) e/ou arquivo texto
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+    METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE', '')
+
+    # Rastreamento de SQL por template (métricas sql_*) e slow log (SQL_SLOW_LOG vazio = console)
+    SQL_TRACE = os.getenv('SQL_TRACE', 'false').lower() == 'true'
+    SQL_SLOW_MS = float(os.getenv('SQL_SLOW_MS', 1000.0))
+    SQL_SLOW_LOG = os.getenv('SQL_SLOW_LOG', '')
+    SQL_CAPTURE_PLAN = os.getenv('SQL_CAPTURE_PLAN', 'false').lower() == 'true'
+
+    # Plano offline (python main.py plan): agrupamento e IDs pré-calculados, replay noturno com verificação
+    USE_PLAN = os.getenv('USE_PLAN', 'false').lower() == 'true'
+    PLAN_CHUNK_PATIENTS = int(os.getenv('PLAN_CHUNK_PATIENTS', 200))
+
+    # Lotes por orçamento: soma de DATALENGTH pendente e nº de itens (0 = sem limite);
+    # com algum orçamento ativo, BATCH_MAX_PATIENTS substitui BATCH_SIZE como teto de pacientes
+    BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 0))
+    BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 0))
+    BATCH_MAX_PATIENTS = int(os.getenv('BATCH_MAX_PATIENTS', 100))
+
+    # Pacientes grandes em blocos: commit na fronteira de grupo (cod_proc, dia) a cada N itens / bytes (0 = desativado)
+    PATIENT_CHUNK_ITEMS = int(os.getenv('PATIENT_CHUNK_ITEMS', 0))
+    PATIENT_CHUNK_BYTES = int(os.getenv('PATIENT_CHUNK_BYTES', 0))
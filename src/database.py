@@ -1,19 +1,162 @@
 import pyodbc
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from src.config import Config
+from src.tracing import TracingConnection
 
-def get_db_connection():
+def get_db_connection(timeout=None):
     """
     Estabelece uma conexão nova com o banco de dados.
-    Configura timeout infinito (0) para workers de longa duração.
+    `timeout` = limite por instrução em segundos (padrão DB_QUERY_TIMEOUT; 0 = infinito,
+    só para comandos de manutenção longos). O login respeita DB_LOGIN_TIMEOUT.
     """
     try:
-        conn = pyodbc.connect(Config.DB_CONNECTION_STRING)
-        conn.timeout = 0
-        return conn
+        conn = pyodbc.connect(Config.DB_CONNECTION_STRING, timeout=Config.DB_LOGIN_TIMEOUT)
+        conn.timeout = Config.DB_QUERY_TIMEOUT if timeout is None else timeout
+        # SQL_TRACE: latência/linhas/erros por template de SQL e slow log
+        return TracingConnection(conn) if Config.SQL_TRACE else conn
     except Exception as e:
         print(f"❌ Erro fatal de configuração/conexão: {e}")
         raise e
 
+# SQLSTATEs de conexão perdida/indisponível
+CONNECTION_SQLSTATES = ('08S01', '08001', '08003', '08004', '08007')
+# SQLSTATEs de timeout (a conexão continua válida)
+TIMEOUT_SQLSTATES = ('HYT00', 'HYT01')
+
+def _sqlstate(error):
+    return str(error.args[0]) if error.args else ''
+
+def is_timeout(error):
+    """Indica se o erro do pyodbc é timeout de instrução/login (conexão ainda utilizável)."""
+    return isinstance(error, pyodbc.Error) and _sqlstate(error) in TIMEOUT_SQLSTATES
+
+def is_connection_error(error):
+    """Indica se o erro do pyodbc é de conexão (rede, servidor) e não de dados ou timeout."""
+    if not isinstance(error, pyodbc.Error) or is_timeout(error):
+        return False
+    if isinstance(error, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+        return True
+    return _sqlstate(error) in CONNECTION_SQLSTATES
+
+
+class ConnectionManager:
+    """
+    Conexões resilientes, separadas por papel: 'write' (transação do lote),
+    'read' (leitor do pipeline) e 'monitor' (progresso/carga do servidor).
+
+    Cada papel tem o próprio timeout por instrução; phase() aplica um limite
+    diferente durante uma fase (ex.: seleção do lote). A cada DB_HEALTHCHECK_SECONDS
+    a conexão é testada com SELECT 1 antes de ser entregue, e reconnect()
+    descarta a conexão antiga e tenta de novo com backoff exponencial e jitter,
+    para um blip de rede custar segundos em vez de travar a noite.
+    """
+    AUTOCOMMIT_ROLES = ('monitor',)
+
+    def __init__(self, timeouts=None):
+        self.timeouts = timeouts or {
+            'write': Config.DB_QUERY_TIMEOUT,
+            'read': Config.DB_QUERY_TIMEOUT,
+            'monitor': Config.DB_MONITOR_TIMEOUT,
+        }
+        self.connections = {}
+        self.checked_at = {}
+        self.lock = threading.Lock()
+
+    def get(self, role):
+        """Conexão do papel, aberta sob demanda e testada a cada DB_HEALTHCHECK_SECONDS."""
+        with self.lock:
+            conn = self.connections.get(role)
+        if conn is not None and time.time() - self.checked_at.get(role, 0.0) > Config.DB_HEALTHCHECK_SECONDS:
+            if not self.is_alive(conn):
+                print(f"⚠️  Conexão '{role}' inativa. Reconectando...")
+                conn = None
+            else:
+                self.checked_at[role] = time.time()
+        if conn is None:
+            return self.reconnect(role)
+        return conn
+
+    def cursor(self, role):
+        return self.get(role).cursor()
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    def discard(self, role):
+        """Fecha e esquece a conexão do papel (erros ao fechar são ignorados)."""
+        with self.lock:
+            conn = self.connections.pop(role, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def backoff_delay(attempt):
+        """Espera da tentativa N: jitter completo sobre base * 2^N, limitado a DB_RECONNECT_MAX_SECONDS."""
+        return random.uniform(0, min(Config.DB_RECONNECT_MAX_SECONDS,
+                                     Config.DB_RECONNECT_BASE_SECONDS * 2 ** attempt))
+
+    def reconnect(self, role):
+        """Nova conexão com backoff exponencial e jitter (DB_RECONNECT_*)."""
+        self.discard(role)
+        attempt = 0
+        while True:
+            try:
+                conn = get_db_connection(self.timeouts.get(role, Config.DB_QUERY_TIMEOUT))
+                # Monitoramento só lê: autocommit evita transação implícita aberta entre leituras
+                conn.autocommit = role in self.AUTOCOMMIT_ROLES
+                break
+            except Exception as e:
+                attempt += 1
+                if Config.DB_RECONNECT_ATTEMPTS and attempt >= Config.DB_RECONNECT_ATTEMPTS:
+                    raise
+                delay = self.backoff_delay(attempt)
+                print(f"   🔌 Falha ao conectar ('{role}', tentativa {attempt}). Nova tentativa em {delay:.1f}s... ({e})")
+                time.sleep(delay)
+        with self.lock:
+            self.connections[role] = conn
+        self.checked_at[role] = time.time()
+        return conn
+
+    @contextmanager
+    def phase(self, role, seconds):
+        """
+        Timeout por instrução diferente durante uma fase. O pyodbc só aplica o timeout
+        ao criar o cursor, então a fase entrega um cursor novo, fechado ao final;
+        a conexão volta ao timeout do papel para os cursores seguintes.
+        """
+        conn = self.connections.get(role) or self.get(role)
+        conn.timeout = seconds
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            yield cursor
+        finally:
+            try:
+                conn.timeout = self.timeouts.get(role, Config.DB_QUERY_TIMEOUT)
+                if cursor is not None:
+                    cursor.close()
+            except Exception:
+                pass # Conexão perdida durante a fase; a próxima já nasce com o timeout do papel
+
+    def close_all(self):
+        """Fecha as conexões de todos os papéis (encerramento do worker)."""
+        for role in list(self.connections):
+            self.discard(role)
+
 class IdGenerator:
     """
     Gerenciador de IDs com Estratégia de Cache.
@@ -21,15 +164,20 @@ class IdGenerator:
     Objetivo: Evitar milhares de consultas 'SELECT MAX()' para cada imagem inserida.
     Estratégia: Busca o MAX ID apenas uma vez por lote/ciclo e incrementa localmente na memória.
     """
-    def __init__(self, cursor):
+    def __init__(self, cursor, allocator=None, client_cache=None):
         self.cursor = cursor
-        # Inicializa o próximo ID disponível baseado no estado atual do banco
-        self.last_img_id = self._get_max_id("tbllaudoimagem", "intLaudoImagemId")
-        self.last_fat_id = self._get_max_id("tblfaturaatendimento", "intFaturaAtendimentoId")
+        # Com allocator (BlockIdAllocator) os IDs globais vêm de faixas reservadas atomicamente
+        self.allocator = allocator
+        self.last_img_id = None
+        self.last_fat_id = None
+        if allocator is None:
+            # Inicializa o próximo ID disponível baseado no estado atual do banco
+            self.last_img_id = self._get_max_id("tbllaudoimagem", "intLaudoImagemId")
+            self.last_fat_id = self._get_max_id("tblfaturaatendimento", "intFaturaAtendimentoId")
         
-        # Cache para controlar IDs de atendimento por cliente na sessão
-        # Formato: { cliente_id: last_used_id }
-        self.client_atend_cache = {}
+        # Cache para controlar IDs de atendimento por cliente.
+        # Quando recebido do worker, persiste entre lotes (ClientAtendimentoCache).
+        self.client_atend_cache = client_cache if client_cache is not None else ClientAtendimentoCache()
 
     def _get_max_id(self, table, pk_column):
         """Busca o maior ID atual de uma tabela usando NOLOCK."""
@@ -40,26 +188,242 @@ class IdGenerator:
 
     def next_global_img_id(self):
         """Retorna o próximo ID único para Tabela de Imagens."""
+        if self.allocator:
+            return self.allocator.next_id("tbllaudoimagem")
         self.last_img_id += 1
         return self.last_img_id
 
     def next_global_fatura_id(self):
         """Retorna o próximo ID único para Faturas."""
+        if self.allocator:
+            return self.allocator.next_id("tblfaturaatendimento")
         self.last_fat_id += 1
         return self.last_fat_id
 
+    def _atendimento_hint(self):
+        # No modo por blocos a leitura trava a faixa do cliente até o commit (sem dirty read)
+        return "UPDLOCK, HOLDLOCK" if self.allocator else "NOLOCK"
+
+    def prefetch_atendimento_maxima(self, client_ids):
+        """
+        Carrega em UMA consulta agrupada o MAX(intAtendimentoId) de todos os clientes
+        do lote que ainda não estão no cache (ou expiraram), via tabela temporária.
+        """
+        missing = sorted({int(c) for c in client_ids if int(c) not in self.client_atend_cache})
+        if not missing:
+            return
+
+        self.cursor.execute("""
+            IF OBJECT_ID('tempdb..#clientes_lote') IS NULL
+            CREATE TABLE #clientes_lote (intClienteId INT NOT NULL PRIMARY KEY)
+        """)
+        self.cursor.execute("DELETE FROM #clientes_lote")
+        self.cursor.fast_executemany = True
+        self.cursor.executemany("INSERT INTO #clientes_lote (intClienteId) VALUES (?)", [(c,) for c in missing])
+        self.cursor.fast_executemany = False
+
+        self.cursor.execute(f"""
+            SELECT c.intClienteId, ISNULL(MAX(a.intAtendimentoId), 0)
+            FROM #clientes_lote c
+            LEFT JOIN tblatendimento a WITH ({self._atendimento_hint()}) ON a.intClienteId = c.intClienteId
+            GROUP BY c.intClienteId
+        """)
+        for cliente_id, current_max in self.cursor.fetchall():
+            self.client_atend_cache.set(cliente_id, current_max)
+
     def get_atendimento_id_by_client(self, cliente_id):
         """
         Retorna o PRÓXIMO ID de Atendimento para o cliente.
         Gerencia cache local para garantir incremento correto dentro da transação.
         """
         if cliente_id not in self.client_atend_cache:
-            # Primeira vez no lote para esse cliente: busca do banco
-            sql = "SELECT ISNULL(MAX(intAtendimentoId), 0) FROM tblatendimento WITH (NOLOCK) WHERE intClienteId = ?"
+            # Cliente fora do prefetch: busca individual do banco
+            sql = f"SELECT ISNULL(MAX(intAtendimentoId), 0) FROM tblatendimento WITH ({self._atendimento_hint()}) WHERE intClienteId = ?"
             self.cursor.execute(sql, (cliente_id,))
             current_max = self.cursor.fetchone()[0]
-            self.client_atend_cache[cliente_id] = current_max
+            self.client_atend_cache.set(cliente_id, current_max)
 
         # Incrementa e atualiza cache
-        self.client_atend_cache[cliente_id] += 1
-        return self.client_atend_cache[cliente_id]
+        return self.client_atend_cache.increment(cliente_id)
+
+
+class ClientAtendimentoCache:
+    """
+    Cache de { cliente_id: último intAtendimentoId usado } que sobrevive entre lotes.
+
+    Entradas expiram após ATEND_CACHE_TTL segundos (0 = sem expiração), para captar
+    atendimentos criados por outros sistemas; invalidate() limpa tudo após um rollback,
+    já que os IDs em memória deixam de refletir o banco.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = Config.ATEND_CACHE_TTL if ttl is None else ttl
+        self.values = {}
+        self.loaded_at = {}
+
+    def __contains__(self, cliente_id):
+        if cliente_id not in self.values:
+            return False
+        if self.ttl > 0 and time.time() - self.loaded_at[cliente_id] > self.ttl:
+            del self.values[cliente_id]
+            del self.loaded_at[cliente_id]
+            return False
+        return True
+
+    def set(self, cliente_id, value):
+        self.values[cliente_id] = value
+        self.loaded_at[cliente_id] = time.time()
+
+    def increment(self, cliente_id):
+        self.values[cliente_id] += 1
+        return self.values[cliente_id]
+
+    def invalidate(self, cliente_id=None):
+        """Limpa um cliente específico ou, sem argumento, o cache inteiro."""
+        if cliente_id is None:
+            self.values.clear()
+            self.loaded_at.clear()
+        else:
+            self.values.pop(cliente_id, None)
+            self.loaded_at.pop(cliente_id, None)
+
+
+class BlockIdAllocator:
+    """
+    Alocador de IDs por blocos (hi/lo) seguro para vários workers.
+
+    Objetivo: Eliminar o MAX() + incremento local, que colide entre processos.
+    Estratégia: Reserva faixas contíguas de ID_BLOCK_SIZE de forma atômica na tabela
+    tbl_chave_migracao_python (conexão própria em autocommit, sem segurar lock durante
+    o lote) e entrega os IDs localmente. O próximo bloco é reservado antes do atual
+    acabar; faixas não usadas ao encerrar são gravadas em tbl_chave_sobra_migracao_python
+    e reaproveitadas na próxima reserva. Cada reserva sincroniza com o MAX(pk) atual,
+    para que IDs gravados por fora do alocador nunca sejam entregues de novo.
+    """
+    # Tabelas com ID global alocado pelo worker: { tabela: coluna_pk }
+    KEYS = {
+        "tbllaudoimagem": "intLaudoImagemId",
+        "tblfaturaatendimento": "intFaturaAtendimentoId",
+    }
+
+    def __init__(self, block_size=None):
+        self.block_size = max(1, block_size or Config.ID_BLOCK_SIZE)
+        self._connect()
+        # Faixas reservadas por tabela: deque de [proximo, fim] (inclusive)
+        self.ranges = {table: deque() for table in self.KEYS}
+        self._ensure_tables()
+
+    def _connect(self):
+        self.conn = get_db_connection()
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+
+    def _ensure_tables(self):
+        """Cria as tabelas de chaves/sobras e semeia cada chave com MAX(pk) + 1."""
+        self.cursor.execute("""
+            IF OBJECT_ID('tbl_chave_migracao_python') IS NULL
+            CREATE TABLE tbl_chave_migracao_python (
+                strChave VARCHAR(100) NOT NULL PRIMARY KEY,
+                intProximo BIGINT NOT NULL
+            )
+        """)
+        self.cursor.execute("""
+            IF OBJECT_ID('tbl_chave_sobra_migracao_python') IS NULL
+            CREATE TABLE tbl_chave_sobra_migracao_python (
+                intSobraId INT IDENTITY(1,1) PRIMARY KEY,
+                strChave VARCHAR(100) NOT NULL,
+                intInicio BIGINT NOT NULL,
+                intFim BIGINT NOT NULL
+            )
+        """)
+        for table, pk_column in self.KEYS.items():
+            self.cursor.execute(f"""
+                IF NOT EXISTS (SELECT 1 FROM tbl_chave_migracao_python WITH (UPDLOCK, HOLDLOCK) WHERE strChave = ?)
+                INSERT INTO tbl_chave_migracao_python (strChave, intProximo)
+                SELECT ?, ISNULL(MAX({pk_column}), 0) + 1 FROM {table}
+            """, (table, table))
+
+    def _reserve(self, table):
+        """
+        Reserva uma faixa; se a conexão própria caiu, reconecta e tenta mais uma vez
+        (cada reserva é atômica em autocommit: no pior caso uma faixa vira lacuna).
+        """
+        try:
+            return self._reserve_range(table)
+        except pyodbc.Error as e:
+            if not is_connection_error(e):
+                raise
+            print(f"   🔌 Alocador de IDs: conexão perdida ({e}). Reconectando...")
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self._connect()
+            return self._reserve_range(table)
+
+    def _reserve_range(self, table):
+        """
+        Reserva uma faixa: primeiro tenta uma sobra registrada, senão avança a chave.
+        Ambas são conferidas contra o MAX(pk) atual da tabela (IDs gravados fora do
+        alocador): sobras já ultrapassadas são descartadas e a chave nunca fica abaixo
+        de MAX(pk) + 1.
+        """
+        self.cursor.execute(f"SELECT ISNULL(MAX({self.KEYS[table]}), 0) FROM {table} WITH (NOLOCK)")
+        max_id = self.cursor.fetchone()[0]
+
+        # Sobras inteiramente abaixo do MAX não servem mais
+        self.cursor.execute(
+            "DELETE FROM tbl_chave_sobra_migracao_python WHERE strChave = ? AND intFim <= ?",
+            (table, max_id)
+        )
+        self.cursor.execute("""
+            DELETE TOP (1) FROM tbl_chave_sobra_migracao_python WITH (READPAST)
+            OUTPUT deleted.intInicio, deleted.intFim
+            WHERE strChave = ? AND intFim > ?
+        """, (table, max_id))
+        row = self.cursor.fetchone()
+        if row:
+            return [max(row[0], max_id + 1), row[1]]
+
+        self.cursor.execute("""
+            UPDATE tbl_chave_migracao_python
+            SET intProximo = CASE WHEN intProximo > ? THEN intProximo ELSE ? END + ?
+            OUTPUT inserted.intProximo - ?
+            WHERE strChave = ?
+        """, (max_id, max_id + 1, self.block_size, self.block_size, table))
+        start = self.cursor.fetchone()[0]
+        return [start, start + self.block_size - 1]
+
+    def next_id(self, table):
+        """Retorna o próximo ID da faixa local, pré-reservando o bloco seguinte."""
+        ranges = self.ranges[table]
+        if not ranges:
+            ranges.append(self._reserve(table))
+
+        current = ranges[0]
+        value = current[0]
+        current[0] += 1
+        if current[0] > current[1]:
+            ranges.popleft()
+
+        # Prefetch: reserva o próximo bloco antes do atual acabar
+        remaining = sum(end - nxt + 1 for nxt, end in ranges)
+        if remaining < self.block_size * Config.ID_PREFETCH_RATIO and len(ranges) < 2:
+            ranges.append(self._reserve(table))
+        return value
+
+    def unused_ranges(self):
+        """Faixas reservadas e ainda não entregues: { tabela: [(inicio, fim), ...] }."""
+        return {table: [(nxt, end) for nxt, end in ranges] for table, ranges in self.ranges.items()}
+
+    def release(self):
+        """Registra as faixas não usadas para reaproveitamento e fecha a conexão."""
+        try:
+            for table, ranges in self.unused_ranges().items():
+                for start, end in ranges:
+                    self.cursor.execute(
+                        "INSERT INTO tbl_chave_sobra_migracao_python (strChave, intInicio, intFim) VALUES (?, ?, ?)",
+                        (table, start, end)
+                    )
+            self.ranges = {table: deque() for table in self.KEYS}
+        finally:
+            self.conn.close()
@@ -0,0 +1,52 @@
+import hashlib
+from src.repository import Repository
+
+class ContentDedupe:
+    """
+    Deduplicação por conteúdo (SHA-256 do payload) por paciente/procedimento.
+
+    O mesmo exame reenviado com outro strCodigo tem o mesmo hash: a cópia é apenas
+    marcada como migrada, sem regravar o blob. O índice fica em tbl_hash_migracao_python
+    e é gravado pelo BulkWriter na mesma transação dos itens.
+    """
+    def __init__(self, cursor):
+        Repository.ensure_hash_table(cursor)
+        cursor.commit()
+
+    @staticmethod
+    def content_hash(row):
+        """Hash do item: calculado no servidor (modos sem blob) ou localmente."""
+        if row.content_hash:
+            return row.content_hash.upper()
+        if row.blob_data:
+            return hashlib.sha256(row.blob_data).hexdigest().upper()
+        return None
+
+    def filter(self, cursor, writer, client_id, rows):
+        """
+        Remove os duplicados de `rows` (já gravados antes ou repetidos no próprio paciente).
+        Duplicados são marcados no controle; os novos hashes entram no índice.
+        Retorna (linhas_mantidas, duplicados, duplicados_pdf, bytes_economizados).
+        """
+        seen = Repository.fetch_content_hashes(cursor, client_id)
+        kept = []
+        duplicates = 0
+        duplicate_pdfs = 0
+        bytes_saved = 0
+        for row in rows:
+            digest = self.content_hash(row)
+            if digest is None:
+                kept.append(row)
+                continue
+            key = (str(row.cod_proc), digest)
+            if key in seen:
+                writer.add('tbl_controle_migracao_python', (row.id_imagem_origem,))
+                duplicates += 1
+                if row.extensao.lower() == 'pdf':
+                    duplicate_pdfs += 1
+                bytes_saved += row.blob_size or 0
+                continue
+            seen.add(key)
+            writer.add('tbl_hash_migracao_python', (client_id, key[0], digest, row.id_imagem_origem))
+            kept.append(row)
+        return kept, duplicates, duplicate_pdfs, bytes_saved
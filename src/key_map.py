@@ -0,0 +1,28 @@
+import time
+from src.config import Config
+from src.repository import Repository
+
+class KeyMap:
+    """
+    Manutenção do mapa de chaves img_rcl (tbl_mapa_img_rcl_python).
+
+    Objetivo: JOIN tblmigracao x img_rcl por chave indexada, sem converter
+    IMG_RCL_IND/IMG_RCL_RCL_COD linha a linha (o CAST impede seeks).
+    Estratégia: O mapa é criado pelo comando prepare; o worker inclui as linhas
+    novas de img_rcl a cada KEY_MAP_REFRESH_SECONDS. Itens de origem ainda fora do
+    mapa ficam invisíveis até o próximo refresh.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.last_refresh = 0.0
+
+    def refresh_if_due(self):
+        """Executa o refresh incremental se o intervalo configurado já passou."""
+        if time.time() - self.last_refresh < Config.KEY_MAP_REFRESH_SECONDS:
+            return 0
+        added = Repository.refresh_key_map(self.cursor)
+        self.cursor.commit()
+        self.last_refresh = time.time()
+        if added:
+            print(f"🔑 Mapa de chaves atualizado: +{added} linhas de img_rcl.")
+        return added
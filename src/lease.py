@@ -0,0 +1,41 @@
+import os
+import socket
+from src.config import Config
+from src.repository import Repository
+
+class LeaseManager:
+    """
+    Controle de posse de pacientes entre vários workers (tbl_lease_migracao_python).
+
+    Cada paciente só é processado pelo worker que detém o lease. Leases expiram
+    após LEASE_SECONDS, então pacientes de um worker que caiu voltam a ficar livres.
+    Os claims são confirmados imediatamente (fora da transação do lote) para que
+    os outros workers os enxerguem. Antes de cada paciente o lease é renovado (se
+    expirou e outro worker o assumiu, o paciente é pulado) e, após o commit, liberado.
+    """
+    def __init__(self, cursor, worker_id=None):
+        self.worker_id = worker_id or Config.WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+        Repository.ensure_lease_table(cursor)
+        cursor.commit()
+
+    def claim(self, cursor, candidates, limit):
+        """Assume até `limit` pacientes da lista de candidatos. Retorna os obtidos."""
+        claimed = []
+        for patient_id in candidates:
+            if Repository.claim_patient(cursor, patient_id, self.worker_id, Config.LEASE_SECONDS):
+                claimed.append(patient_id)
+                if len(claimed) >= limit:
+                    break
+        cursor.commit()
+        return claimed
+
+    def renew(self, cursor, patient_id):
+        """Renova o lease antes de processar o paciente. Retorna False se ele não é mais nosso."""
+        renewed = Repository.renew_lease(cursor, patient_id, self.worker_id, Config.LEASE_SECONDS)
+        cursor.commit()
+        return renewed
+
+    def release(self, cursor, patient_ids):
+        """Libera os pacientes (após o commit de cada um ou ao final do lote)."""
+        Repository.release_leases(cursor, patient_ids, self.worker_id)
+        cursor.commit()
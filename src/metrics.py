@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.config import Config
+
+class Metrics:
+    """
+    Métricas do worker no formato texto do Prometheus (sem dependências externas).
+
+    Contadores (lotes, pacientes, itens, bytes), histogramas de latência por fase
+    (fetch_batch, fetch_images, insert, commit, sleep...) e gauges de estado
+    (throttle, horário de funcionamento). Expostas via HTTP (METRICS_PORT) e/ou
+    gravadas em arquivo texto (METRICS_TEXTFILE) para o node_exporter.
+    """
+    PREFIX = "robomigra_"
+    # Limites (s) dos buckets dos histogramas de latência
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    HELP = {
+        'batches_total': 'Lotes processados',
+        'patients_total': 'Pacientes migrados',
+        'patient_failures_total': 'Pacientes com falha (revertidos)',
+        'images_total': 'Imagens gravadas',
+        'pdfs_total': 'PDFs gravados',
+        'skipped_empty_total': 'Itens vazios marcados como migrados',
+        'duplicates_total': 'Itens duplicados (dedupe por conteúdo)',
+        'bytes_read_total': 'Bytes de blobs lidos pelo worker',
+        'bytes_written_total': 'Bytes de blobs enviados ao banco',
+        'phase_seconds': 'Latência por fase do worker',
+        'sql_seconds': 'Latência por template de SQL (SQL_TRACE)',
+        'sql_statements_total': 'Execuções por template de SQL',
+        'sql_rows_total': 'Linhas afetadas/lidas por template de SQL',
+        'sql_param_bytes_total': 'Bytes de parâmetros enviados por template de SQL',
+        'sql_errors_total': 'Erros por template de SQL',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # { (nome, labels): [contagens por bucket..., soma, total] }
+        self.histograms = {}
+        self.server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        """Mede a duração de um bloco no histograma phase_seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('phase_seconds', time.perf_counter() - started, phase=phase)
+
+    def record_patient(self, result, bytes_written=0):
+        """Contabiliza o resultado de migrate_patient."""
+        self.inc('patients_total')
+        self.inc('images_total', result['saved_imgs'])
+        self.inc('pdfs_total', result['saved_pdfs'])
+        self.inc('skipped_empty_total', result['skipped_empty'])
+        self.inc('duplicates_total', result['duplicates'])
+        self.inc('bytes_read_total', result['bytes_read'])
+        self.inc('bytes_written_total', bytes_written)
+
+    def set_throttle_state(self, state):
+        for field in ('batch_size', 'pause', 'latency_ms', 'active_requests', 'load'):
+            if state.get(field) is not None:
+                self.set_gauge(f'throttle_{field}', state[field])
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """Exporta todas as métricas no formato texto do Prometheus."""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# HELP {self.PREFIX}{name} {self.HELP.get(name, name)}")
+                    lines.append(f"# TYPE {self.PREFIX}{name} counter")
+                    typed.add(name)
+                lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {self.PREFIX}{name} gauge")
+                    typed.add(name)
+                lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# HELP {self.PREFIX}{name} {self.HELP.get(name, name)}")
+                    lines.append(f"# TYPE {self.PREFIX}{name} histogram")
+                    typed.add(name)
+                for bound, count in zip(self.BUCKETS, hist):
+                    lines.append(f"{self.PREFIX}{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{self.PREFIX}{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist[-1]}")
+                lines.append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {hist[-2]:.6f}")
+                lines.append(f"{self.PREFIX}{name}_count{self._labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path=None):
+        """Grava as métricas em arquivo (escrita atômica via rename)."""
+        path = path or Config.METRICS_TEXTFILE
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def start_http(self, port=None):
+        """Sobe o endpoint /metrics em uma thread daemon."""
+        port = port or Config.METRICS_PORT
+        if not port or self.server is not None:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Silencia o log de acesso
+
+        self.server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+
+
+# Registro único do processo
+metrics = Metrics()
@@ -0,0 +1,126 @@
+import queue
+import threading
+from src.config import Config
+from src.database import get_db_connection
+from src.repository import Repository
+from src.metrics import metrics
+
+# Marcador de fim da leitura do lote
+_DONE = object()
+
+
+class PatientReader:
+    """
+    Leitor em pipeline: uma thread com conexão própria busca as imagens do
+    paciente N+1 enquanto a thread principal insere o paciente N.
+
+    Back-pressure: a leitura para enquanto os bytes já lidos e ainda não consumidos
+    passarem de PIPELINE_MAX_BYTES (um paciente sempre pode entrar, mesmo que grande).
+    Erros da thread leitora são repassados ao consumidor; um erro do consumidor
+    encerra a leitora ao fechar o iterador. Com `plan` (PlanReplay) as linhas vêm do
+    plano pré-calculado quando ele está íntegro.
+    """
+    def __init__(self, max_bytes=None, max_patients=None, plan=None, db=None):
+        self.max_bytes = max_bytes or Config.PIPELINE_MAX_BYTES
+        self.max_patients = max_patients or Config.PIPELINE_DEPTH
+        self.plan = plan
+        # ConnectionManager: conexão 'read' testada/reconectada; sem ele, conexão própria
+        self.db = db
+        self.conn = None
+        self.bytes_in_flight = 0
+        self.cond = threading.Condition()
+
+    def _cursor(self):
+        if self.db is not None:
+            self.conn = self.db.get('read')
+        elif self.conn is None:
+            self.conn = get_db_connection()
+        return self.conn.cursor()
+
+    def _reset_connection(self):
+        if self.db is not None:
+            self.db.discard('read')
+            self.conn = None
+            return
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+
+    def _read(self, patient_ids, out, stop):
+        """Corpo da thread leitora."""
+        try:
+            cursor = self._cursor()
+            for cod_paciente in patient_ids:
+                if stop.is_set():
+                    return
+                with metrics.timer('fetch_images'):
+                    rows = None
+                    if self.plan:
+                        rows = self.plan.fetch(cursor, [cod_paciente], include_blobs=Config.INLINE_BLOBS).get(cod_paciente)
+                    if rows is None:
+                        rows = Repository.fetch_patient_images(cursor, cod_paciente, include_blobs=Config.INLINE_BLOBS)
+                # Commit encerra a transação implícita de leitura (não segura locks)
+                self.conn.commit()
+                size = sum(r.blob_size or 0 for r in rows) if Config.INLINE_BLOBS else 0
+
+                with self.cond:
+                    while (not stop.is_set() and self.bytes_in_flight > 0
+                           and self.bytes_in_flight + size > self.max_bytes):
+                        self.cond.wait(timeout=1.0)
+                    if stop.is_set():
+                        return
+                    self.bytes_in_flight += size
+
+                while not stop.is_set():
+                    try:
+                        out.put((cod_paciente, rows, size), timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+            out.put(_DONE)
+        except Exception as e:
+            self._reset_connection()
+            out.put(e)
+
+    def _release(self, size):
+        with self.cond:
+            self.bytes_in_flight -= size
+            self.cond.notify_all()
+
+    def iterate(self, patient_ids):
+        """
+        Gera (cod_paciente, rows) na ordem do lote, com a leitura antecipada em
+        outra thread. Os bytes de um paciente são liberados quando o próximo é pedido.
+        """
+        out = queue.Queue(maxsize=max(1, self.max_patients))
+        stop = threading.Event()
+        self.bytes_in_flight = 0
+        reader = threading.Thread(target=self._read, args=(list(patient_ids), out, stop),
+                                  name="patient-reader", daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = out.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                cod_paciente, rows, size = item
+                try:
+                    yield cod_paciente, rows
+                finally:
+                    self._release(size)
+        finally:
+            # Encerramento limpo: sinaliza a leitora e desbloqueia put()/wait()
+            stop.set()
+            with self.cond:
+                self.cond.notify_all()
+            while reader.is_alive():
+                try:
+                    out.get_nowait()
+                except queue.Empty:
+                    pass
+                reader.join(timeout=0.1)
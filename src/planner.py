@@ -0,0 +1,120 @@
+from datetime import datetime
+from src.config import Config
+from src.repository import Repository
+
+def group_images(rows):
+    """
+    Agrupamento Inteligente por (Código Procedimento, Data Dia).
+    Objetivo: Unificar múltiplas imagens do mesmo exame/dia em um único Atendimento.
+    Retorna { chave: {'header': primeira linha, 'items': [linhas]} } na ordem das linhas.
+    """
+    grouped = {}
+    for img in rows:
+        # Extrai apenas a DATA (Ignora Hora) para agrupar
+        data_dia = img.data_raw.date() if img.data_raw else datetime.min.date()
+        key = (img.cod_proc, data_dia)
+        if key not in grouped:
+            grouped[key] = {'header': img, 'items': []} # Usa os dados da primeira imagem como cabeçalho
+        grouped[key]['items'].append(img)
+    return grouped
+
+
+class MigrationPlanner:
+    """
+    Planejamento offline (horário comercial) em tbl_plano_migracao_python.
+
+    Lê apenas metadados (sem blobs, NOLOCK), aplica o mesmo agrupamento do worker e
+    grava por item o grupo, procedimento, data e o tamanho do payload (usado para
+    verificar a origem no replay). Com ID_ALLOCATION=block os IDs de fatura/laudo e
+    de imagem já saem reservados em tbl_chave_migracao_python; os de atendimento
+    (MAX por cliente) continuam sendo resolvidos no replay.
+    """
+    def __init__(self, cursor, allocator=None):
+        self.cursor = cursor
+        self.allocator = allocator
+        Repository.ensure_plan_table(cursor)
+        cursor.commit()
+
+    def plan_patient(self, patient_id, rows):
+        """Linhas do plano para um paciente (mesmas regras de migrate_patient)."""
+        unique_imgs = {r.id_imagem_origem: r for r in rows}
+        plan_rows = []
+        valid = []
+        for row in unique_imgs.values():
+            if row.blob_size is None or row.blob_size == 0:
+                # Vazio: só será marcado como migrado
+                plan_rows.append((row.id_imagem_origem, str(patient_id), None, row.cod_proc, row.nome_proc,
+                                  row.data_raw, row.extensao, row.blob_size, None, None))
+            else:
+                valid.append(row)
+
+        for number, group in enumerate(group_images(valid).values(), start=1):
+            header = group['header']
+            fatura_id = None
+            if self.allocator and header.blob_size and header.data_raw:
+                fatura_id = self.allocator.next_id("tblfaturaatendimento")
+            for item in group['items']:
+                img_id = None
+                if fatura_id and item.data_raw and item.extensao.lower() != 'pdf':
+                    img_id = self.allocator.next_id("tbllaudoimagem")
+                plan_rows.append((item.id_imagem_origem, str(patient_id), number, item.cod_proc, item.nome_proc,
+                                  item.data_raw, item.extensao, item.blob_size, fatura_id, img_id))
+        return plan_rows
+
+    def build(self, limit=None):
+        """Planeja os pacientes pendentes ainda sem plano. Retorna (pacientes, itens)."""
+        patients = items = 0
+        # Pacientes já tentados nesta execução: quem não gerou plano não volta como candidato
+        tried = set()
+        while limit is None or patients < limit:
+            chunk = Config.PLAN_CHUNK_PATIENTS if limit is None else min(Config.PLAN_CHUNK_PATIENTS, limit - patients)
+            candidates = [p for p in Repository.fetch_plan_candidates(self.cursor, chunk + len(tried))
+                          if str(p) not in tried][:chunk]
+            if not candidates:
+                break
+            tried.update(str(p) for p in candidates)
+            by_patient = Repository.fetch_batch_images(self.cursor, candidates, include_blobs=False, with_hash=False)
+            plan_rows = []
+            for patient_id, rows in by_patient.items():
+                plan_rows.extend(self.plan_patient(patient_id, rows))
+            Repository.insert_plan(self.cursor, plan_rows)
+            self.cursor.commit()
+            patients += len(candidates)
+            items += len(plan_rows)
+            print(f"   🗺️  +{len(candidates)} pacientes ({len(plan_rows)} itens). Total: {patients} pacientes.")
+        return patients, items
+
+
+class PlanReplay:
+    """
+    Execução noturna do plano: busca as linhas do paciente direto do plano (sem os
+    JOINs de procedimento/de-para) e confere a origem. Se qualquer item mudou desde
+    o planejamento, ou se a origem tem itens pendentes que o plano não cobre (novos
+    desde o planejamento), o plano do paciente é descartado e o worker recalcula na hora.
+    """
+    def __init__(self, cursor):
+        Repository.ensure_plan_table(cursor)
+        cursor.commit()
+
+    def fetch(self, cursor, patient_ids, include_blobs=True):
+        """{ cod_paciente: [rows] } apenas para pacientes com plano íntegro."""
+        by_patient = Repository.fetch_planned_images(cursor, list(patient_ids), include_blobs=include_blobs)
+        with_plan = [p for p, rows in by_patient.items() if rows]
+        pending = Repository.count_pending_items(cursor, with_plan)
+        planned = {}
+        stale = []
+        for patient_id, rows in by_patient.items():
+            if not rows:
+                continue
+            if all(r.plan_ok for r in rows) and pending.get(str(patient_id), 0) == len(rows):
+                planned[patient_id] = rows
+            else:
+                stale.append(patient_id)
+        if stale:
+            print(f"   ⚠️  Plano desatualizado (origem alterada ou itens novos) para {len(stale)} paciente(s). Recalculando na hora.")
+            Repository.delete_plan(cursor, stale)
+        return planned
+
+    def complete(self, cursor, patient_ids):
+        """Remove o plano dos pacientes migrados (na mesma transação do commit)."""
+        Repository.delete_plan(cursor, patient_ids)
@@ -0,0 +1,31 @@
+from src.config import Config
+from src.repository import Repository
+
+class Quarantine:
+    """
+    Quarentena de pacientes que falham (tbl_quarentena_migracao_python).
+
+    Cada falha registra a classe do erro e incrementa as tentativas; o paciente
+    some da seleção de lotes até datProximaTentativa (backoff exponencial), para
+    que um registro corrompido nunca trave o restante da fila.
+    """
+    def __init__(self, cursor):
+        Repository.ensure_quarantine_table(cursor)
+        cursor.commit()
+
+    def record(self, cursor, patient_id, error):
+        """Registra a falha do paciente (na transação corrente) e informa o próximo retry."""
+        error_class = type(error).__name__
+        message = str(error)[:1000]
+        attempts, next_retry = Repository.record_quarantine_failure(
+            cursor, patient_id, error_class, message,
+            Config.QUARANTINE_BASE_SECONDS, Config.QUARANTINE_MAX_BACKOFF, Config.QUARANTINE_MAX_ATTEMPTS
+        )
+        if attempts >= Config.QUARANTINE_MAX_ATTEMPTS:
+            print(f"   🚫 Paciente {patient_id} em quarentena permanente ({attempts} falhas, {error_class}). Libere com: python main.py quarantine release {patient_id}")
+        else:
+            print(f"   🧪 Paciente {patient_id} em quarentena ({attempts}ª falha, {error_class}). Próxima tentativa: {next_retry}")
+
+    def clear(self, cursor, patient_ids):
+        """Tira da quarentena os pacientes migrados com sucesso."""
+        Repository.clear_quarantine(cursor, patient_ids)
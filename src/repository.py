@@ -1,7 +1,55 @@
+import threading
+import time
 from src.config import Config
 
 class Repository:
     """Centraliza as queries SQL para manter o código limpo."""
+
+    # INSERTs das tabelas de destino e controle (usados pelo BulkWriter)
+    INSERT_SQL = {
+        'tblatendimento': """
+            INSERT INTO tblatendimento (
+                intAtendimentoId, datAtende, intProfissionalId, intClienteId, 
+                intEmpresaId, intUsuarioId, datAtendimento, strStatus, bolCheck, intTipoAtendimentoId
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        'tblfaturaatendimento': """
+            INSERT INTO tblfaturaatendimento (
+                intFaturaAtendimentoId, intClienteId, intAtendimentoId, 
+                strProcedimento, strDescrProcedimento, numQuantidade, numValor, 
+                intEmpresaId, intUsuarioId, datFaturaAtendimento, strStatusFat
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        'tbllaudocliente': """
+            INSERT INTO tbllaudocliente (
+               intLaudoClienteId, intClienteId, intAtendimentoId, intFaturaAtendimentoId,
+               strCodigoProcedimento, strDescrProcedimento, 
+               strStatus, intMedicoId, intUsuarioId, intEmpresaId,
+               datLaudoCliente, datLiberacao, bolCheck, bolConcluido
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        'tbllaudoimagem': """
+            INSERT INTO tbllaudoimagem (
+                intLaudoImagemId, strLaudoImagem, intClienteId, intAtendimentoId, intFaturaAtendimentoId, 
+                strCodigoProcedimento, strDescrProcedimento, intOrdem, strTerminal, 
+                imgImagem, intUsuarioId, intEmpresaId, datLaudoImagem, bolImpressao, intLaudoClienteId
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        'tbllaudopdfanexo': """
+            INSERT INTO tbllaudopdfanexo (
+                intClienteId, intAtendimentoId, intLaudoClienteId, 
+                strLaudoPDFAnexo, bolLiberado, intUsuarioId, 
+                datLaudoPDFAnexo, intEmpresaId, bolImportado, 
+                strLaudoPDFAnexoSemTimbre
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        'tbl_hash_migracao_python': """
+            INSERT INTO tbl_hash_migracao_python (intClienteId, strCodigoProcedimento, strHash, strCodigoImagemOrigem) VALUES (?, ?, ?, ?)
+        """,
+        'tbl_controle_migracao_python': """
+            INSERT INTO tbl_controle_migracao_python (strCodigoImagemOrigem) VALUES (?)
+        """,
+    }
     
     @staticmethod
     def get_stats(cursor):
@@ -46,17 +94,178 @@ class Repository:
         }
 
     @staticmethod
-    def fetch_batch(cursor):
-        """Busca um lote de pacientes pendentes, priorizando os mais recentes."""
+    def get_approx_stats(cursor):
+        """
+        Estatística aproximada e barata: contagem de linhas pelos metadados do catálogo
+        (sys.partitions), sem varrer as tabelas. Não separa Imgs/PDFs.
+        """
+        sql = """
+            SELECT
+                SUM(CASE WHEN p.object_id = OBJECT_ID('tbl_controle_migracao_python') THEN p.rows ELSE 0 END) as migrated,
+                SUM(CASE WHEN p.object_id = OBJECT_ID('tblmigracao') THEN p.rows ELSE 0 END) as source_total
+            FROM sys.partitions p
+            WHERE p.index_id IN (0, 1)
+            AND p.object_id IN (OBJECT_ID('tbl_controle_migracao_python'), OBJECT_ID('tblmigracao'))
+        """
+        cursor.execute(sql)
+        row = cursor.fetchone()
+        migrated = row[0] or 0
+        source_total = row[1] or 0
+        return {
+            'migrated_total': migrated,
+            'pending_total': max(source_total - migrated, 0)
+        }
+
+    @staticmethod
+    def ping(cursor):
+        """Ida e volta mínima ao servidor (SELECT 1), independente do volume de dados."""
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+
+    @staticmethod
+    def get_active_requests(cursor):
+        """Nº de requisições ativas de outras sessões no banco atual (carga do servidor)."""
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM sys.dm_exec_requests WITH (NOLOCK)
+            WHERE session_id <> @@SPID
+            AND database_id = DB_ID()
+            AND status IN ('running', 'runnable', 'suspended')
+        """)
+        return cursor.fetchone()[0]
+
+    # --- Mapa de Chaves img_rcl (tbl_mapa_img_rcl_python, comando prepare) ---
+
+    # None = ainda não verificado nesta execução
+    _key_map_present = None
+
+    @staticmethod
+    def has_key_map(cursor):
+        """Indica se o mapa de chaves existe (verificado uma vez por processo)."""
+        if Repository._key_map_present is None:
+            cursor.execute("SELECT CASE WHEN OBJECT_ID('tbl_mapa_img_rcl_python') IS NULL THEN 0 ELSE 1 END")
+            row = cursor.fetchone()
+            Repository._key_map_present = bool(row and row[0])
+        return Repository._key_map_present
+
+    @staticmethod
+    def _img_source(cursor):
+        """
+        (JOIN de img_rcl com alias i, expressão do código de procedimento).
+        Com o mapa, o JOIN é feito pela chave VARCHAR já materializada e indexada
+        (seek) em vez de CAST(i.IMG_RCL_IND AS VARCHAR(50)) sobre img_rcl inteira.
+        """
+        if Repository.has_key_map(cursor):
+            return ("INNER JOIN tbl_mapa_img_rcl_python i WITH (NOLOCK) ON i.strCodigo = m.strCodigo",
+                    "i.strProcedimento")
+        return ("INNER JOIN img_rcl i WITH (NOLOCK) ON m.strCodigo = CAST(i.IMG_RCL_IND AS VARCHAR(50))",
+                "CAST(i.IMG_RCL_RCL_COD AS VARCHAR(50))")
+
+    @staticmethod
+    def build_key_map(cursor):
+        """
+        (Re)cria o mapa: uma linha por linha de img_rcl com a chave já convertida
+        (strCodigo), a chave original tipada, o procedimento convertido e a data.
+        Retorna o nº de linhas.
+        """
+        cursor.execute("IF OBJECT_ID('tbl_mapa_img_rcl_python') IS NOT NULL DROP TABLE tbl_mapa_img_rcl_python")
+        cursor.execute("""
+            SELECT
+                CAST(i.IMG_RCL_IND AS VARCHAR(50)) as strCodigo,
+                i.IMG_RCL_IND,
+                CAST(i.IMG_RCL_RCL_COD AS VARCHAR(50)) as strProcedimento,
+                i.IMG_RCL_RCL_DTHR
+            INTO tbl_mapa_img_rcl_python
+            FROM img_rcl i WITH (NOLOCK)
+        """)
+        total = cursor.rowcount
+        cursor.execute("CREATE CLUSTERED INDEX IX_mapa_img_rcl_codigo ON tbl_mapa_img_rcl_python (strCodigo)")
+        cursor.execute("CREATE INDEX IX_mapa_img_rcl_ind ON tbl_mapa_img_rcl_python (IMG_RCL_IND)")
+        Repository._key_map_present = True
+        return total
+
+    @staticmethod
+    def refresh_key_map(cursor):
+        """
+        Inclui no mapa as linhas novas de img_rcl (anti-join pela chave tipada). Retorna o nº de linhas.
+        UPDLOCK/HOLDLOCK no anti-join trava as faixas da chave até o commit: dois workers
+        atualizando ao mesmo tempo não inserem a mesma linha duas vezes.
+        """
+        cursor.execute("""
+            INSERT INTO tbl_mapa_img_rcl_python (strCodigo, IMG_RCL_IND, strProcedimento, IMG_RCL_RCL_DTHR)
+            SELECT
+                CAST(i.IMG_RCL_IND AS VARCHAR(50)),
+                i.IMG_RCL_IND,
+                CAST(i.IMG_RCL_RCL_COD AS VARCHAR(50)),
+                i.IMG_RCL_RCL_DTHR
+            FROM img_rcl i WITH (NOLOCK)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM tbl_mapa_img_rcl_python K WITH (UPDLOCK, HOLDLOCK)
+                WHERE K.IMG_RCL_IND = i.IMG_RCL_IND
+            )
+        """)
+        return cursor.rowcount
+
+    @staticmethod
+    def ensure_support_indexes(cursor):
+        """
+        Índices de apoio das consultas quentes, criados apenas se nenhum índice
+        existente já começa pela coluna. Retorna os nomes dos índices criados.
+        """
+        indexes = (
+            ('IX_controle_migracao_origem', 'tbl_controle_migracao_python', 'strCodigoImagemOrigem', ''),
+            ('IX_migracao_paciente', 'tblmigracao', 'strCodigoPaciente', 'INCLUDE (strCodigo, strextensao)'),
+        )
+        created = []
+        for name, table, column, include in indexes:
+            cursor.execute("""
+                SELECT COUNT(*)
+                FROM sys.index_columns ic
+                INNER JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+                WHERE ic.object_id = OBJECT_ID(?) AND ic.key_ordinal = 1 AND c.name = ?
+            """, (table, column))
+            if cursor.fetchone()[0]:
+                continue
+            cursor.execute(f"CREATE INDEX {name} ON {table} ({column}) {include}")
+            created.append(name)
+        return created
+
+    # Pacientes em quarentena aguardando o próximo retry (alias do paciente: {alias})
+    _QUARANTINE_FILTER = """
+        AND NOT EXISTS (
+            SELECT 1 FROM tbl_quarentena_migracao_python Q WITH (NOLOCK)
+            WHERE Q.strCodigoPaciente = {alias}.strCodigoPaciente AND Q.datProximaTentativa > GETDATE()
+        )
+    """
+
+    @staticmethod
+    def fetch_batch(cursor, limit=None, exclude_leased=False, exclude_quarantined=False):
+        """
+        Busca um lote de pacientes pendentes, priorizando os mais recentes.
+        Com exclude_leased=True ignora pacientes com lease ativo de outro worker;
+        com exclude_quarantined=True ignora pacientes em quarentena (backoff).
+        """
+        quarantine_filter = Repository._QUARANTINE_FILTER.format(alias='m') if exclude_quarantined else ""
+        lease_filter = ""
+        if exclude_leased:
+            lease_filter = """
+            AND NOT EXISTS (
+                SELECT 1 FROM tbl_lease_migracao_python L WITH (NOLOCK)
+                WHERE L.strCodigoPaciente = m.strCodigoPaciente AND L.datExpira > GETDATE()
+            )
+            """
+        img_join, _ = Repository._img_source(cursor)
         sql = f"""
-            SELECT TOP {Config.BATCH_SIZE} m.strCodigoPaciente
+            SELECT TOP {int(limit or Config.BATCH_SIZE)} m.strCodigoPaciente
             FROM tblmigracao m WITH (NOLOCK)
-            INNER JOIN img_rcl i WITH (NOLOCK) ON m.strCodigo = CAST(i.IMG_RCL_IND AS VARCHAR(50))
+            {img_join}
             WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
             AND NOT EXISTS (
                 SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
                 WHERE C.strCodigoImagemOrigem = m.strCodigo
             )
+            {lease_filter}
+            {quarantine_filter}
             GROUP BY m.strCodigoPaciente
             ORDER BY MAX(i.IMG_RCL_RCL_DTHR) DESC
         """
@@ -64,36 +273,722 @@ class Repository:
         return [row[0] for row in cursor.fetchall()]
 
     @staticmethod
-    def fetch_patient_images(cursor, patient_id):
-        """Busca todas as imagens pendentes de um paciente específico."""
-        sql = """
-            SELECT 
-                m.strCodigo as id_imagem_origem,
-                CAST(m.strBase64 AS VARBINARY(MAX)) as blob_data,
-                ISNULL(m.strextensao, 'jpg') as extensao,
-                TRY_CONVERT(DATETIME, LEFT(CAST(i.IMG_RCL_RCL_DTHR AS VARCHAR(100)), 19), 120) as data_raw,
-                COALESCE(DP.Destino_Codigo, CAST(i.IMG_RCL_RCL_COD AS VARCHAR(50))) as cod_proc,
-                COALESCE(P_Novo.strProcedimento, P_Velho.strProcedimento, 'PROCEDIMENTO IMPORTADO') as nome_proc,
-                m.strCodigoPaciente as cod_origem
+    def fetch_patient_costs(cursor, patient_ids):
+        """Itens e bytes pendentes por paciente (custo estimado): { str(paciente): (itens, bytes) }."""
+        if not patient_ids:
+            return {}
+        Repository._load_patient_temp(cursor, patient_ids)
+        cursor.execute("""
+            SELECT m.strCodigoPaciente, COUNT(*), ISNULL(SUM(CAST(DATALENGTH(m.strBase64) AS BIGINT)), 0)
             FROM tblmigracao m WITH (NOLOCK)
-            INNER JOIN img_rcl i WITH (NOLOCK) ON m.strCodigo = CAST(i.IMG_RCL_IND AS VARCHAR(50))
-            LEFT JOIN tbl_migracao_codigos_depara DP WITH (NOLOCK) ON CAST(i.IMG_RCL_RCL_COD AS VARCHAR(50)) = DP.Origem_Codigo
-            LEFT JOIN tblProcedimento P_Novo WITH (NOLOCK) ON P_Novo.strCodigo = DP.Destino_Codigo
-            LEFT JOIN tblProcedimento P_Velho WITH (NOLOCK) ON P_Velho.strCodigo = CAST(i.IMG_RCL_RCL_COD AS VARCHAR(50))
-            WHERE m.strCodigoPaciente = ? 
-            AND m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
+            INNER JOIN #pacientes_lote PL ON PL.strCodigoPaciente = m.strCodigoPaciente
+            WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
             AND NOT EXISTS (
                 SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
                 WHERE C.strCodigoImagemOrigem = m.strCodigo
             )
-            ORDER BY i.IMG_RCL_RCL_DTHR
+            GROUP BY m.strCodigoPaciente
+        """)
+        return {str(row[0]): (row[1], row[2]) for row in cursor.fetchall()}
+
+    # --- Leases de Pacientes (multi-worker) ---
+
+    @staticmethod
+    def ensure_lease_table(cursor):
+        """Cria a tabela de leases (posse temporária de um paciente por um worker)."""
+        cursor.execute("""
+            IF OBJECT_ID('tbl_lease_migracao_python') IS NULL
+            CREATE TABLE tbl_lease_migracao_python (
+                strCodigoPaciente VARCHAR(50) NOT NULL PRIMARY KEY,
+                strWorkerId VARCHAR(100) NOT NULL,
+                datExpira DATETIME NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def claim_patient(cursor, patient_id, worker_id, lease_seconds):
         """
-        cursor.execute(sql, (patient_id,))
+        Tenta assumir o paciente de forma atômica: só consegue se não houver lease,
+        se o lease estiver expirado (worker caído) ou se já for deste worker.
+        Retorna True se o lease foi obtido.
+        """
+        cursor.execute("""
+            MERGE tbl_lease_migracao_python WITH (HOLDLOCK) AS t
+            USING (SELECT ? AS strCodigoPaciente) AS s
+                ON t.strCodigoPaciente = s.strCodigoPaciente
+            WHEN MATCHED AND (t.datExpira < GETDATE() OR t.strWorkerId = ?) THEN
+                UPDATE SET strWorkerId = ?, datExpira = DATEADD(SECOND, ?, GETDATE())
+            WHEN NOT MATCHED THEN
+                INSERT (strCodigoPaciente, strWorkerId, datExpira)
+                VALUES (s.strCodigoPaciente, ?, DATEADD(SECOND, ?, GETDATE()));
+        """, (str(patient_id), worker_id, worker_id, lease_seconds, worker_id, lease_seconds))
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def renew_lease(cursor, patient_id, worker_id, lease_seconds):
+        """
+        Estende o lease do paciente apenas se ainda for deste worker (um lease expirado
+        pode ter sido reassumido por outro). Retorna True se o lease foi renovado.
+        """
+        cursor.execute("""
+            UPDATE tbl_lease_migracao_python
+            SET datExpira = DATEADD(SECOND, ?, GETDATE())
+            WHERE strCodigoPaciente = ? AND strWorkerId = ?
+        """, (lease_seconds, str(patient_id), worker_id))
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def release_leases(cursor, patient_ids, worker_id):
+        """Libera os leases deste worker para os pacientes informados."""
+        if not patient_ids:
+            return
+        cursor.executemany(
+            "DELETE FROM tbl_lease_migracao_python WHERE strCodigoPaciente = ? AND strWorkerId = ?",
+            [(str(p), worker_id) for p in patient_ids]
+        )
+
+    # --- Fila Persistente (tbl_fila_migracao_python) ---
+
+    @staticmethod
+    def ensure_queue_table(cursor):
+        """Cria a tabela de fila e seu índice de prioridade, se ainda não existirem."""
+        cursor.execute("""
+            IF OBJECT_ID('tbl_fila_migracao_python') IS NULL
+            BEGIN
+                CREATE TABLE tbl_fila_migracao_python (
+                    strCodigoPaciente VARCHAR(50) NOT NULL PRIMARY KEY,
+                    datPrioridade DATETIME NOT NULL,
+                    intItens INT NOT NULL,
+                    bigBytes BIGINT NOT NULL,
+                    datInclusao DATETIME NOT NULL DEFAULT GETDATE()
+                );
+                CREATE INDEX IX_fila_migracao_prioridade
+                    ON tbl_fila_migracao_python (datPrioridade DESC, strCodigoPaciente);
+            END
+        """)
+
+    # Pacientes pendentes agregados (mesmos filtros do fetch_batch)
+    _QUEUE_SOURCE_SQL = """
+        SELECT
+            m.strCodigoPaciente,
+            ISNULL(TRY_CONVERT(DATETIME, LEFT(CAST(MAX(i.IMG_RCL_RCL_DTHR) AS VARCHAR(100)), 19), 120), '19000101') as datPrioridade,
+            COUNT(*) as intItens,
+            ISNULL(SUM(CAST(DATALENGTH(m.strBase64) AS BIGINT)), 0) as bigBytes
+        FROM tblmigracao m WITH (NOLOCK)
+        {img_join}
+        WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
+        AND NOT EXISTS (
+            SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
+            WHERE C.strCodigoImagemOrigem = m.strCodigo
+        )
+        {extra_filter}
+        GROUP BY m.strCodigoPaciente
+    """
+
+    @staticmethod
+    def build_queue(cursor):
+        """(Re)constrói a fila inteira a partir do anti-join completo. Retorna o nº de pacientes."""
+        Repository.ensure_queue_table(cursor)
+        cursor.execute("TRUNCATE TABLE tbl_fila_migracao_python")
+        cursor.execute(f"""
+            INSERT INTO tbl_fila_migracao_python (strCodigoPaciente, datPrioridade, intItens, bigBytes)
+            {Repository._QUEUE_SOURCE_SQL.format(img_join=Repository._img_source(cursor)[0], extra_filter='')}
+        """)
+        return cursor.rowcount
+
+    @staticmethod
+    def refresh_queue(cursor):
+        """
+        Atualização incremental: adiciona à fila apenas pacientes com itens pendentes
+        que ainda não estão enfileirados. Retorna o nº de pacientes adicionados.
+        """
+        extra_filter = """
+        AND NOT EXISTS (
+            SELECT 1 FROM tbl_fila_migracao_python F WITH (NOLOCK)
+            WHERE F.strCodigoPaciente = m.strCodigoPaciente
+        )
+        """
+        cursor.execute(f"""
+            INSERT INTO tbl_fila_migracao_python (strCodigoPaciente, datPrioridade, intItens, bigBytes)
+            {Repository._QUEUE_SOURCE_SQL.format(img_join=Repository._img_source(cursor)[0], extra_filter=extra_filter)}
+        """)
+        return cursor.rowcount
+
+    @staticmethod
+    def dequeue_batch(cursor, limit, after=None, exclude_quarantined=False):
+        """
+        Lê os próximos `limit` pacientes da fila por prioridade (mais recentes primeiro).
+        `after` = (datPrioridade, strCodigoPaciente) do último item lido (keyset watermark).
+        """
+        quarantine_filter = Repository._QUARANTINE_FILTER.format(alias='F') if exclude_quarantined else ""
+        if after is None:
+            cursor.execute(f"""
+                SELECT TOP {int(limit)} F.strCodigoPaciente, F.datPrioridade
+                FROM tbl_fila_migracao_python F WITH (NOLOCK)
+                WHERE 1 = 1
+                {quarantine_filter}
+                ORDER BY F.datPrioridade DESC, F.strCodigoPaciente
+            """)
+        else:
+            cursor.execute(f"""
+                SELECT TOP {int(limit)} F.strCodigoPaciente, F.datPrioridade
+                FROM tbl_fila_migracao_python F WITH (NOLOCK)
+                WHERE (F.datPrioridade < ? OR (F.datPrioridade = ? AND F.strCodigoPaciente > ?))
+                {quarantine_filter}
+                ORDER BY F.datPrioridade DESC, F.strCodigoPaciente
+            """, (after[0], after[0], after[1]))
         return cursor.fetchall()
 
     @staticmethod
-    def mark_as_migrated(cursor, image_origin_id):
-        cursor.execute("INSERT INTO tbl_controle_migracao_python (strCodigoImagemOrigem) VALUES (?)", (image_origin_id,))
+    def complete_queue_items(cursor, patient_ids):
+        """Remove da fila os pacientes concluídos (executado na mesma transação do lote)."""
+        if not patient_ids:
+            return
+        cursor.executemany(
+            "DELETE FROM tbl_fila_migracao_python WHERE strCodigoPaciente = ?",
+            [(str(p),) for p in patient_ids]
+        )
+
+    # --- Quarentena de Pacientes com Falha ---
+
+    @staticmethod
+    def ensure_quarantine_table(cursor):
+        """Cria a tabela de quarentena (falhas por paciente com backoff de retry)."""
+        cursor.execute("""
+            IF OBJECT_ID('tbl_quarentena_migracao_python') IS NULL
+            CREATE TABLE tbl_quarentena_migracao_python (
+                strCodigoPaciente VARCHAR(50) NOT NULL PRIMARY KEY,
+                strErroClasse VARCHAR(200) NOT NULL,
+                strErroMensagem VARCHAR(1000) NULL,
+                intTentativas INT NOT NULL,
+                datUltimaFalha DATETIME NOT NULL,
+                datProximaTentativa DATETIME NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def record_quarantine_failure(cursor, patient_id, error_class, error_message, base_seconds, max_seconds, max_attempts):
+        """
+        Registra uma falha do paciente e agenda o próximo retry com backoff exponencial
+        (base * 2^(tentativas-1), limitado a max_seconds). Após max_attempts o paciente
+        fica retido até ser liberado manualmente. Retorna (tentativas, próxima tentativa).
+        """
+        cursor.execute("""
+            MERGE tbl_quarentena_migracao_python WITH (HOLDLOCK) AS t
+            USING (SELECT ? AS strCodigoPaciente) AS s
+                ON t.strCodigoPaciente = s.strCodigoPaciente
+            WHEN MATCHED THEN
+                UPDATE SET strErroClasse = ?, strErroMensagem = ?,
+                           intTentativas = t.intTentativas + 1, datUltimaFalha = GETDATE()
+            WHEN NOT MATCHED THEN
+                INSERT (strCodigoPaciente, strErroClasse, strErroMensagem, intTentativas, datUltimaFalha, datProximaTentativa)
+                VALUES (s.strCodigoPaciente, ?, ?, 1, GETDATE(), GETDATE());
+        """, (str(patient_id), error_class, error_message, error_class, error_message))
+        cursor.execute("""
+            UPDATE tbl_quarentena_migracao_python
+            SET datProximaTentativa = CASE
+                WHEN intTentativas >= ? THEN '99991231'
+                ELSE DATEADD(SECOND,
+                    CASE WHEN intTentativas > 20 THEN ? ELSE
+                        CASE WHEN ? * POWER(CAST(2 AS BIGINT), intTentativas - 1) > ? THEN ?
+                             ELSE ? * POWER(CAST(2 AS BIGINT), intTentativas - 1) END
+                    END, GETDATE())
+            END
+            OUTPUT inserted.intTentativas, inserted.datProximaTentativa
+            WHERE strCodigoPaciente = ?
+        """, (max_attempts, max_seconds, base_seconds, max_seconds, max_seconds, base_seconds, str(patient_id)))
+        row = cursor.fetchone()
+        return row[0], row[1]
+
+    @staticmethod
+    def clear_quarantine(cursor, patient_ids):
+        """Remove da quarentena pacientes migrados com sucesso (ou liberados manualmente)."""
+        if not patient_ids:
+            return
+        cursor.executemany(
+            "DELETE FROM tbl_quarentena_migracao_python WHERE strCodigoPaciente = ?",
+            [(str(p),) for p in patient_ids]
+        )
+
+    @staticmethod
+    def release_all_quarantine(cursor):
+        """Libera todos os pacientes da quarentena. Retorna quantos foram liberados."""
+        cursor.execute("DELETE FROM tbl_quarentena_migracao_python")
+        return cursor.rowcount
+
+    @staticmethod
+    def list_quarantine(cursor):
+        cursor.execute("""
+            SELECT strCodigoPaciente, strErroClasse, strErroMensagem, intTentativas, datUltimaFalha, datProximaTentativa
+            FROM tbl_quarentena_migracao_python WITH (NOLOCK)
+            ORDER BY datUltimaFalha DESC
+        """)
+        return cursor.fetchall()
+
+    # --- Índice de Hash de Conteúdo (dedupe) ---
+
+    @staticmethod
+    def ensure_hash_table(cursor):
+        """Cria o índice persistente de hashes dos payloads já gravados."""
+        cursor.execute("""
+            IF OBJECT_ID('tbl_hash_migracao_python') IS NULL
+            CREATE TABLE tbl_hash_migracao_python (
+                intClienteId INT NOT NULL,
+                strCodigoProcedimento VARCHAR(50) NOT NULL,
+                strHash CHAR(64) NOT NULL,
+                strCodigoImagemOrigem VARCHAR(50) NOT NULL,
+                PRIMARY KEY (intClienteId, strCodigoProcedimento, strHash)
+            )
+        """)
+
+    @staticmethod
+    def fetch_content_hashes(cursor, client_id):
+        """Hashes já gravados do cliente: { (cod_proc, hash) }."""
+        cursor.execute("""
+            SELECT strCodigoProcedimento, strHash
+            FROM tbl_hash_migracao_python WITH (NOLOCK)
+            WHERE intClienteId = ?
+        """, (client_id,))
+        return {(row[0], row[1]) for row in cursor.fetchall()}
+
+    # --- Plano de Migração Pré-calculado (tbl_plano_migracao_python) ---
+
+    @staticmethod
+    def ensure_plan_table(cursor):
+        """Cria a tabela do plano (agrupamento e IDs calculados fora da janela noturna)."""
+        cursor.execute("""
+            IF OBJECT_ID('tbl_plano_migracao_python') IS NULL
+            BEGIN
+                CREATE TABLE tbl_plano_migracao_python (
+                    strCodigoImagemOrigem VARCHAR(50) NOT NULL PRIMARY KEY,
+                    strCodigoPaciente VARCHAR(50) NOT NULL,
+                    intGrupo INT NULL,
+                    strCodigoProcedimento VARCHAR(50) NULL,
+                    strDescrProcedimento VARCHAR(255) NULL,
+                    datItem DATETIME NULL,
+                    strExtensao VARCHAR(10) NOT NULL,
+                    bigBytes BIGINT NULL,
+                    intFaturaAtendimentoId INT NULL,
+                    intLaudoImagemId INT NULL,
+                    datPlano DATETIME NOT NULL DEFAULT GETDATE()
+                );
+                CREATE INDEX IX_plano_migracao_paciente
+                    ON tbl_plano_migracao_python (strCodigoPaciente, datItem);
+            END
+        """)
+
+    @staticmethod
+    def fetch_plan_candidates(cursor, limit):
+        """
+        Pacientes pendentes ainda sem plano (somente leitura, NOLOCK). Usa o mesmo JOIN
+        de img_rcl da leitura de imagens: paciente sem item planejável não é candidato.
+        """
+        img_join, _ = Repository._img_source(cursor)
+        cursor.execute(f"""
+            SELECT DISTINCT TOP {int(limit)} m.strCodigoPaciente
+            FROM tblmigracao m WITH (NOLOCK)
+            {img_join}
+            WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
+            AND NOT EXISTS (
+                SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
+                WHERE C.strCodigoImagemOrigem = m.strCodigo
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM tbl_plano_migracao_python P WITH (NOLOCK)
+                WHERE P.strCodigoPaciente = m.strCodigoPaciente
+            )
+        """)
+        return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def count_pending_items(cursor, patient_ids):
+        """Itens pendentes planejáveis na origem por paciente: { str(paciente): itens }."""
+        if not patient_ids:
+            return {}
+        Repository._load_patient_temp(cursor, patient_ids)
+        img_join, _ = Repository._img_source(cursor)
+        cursor.execute(f"""
+            SELECT m.strCodigoPaciente, COUNT(DISTINCT m.strCodigo)
+            FROM tblmigracao m WITH (NOLOCK)
+            INNER JOIN #pacientes_lote PL ON PL.strCodigoPaciente = m.strCodigoPaciente
+            {img_join}
+            WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
+            AND NOT EXISTS (
+                SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
+                WHERE C.strCodigoImagemOrigem = m.strCodigo
+            )
+            GROUP BY m.strCodigoPaciente
+        """)
+        return {str(row[0]): row[1] for row in cursor.fetchall()}
+
+    @staticmethod
+    def insert_plan(cursor, rows):
+        """Grava itens do plano: (codigo, paciente, grupo, cod_proc, nome_proc, data, ext, bytes, fatura_id, img_id)."""
+        if not rows:
+            return
+        cursor.fast_executemany = True
+        cursor.executemany("""
+            INSERT INTO tbl_plano_migracao_python (
+                strCodigoImagemOrigem, strCodigoPaciente, intGrupo, strCodigoProcedimento, strDescrProcedimento,
+                datItem, strExtensao, bigBytes, intFaturaAtendimentoId, intLaudoImagemId
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        cursor.fast_executemany = False
+
+    @staticmethod
+    def delete_plan(cursor, patient_ids):
+        """Remove o plano dos pacientes (concluídos ou com origem alterada)."""
+        if not patient_ids:
+            return
+        cursor.executemany(
+            "DELETE FROM tbl_plano_migracao_python WHERE strCodigoPaciente = ?",
+            [(str(p),) for p in patient_ids]
+        )
+
+    @staticmethod
+    def clear_plan(cursor):
+        Repository.ensure_plan_table(cursor)
+        cursor.execute("TRUNCATE TABLE tbl_plano_migracao_python")
+
+    @staticmethod
+    def fetch_planned_images(cursor, patient_ids, include_blobs=True):
+        """
+        Replay do plano: devolve as linhas pendentes no mesmo formato de fetch_patient_images,
+        com procedimento/data/IDs vindos do plano (sem os JOINs de img_rcl e de-para).
+        plan_ok = 0 indica que a origem mudou desde o planejamento (tamanho, extensão,
+        paciente ou registro removido). Retorna { cod_paciente: [rows] }.
+        """
+        by_patient = {p: [] for p in patient_ids}
+        if not patient_ids:
+            return by_patient
+
+        if len(by_patient) == 1:
+            patient_join = ""
+            patient_filter = "AND P.strCodigoPaciente = ?"
+            params = (str(patient_ids[0]),)
+        else:
+            Repository._load_patient_temp(cursor, patient_ids)
+            patient_join = "INNER JOIN #pacientes_lote PL ON PL.strCodigoPaciente = P.strCodigoPaciente"
+            patient_filter = ""
+            params = ()
+
+        cursor.execute(f"""
+            SELECT
+                P.strCodigoImagemOrigem as id_imagem_origem,
+                {Repository._blob_column(include_blobs)} as blob_data,
+                DATALENGTH(m.strBase64) as blob_size,
+                {Repository._hash_column(include_blobs)} as content_hash,
+                P.strExtensao as extensao,
+                P.datItem as data_raw,
+                P.strCodigoProcedimento as cod_proc,
+                P.strDescrProcedimento as nome_proc,
+                P.strCodigoPaciente as cod_origem,
+                P.intFaturaAtendimentoId as plan_fatura_id,
+                P.intLaudoImagemId as plan_img_id,
+                CASE WHEN m.strCodigo IS NOT NULL
+                      AND m.strCodigoPaciente = P.strCodigoPaciente
+                      AND ISNULL(m.strextensao, 'jpg') = P.strExtensao
+                      AND ISNULL(DATALENGTH(m.strBase64), -1) = ISNULL(P.bigBytes, -1)
+                     THEN 1 ELSE 0 END as plan_ok
+            FROM tbl_plano_migracao_python P WITH (NOLOCK)
+            {patient_join}
+            LEFT JOIN tblmigracao m WITH (NOLOCK) ON m.strCodigo = P.strCodigoImagemOrigem
+            WHERE NOT EXISTS (
+                SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
+                WHERE C.strCodigoImagemOrigem = P.strCodigoImagemOrigem
+            )
+            {patient_filter}
+            ORDER BY P.strCodigoPaciente, P.datItem
+        """, params)
+        keys = {str(p): p for p in patient_ids}
+        for row in cursor.fetchall():
+            by_patient[keys[str(row.cod_origem)]].append(row)
+        return by_patient
+
+    # SELECT das imagens pendentes; {patient_join}/{patient_filter} definem o(s) paciente(s)
+    _PATIENT_IMAGES_SQL = """
+        SELECT 
+            m.strCodigo as id_imagem_origem,
+            {blob_column} as blob_data,
+            DATALENGTH(m.strBase64) as blob_size,
+            {hash_column} as content_hash,
+            ISNULL(m.strextensao, 'jpg') as extensao,
+            TRY_CONVERT(DATETIME, LEFT(CAST(i.IMG_RCL_RCL_DTHR AS VARCHAR(100)), 19), 120) as data_raw,
+            {proc_columns},
+            m.strCodigoPaciente as cod_origem
+        FROM tblmigracao m WITH (NOLOCK)
+        {patient_join}
+        {img_join}
+        {proc_joins}
+        WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
+        {patient_filter}
+        AND NOT EXISTS (
+            SELECT 1 FROM tbl_controle_migracao_python C WITH (NOLOCK)
+            WHERE C.strCodigoImagemOrigem = m.strCodigo
+        )
+        ORDER BY {order_by}
+    """
+
+    @staticmethod
+    def _procedure_sql(proc_code):
+        """
+        (colunas cod_proc/nome_proc, JOINs de de-para/procedimento). Com PROCEDURE_CACHE
+        a consulta devolve só o código bruto e a resolução é feita em memória (ProcedureCache).
+        """
+        if Config.PROCEDURE_CACHE:
+            return f"{proc_code} as cod_proc, CAST(NULL AS VARCHAR(255)) as nome_proc", ""
+        columns = f"""COALESCE(DP.Destino_Codigo, {proc_code}) as cod_proc,
+            COALESCE(P_Novo.strProcedimento, P_Velho.strProcedimento, 'PROCEDIMENTO IMPORTADO') as nome_proc"""
+        joins = f"""LEFT JOIN tbl_migracao_codigos_depara DP WITH (NOLOCK) ON DP.Origem_Codigo = {proc_code}
+        LEFT JOIN tblProcedimento P_Novo WITH (NOLOCK) ON P_Novo.strCodigo = DP.Destino_Codigo
+        LEFT JOIN tblProcedimento P_Velho WITH (NOLOCK) ON P_Velho.strCodigo = {proc_code}"""
+        return columns, joins
+
+    @staticmethod
+    def fetch_depara_codes(cursor):
+        """Tabela de de-para completa: [(Origem_Codigo, Destino_Codigo)]."""
+        cursor.execute("SELECT Origem_Codigo, Destino_Codigo FROM tbl_migracao_codigos_depara WITH (NOLOCK)")
+        return cursor.fetchall()
+
+    @staticmethod
+    def fetch_procedure_names(cursor):
+        """Nomes dos procedimentos: [(strCodigo, strProcedimento)]."""
+        cursor.execute("SELECT strCodigo, strProcedimento FROM tblProcedimento WITH (NOLOCK) WHERE strProcedimento IS NOT NULL")
+        return cursor.fetchall()
+
+    @staticmethod
+    def _blob_column(include_blobs):
+        return "CAST(m.strBase64 AS VARBINARY(MAX))" if include_blobs else "CAST(NULL AS VARBINARY(MAX))"
+
+    @staticmethod
+    def _hash_column(include_blobs):
+        # Sem blob no worker, o hash de conteúdo (dedupe) é calculado no servidor
+        if Config.DEDUPE_CONTENT and not include_blobs:
+            return "CONVERT(VARCHAR(64), HASHBYTES('SHA2_256', m.strBase64), 2)"
+        return "CAST(NULL AS VARCHAR(64))"
+
+    @staticmethod
+    def fetch_patient_images(cursor, patient_id, include_blobs=True):
+        """
+        Busca todas as imagens pendentes de um paciente específico.
+        Com include_blobs=False retorna apenas metadados (blob_data = NULL),
+        usando blob_size para identificar registros vazios.
+        """
+        img_join, proc_code = Repository._img_source(cursor)
+        proc_columns, proc_joins = Repository._procedure_sql(proc_code)
+        sql = Repository._PATIENT_IMAGES_SQL.format(
+            img_join=img_join,
+            proc_columns=proc_columns,
+            proc_joins=proc_joins,
+            blob_column=Repository._blob_column(include_blobs),
+            hash_column=Repository._hash_column(include_blobs),
+            patient_join="",
+            patient_filter="AND m.strCodigoPaciente = ?",
+            order_by="i.IMG_RCL_RCL_DTHR",
+        )
+        cursor.execute(sql, (patient_id,))
+        rows = cursor.fetchall()
+        if Config.PROCEDURE_CACHE:
+            procedure_cache.resolve(cursor, rows)
+        return rows
+
+    @staticmethod
+    def _load_patient_temp(cursor, patient_ids):
+        """Carrega os pacientes do lote na tabela temporária #pacientes_lote."""
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#pacientes_lote') IS NULL
+            CREATE TABLE #pacientes_lote (strCodigoPaciente VARCHAR(50) NOT NULL PRIMARY KEY)
+        """)
+        cursor.execute("DELETE FROM #pacientes_lote")
+        cursor.fast_executemany = True
+        cursor.executemany(
+            "INSERT INTO #pacientes_lote (strCodigoPaciente) VALUES (?)",
+            [(str(p),) for p in dict.fromkeys(patient_ids)]
+        )
+        cursor.fast_executemany = False
+
+    @staticmethod
+    def fetch_batch_images(cursor, patient_ids, include_blobs=True, with_hash=True):
+        """
+        Carrega as imagens pendentes de TODOS os pacientes do lote em uma única consulta
+        (tabela temporária #pacientes_lote). Retorna { cod_paciente: [rows] } na ordem do lote.
+        with_hash=False nunca lê o conteúdo no servidor (uso do planner, só metadados).
+        """
+        by_patient = {p: [] for p in patient_ids}
+        if not patient_ids:
+            return by_patient
+
+        Repository._load_patient_temp(cursor, patient_ids)
+
+        img_join, proc_code = Repository._img_source(cursor)
+        proc_columns, proc_joins = Repository._procedure_sql(proc_code)
+        sql = Repository._PATIENT_IMAGES_SQL.format(
+            img_join=img_join,
+            proc_columns=proc_columns,
+            proc_joins=proc_joins,
+            blob_column=Repository._blob_column(include_blobs),
+            hash_column=Repository._hash_column(include_blobs) if with_hash else "CAST(NULL AS VARCHAR(64))",
+            patient_join="INNER JOIN #pacientes_lote PL ON PL.strCodigoPaciente = m.strCodigoPaciente",
+            patient_filter="",
+            order_by="m.strCodigoPaciente, i.IMG_RCL_RCL_DTHR",
+        )
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        if Config.PROCEDURE_CACHE:
+            procedure_cache.resolve(cursor, rows)
+        # Particiona por paciente (chave original do lote, que pode vir como str ou int)
+        keys = {str(p): p for p in patient_ids}
+        for row in rows:
+            by_patient[keys[str(row.cod_origem)]].append(row)
+        return by_patient
+
+    @staticmethod
+    def fetch_blobs(cursor, codes):
+        """Busca os blobs dos códigos informados. Retorna { strCodigo: bytes }."""
+        if not codes:
+            return {}
+        placeholders = ','.join(['?'] * len(codes))
+        cursor.execute(f"""
+            SELECT m.strCodigo, CAST(m.strBase64 AS VARBINARY(MAX)) as blob_data
+            FROM tblmigracao m WITH (NOLOCK)
+            WHERE m.strCodigo IN ({placeholders})
+            AND DATALENGTH(m.strBase64) > 0
+        """, list(codes))
+        blobs = {}
+        for code, blob in cursor.fetchall():
+            blobs.setdefault(code, blob)
+        return blobs
+
+    @staticmethod
+    def prepare_blob_stage(cursor):
+        """
+        Cria (se necessário) a tabela temporária de mapeamento de IDs usada no modo
+        SERVER_SIDE_BLOBS. Cada linha liga um strCodigo de origem aos IDs de destino.
+        """
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#stage_blob_map') IS NULL
+            CREATE TABLE #stage_blob_map (
+                strCodigoImagemOrigem VARCHAR(50) NOT NULL,
+                bolPdf BIT NOT NULL,
+                intLaudoImagemId INT NULL,
+                strLaudoImagem VARCHAR(255) NULL,
+                intClienteId INT NOT NULL,
+                intAtendimentoId INT NOT NULL,
+                intFaturaAtendimentoId INT NOT NULL,
+                intLaudoClienteId INT NOT NULL,
+                strCodigoProcedimento VARCHAR(50) NULL,
+                strDescrProcedimento VARCHAR(255) NULL,
+                datGrupo DATETIME NULL,
+                datItem DATETIME NULL
+            )
+        """)
+
+    @staticmethod
+    def stage_blob_map(cursor, rows):
+        """Envia o mapeamento compacto (sem blobs) para a tabela temporária."""
+        if not rows:
+            return
+        cursor.fast_executemany = True
+        cursor.executemany("""
+            INSERT INTO #stage_blob_map (
+                strCodigoImagemOrigem, bolPdf, intLaudoImagemId, strLaudoImagem,
+                intClienteId, intAtendimentoId, intFaturaAtendimentoId, intLaudoClienteId,
+                strCodigoProcedimento, strDescrProcedimento, datGrupo, datItem
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        cursor.fast_executemany = False
+
+    @staticmethod
+    def apply_blob_map(cursor):
+        """
+        Preenche tbllaudoimagem / tbllaudopdfanexo copiando os blobs de tblmigracao
+        dentro do servidor (INSERT ... SELECT) e marca os itens no controle.
+        Retorna (imagens_inseridas, pdfs_inseridos).
+        """
+        # CROSS APPLY com TOP 1 protege contra strCodigo duplicado na origem
+        cursor.execute("""
+            INSERT INTO tbllaudoimagem (
+                intLaudoImagemId, strLaudoImagem, intClienteId, intAtendimentoId, intFaturaAtendimentoId, 
+                strCodigoProcedimento, strDescrProcedimento, intOrdem, strTerminal, 
+                imgImagem, intUsuarioId, intEmpresaId, datLaudoImagem, bolImpressao, intLaudoClienteId
+            )
+            SELECT
+                s.intLaudoImagemId, s.strLaudoImagem, s.intClienteId, s.intAtendimentoId, s.intFaturaAtendimentoId,
+                s.strCodigoProcedimento, s.strDescrProcedimento, 0, 'MIGRACAO',
+                b.blob_data, 61, 1, s.datGrupo, 'N', s.intLaudoClienteId
+            FROM #stage_blob_map s
+            CROSS APPLY (
+                SELECT TOP 1 CAST(m.strBase64 AS VARBINARY(MAX)) as blob_data
+                FROM tblmigracao m WITH (NOLOCK)
+                WHERE m.strCodigo = s.strCodigoImagemOrigem AND DATALENGTH(m.strBase64) > 0
+            ) b
+            WHERE s.bolPdf = 0
+        """)
+        imgs = cursor.rowcount
+
+        # PDF: o mesmo conteúdo vai para as duas colunas (com e sem timbre)
+        cursor.execute("""
+            INSERT INTO tbllaudopdfanexo (
+                intClienteId, intAtendimentoId, intLaudoClienteId, 
+                strLaudoPDFAnexo, bolLiberado, intUsuarioId, 
+                datLaudoPDFAnexo, intEmpresaId, bolImportado, 
+                strLaudoPDFAnexoSemTimbre
+            )
+            SELECT
+                s.intClienteId, s.intAtendimentoId, s.intLaudoClienteId,
+                b.blob_data, 1, 61,
+                s.datItem, 1, 0,
+                b.blob_data
+            FROM #stage_blob_map s
+            CROSS APPLY (
+                SELECT TOP 1 CAST(m.strBase64 AS VARBINARY(MAX)) as blob_data
+                FROM tblmigracao m WITH (NOLOCK)
+                WHERE m.strCodigo = s.strCodigoImagemOrigem AND DATALENGTH(m.strBase64) > 0
+            ) b
+            WHERE s.bolPdf = 1
+        """)
+        pdfs = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO tbl_controle_migracao_python (strCodigoImagemOrigem)
+            SELECT strCodigoImagemOrigem FROM #stage_blob_map
+        """)
+        cursor.execute("DELETE FROM #stage_blob_map")
+        return imgs, pdfs
+
+    @staticmethod
+    def savepoint(cursor, name):
+        """
+        Cria um savepoint, abrindo a transação se ainda não houver uma.
+        Com autocommit=False o driver liga IMPLICIT_TRANSACTIONS: um BEGIN TRANSACTION
+        explícito com @@TRANCOUNT = 0 levaria o contador a 2 e o commit() só o baixaria
+        para 1 (paciente "confirmado" continuaria aberto). Por isso a transação é aberta
+        implicitamente por uma leitura inócua, e o contador é conferido.
+        """
+        cursor.execute(f"""
+            IF @@TRANCOUNT = 0
+            BEGIN
+                DECLARE @abre INT;
+                SELECT @abre = COUNT(*) FROM tbl_controle_migracao_python WITH (NOLOCK) WHERE 1 = 0;
+            END;
+            IF @@TRANCOUNT <> 1 THROW 50001, 'Savepoint fora de uma transação única (@@TRANCOUNT <> 1).', 1;
+            SAVE TRANSACTION {name};
+        """)
+
+    @staticmethod
+    def transaction_count(cursor):
+        cursor.execute("SELECT @@TRANCOUNT")
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def rollback_to_savepoint(cursor, name):
+        cursor.execute(f"ROLLBACK TRANSACTION {name}")
+
+    @staticmethod
+    def transaction_state(cursor):
+        """XACT_STATE(): 1 = ativa, 0 = nenhuma, -1 = condenada (só aceita rollback)."""
+        cursor.execute("SELECT XACT_STATE()")
+        return cursor.fetchone()[0]
 
     @staticmethod
     def toggle_identity(cursor, table, status):
@@ -102,3 +997,302 @@ class Repository:
             cursor.execute(f"SET IDENTITY_INSERT {table} {status}")
         except Exception:
             pass # Ignora erro se já estiver no estado desejado ou não permitido
+
+    # --- Auditoria em Massa (reconciliação origem x controle x destino) ---
+
+    @staticmethod
+    def ensure_audit_tables(cursor):
+        """
+        Cria o histórico de auditorias e a data de migração no controle (default GETDATE(),
+        metadado apenas: linhas antigas ficam NULL) com índice, para auditorias incrementais.
+        """
+        cursor.execute("""
+            IF OBJECT_ID('tbl_auditoria_migracao_python') IS NULL
+            CREATE TABLE tbl_auditoria_migracao_python (
+                intAuditoriaId INT IDENTITY(1,1) PRIMARY KEY,
+                datInicio DATETIME NOT NULL,
+                datFim DATETIME NULL,
+                strEscopo VARCHAR(200) NOT NULL,
+                intPacientes INT NULL,
+                intDivergentes INT NULL
+            )
+        """)
+        cursor.execute("""
+            IF COL_LENGTH('tbl_controle_migracao_python', 'datMigracao') IS NULL
+            ALTER TABLE tbl_controle_migracao_python
+                ADD datMigracao DATETIME NULL CONSTRAINT DF_controle_migracao_data DEFAULT GETDATE()
+        """)
+        cursor.execute("""
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_controle_migracao_data'
+                           AND object_id = OBJECT_ID('tbl_controle_migracao_python'))
+            CREATE INDEX IX_controle_migracao_data ON tbl_controle_migracao_python (datMigracao)
+        """)
+
+    @staticmethod
+    def start_audit(cursor, scope):
+        """Registra o início de uma auditoria. Retorna (id, datInicio)."""
+        cursor.execute("""
+            INSERT INTO tbl_auditoria_migracao_python (datInicio, strEscopo)
+            OUTPUT inserted.intAuditoriaId, inserted.datInicio
+            VALUES (GETDATE(), ?)
+        """, (scope,))
+        row = cursor.fetchone()
+        return row[0], row[1]
+
+    @staticmethod
+    def finish_audit(cursor, audit_id, patients, mismatches):
+        cursor.execute("""
+            UPDATE tbl_auditoria_migracao_python
+            SET datFim = GETDATE(), intPacientes = ?, intDivergentes = ?
+            WHERE intAuditoriaId = ?
+        """, (patients, mismatches, audit_id))
+
+    @staticmethod
+    def last_audit_start(cursor):
+        """Início da última auditoria concluída (watermark das execuções incrementais)."""
+        cursor.execute("SELECT MAX(datInicio) FROM tbl_auditoria_migracao_python WITH (NOLOCK) WHERE datFim IS NOT NULL")
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def fetch_patients_migrated_since(cursor, since):
+        """Pacientes com itens marcados no controle a partir de `since`."""
+        cursor.execute("""
+            SELECT DISTINCT m.strCodigoPaciente
+            FROM tbl_controle_migracao_python C WITH (NOLOCK)
+            INNER JOIN tblmigracao m WITH (NOLOCK) ON m.strCodigo = C.strCodigoImagemOrigem
+            WHERE C.datMigracao >= ?
+        """, (since,))
+        return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def load_audit_patients(cursor, patient_ids):
+        """Carrega os pacientes a auditar em #auditoria_pacientes (chave da origem e do destino)."""
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#auditoria_pacientes') IS NULL
+            CREATE TABLE #auditoria_pacientes (
+                strCodigoPaciente VARCHAR(50) NOT NULL PRIMARY KEY,
+                intClienteId INT NULL
+            )
+        """)
+        cursor.execute("DELETE FROM #auditoria_pacientes")
+        cursor.fast_executemany = True
+        cursor.executemany(
+            "INSERT INTO #auditoria_pacientes (strCodigoPaciente, intClienteId) VALUES (?, TRY_CAST(? AS INT))",
+            [(str(p), str(p)) for p in dict.fromkeys(patient_ids)]
+        )
+        cursor.fast_executemany = False
+
+    # Cadeia de destino por cliente: Atendimento -> Fatura -> Laudo -> {item}
+    # Destino pela cadeia do cliente; total = linhas gravadas pela migração (assinatura
+    # {migrated}), preexistentes = as demais (dados anteriores à migração)
+    _AUDIT_DEST_SQL = """
+        SELECT A.intClienteId,
+            SUM(CASE WHEN {migrated} THEN 1 ELSE 0 END) as total,
+            SUM(CASE WHEN {migrated} THEN 0 ELSE 1 END) as preexistentes
+        FROM tblatendimento A WITH (NOLOCK)
+        JOIN tblfaturaatendimento F WITH (NOLOCK) ON F.intAtendimentoId = A.intAtendimentoId AND F.intClienteId = A.intClienteId
+        JOIN tbllaudocliente L WITH (NOLOCK) ON L.intFaturaAtendimentoId = F.intFaturaAtendimentoId AND L.intClienteId = A.intClienteId
+        JOIN {item_table} X WITH (NOLOCK) ON X.intLaudoClienteId = L.intLaudoClienteId AND X.intClienteId = A.intClienteId
+        {dest_join}
+        WHERE 1 = 1
+        {dest_filter}
+        GROUP BY A.intClienteId
+    """
+
+    # Valores fixos que o worker (e apply_blob_map) grava em cada linha migrada
+    _AUDIT_MIGRATED = {
+        'tbllaudoimagem': "A.intUsuarioId = 61 AND A.intTipoAtendimentoId = 2 AND X.intUsuarioId = 61 AND X.strTerminal = 'MIGRACAO'",
+        'tbllaudopdfanexo': "A.intUsuarioId = 61 AND A.intTipoAtendimentoId = 2 AND X.intUsuarioId = 61 AND X.bolImportado = 0",
+    }
+
+    @staticmethod
+    def reconcile_patients(cursor, source_join="", source_filter="", dest_join="", dest_filter="",
+                           source_params=(), dest_params=()):
+        """
+        Reconciliação set-based por paciente, em uma consulta agregada:
+        itens da origem, marcados no controle, cópias descartadas pelo dedupe (hash já
+        gravado em tbl_hash_migracao_python por outro item do cliente), esperados no
+        destino (marcados com conteúdo e data válida, exceto as cópias) e imagens/PDFs
+        gravados pela migração na cadeia atendimento -> fatura -> laudo (mesma árvore
+        do validate_patient), com os itens preexistentes do cliente à parte.
+        """
+        dest_sql = {
+            table: Repository._AUDIT_DEST_SQL.format(item_table=table, migrated=migrated,
+                                                     dest_join=dest_join, dest_filter=dest_filter)
+            for table, migrated in Repository._AUDIT_MIGRATED.items()
+        }
+        cursor.execute(f"""
+            WITH src AS (
+                SELECT
+                    m.strCodigoPaciente,
+                    COUNT(DISTINCT m.strCodigo) as intItens,
+                    COUNT(DISTINCT C.strCodigoImagemOrigem) as intMarcados,
+                    COUNT(DISTINCT CASE WHEN D.bolCopia = 1 THEN m.strCodigo END) as intDuplicados,
+                    COUNT(DISTINCT CASE WHEN C.strCodigoImagemOrigem IS NOT NULL
+                        AND DATALENGTH(m.strBase64) > 0
+                        AND TRY_CONVERT(DATETIME, LEFT(CAST(i.IMG_RCL_RCL_DTHR AS VARCHAR(100)), 19), 120) IS NOT NULL
+                        AND D.bolCopia IS NULL
+                        THEN m.strCodigo END) as intEsperados
+                FROM tblmigracao m WITH (NOLOCK)
+                {Repository._img_source(cursor)[0]}
+                LEFT JOIN tbl_controle_migracao_python C WITH (NOLOCK) ON C.strCodigoImagemOrigem = m.strCodigo
+                OUTER APPLY (
+                    SELECT TOP 1 1 as bolCopia
+                    FROM tbl_hash_migracao_python H WITH (NOLOCK)
+                    WHERE C.strCodigoImagemOrigem IS NOT NULL
+                    AND H.intClienteId = TRY_CAST(m.strCodigoPaciente AS INT)
+                    AND H.strHash = CONVERT(VARCHAR(64), HASHBYTES('SHA2_256', m.strBase64), 2)
+                    AND H.strCodigoImagemOrigem <> m.strCodigo
+                ) D
+                {source_join}
+                WHERE m.strextensao IN ('jpg', 'jpeg', 'png', 'bmp', 'pdf')
+                {source_filter}
+                GROUP BY m.strCodigoPaciente
+            ),
+            img AS ({dest_sql['tbllaudoimagem']}),
+            pdf AS ({dest_sql['tbllaudopdfanexo']})
+            SELECT
+                s.strCodigoPaciente, s.intItens, s.intMarcados, s.intDuplicados, s.intEsperados,
+                ISNULL(img.total, 0) as intImagens,
+                ISNULL(pdf.total, 0) as intPdfs,
+                ISNULL(img.preexistentes, 0) + ISNULL(pdf.preexistentes, 0) as intPreexistentes
+            FROM src s
+            LEFT JOIN img ON img.intClienteId = TRY_CAST(s.strCodigoPaciente AS INT)
+            LEFT JOIN pdf ON pdf.intClienteId = TRY_CAST(s.strCodigoPaciente AS INT)
+        """, tuple(source_params) + tuple(dest_params) + tuple(dest_params))
+        return cursor.fetchall()
+
+
+class ProcedureCache:
+    """
+    De-para e nomes de procedimento em memória (tabelas pequenas e quase estáticas).
+
+    Substitui, na consulta quente, o LEFT JOIN com tbl_migracao_codigos_depara e os
+    dois com tblProcedimento: a consulta devolve o IMG_RCL_RCL_COD bruto e cod_proc/
+    nome_proc são resolvidos aqui com a mesma regra dos COALESCE. As tabelas são
+    recarregadas a cada PROCEDURE_CACHE_TTL segundos (0 = sem expiração) ou após
+    invalidate(). Chaves comparadas sem diferenciar maiúsculas e espaços à direita,
+    como na collation padrão do banco.
+    """
+    DEFAULT_NAME = 'PROCEDIMENTO IMPORTADO'
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.depara = {}
+        self.names = {}
+        self.loaded_at = None
+        self._lock = threading.Lock() # Leitor do pipeline roda em outra thread
+
+    @staticmethod
+    def _key(code):
+        return str(code).rstrip().upper()
+
+    def _expired(self):
+        ttl = Config.PROCEDURE_CACHE_TTL if self.ttl is None else self.ttl
+        return self.loaded_at is None or (ttl > 0 and time.time() - self.loaded_at > ttl)
+
+    def load(self, cursor):
+        depara = {}
+        for origem, destino in Repository.fetch_depara_codes(cursor):
+            if origem is not None and destino is not None:
+                depara.setdefault(self._key(origem), destino)
+        names = {}
+        for code, name in Repository.fetch_procedure_names(cursor):
+            if code is not None:
+                names.setdefault(self._key(code), name)
+        self.depara, self.names = depara, names
+        self.loaded_at = time.time()
+        print(f"📚 Cache de procedimentos: {len(depara)} de-para | {len(names)} procedimentos.")
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def resolve(self, cursor, rows):
+        """Preenche cod_proc/nome_proc das linhas (cod_proc chega com o código bruto)."""
+        with self._lock:
+            if self._expired():
+                self.load(cursor)
+        for row in rows:
+            raw = row.cod_proc
+            if raw is None:
+                row.nome_proc = self.DEFAULT_NAME
+                continue
+            key = self._key(raw)
+            destino = self.depara.get(key)
+            name = self.names.get(self._key(destino)) if destino is not None else None
+            row.cod_proc = destino if destino is not None else raw
+            row.nome_proc = name or self.names.get(key) or self.DEFAULT_NAME
+        return rows
+
+
+procedure_cache = ProcedureCache()
+
+
+class BulkWriter:
+    """
+    Camada de escrita em lote para as tabelas de destino e de controle.
+
+    Acumula as linhas por tabela e grava com binding em array (executemany com
+    fast_executemany), sempre na ordem pai -> filho para respeitar as FKs.
+    O buffer é descarregado ao atingir WRITER_FLUSH_ROWS linhas em uma tabela ou
+    WRITER_FLUSH_BYTES de blobs acumulados, e explicitamente via flush().
+    """
+
+    # Ordem de gravação: Atendimento -> Fatura -> Laudo -> Itens -> Hashes -> Controle
+    TABLE_ORDER = (
+        'tblatendimento',
+        'tblfaturaatendimento',
+        'tbllaudocliente',
+        'tbllaudoimagem',
+        'tbllaudopdfanexo',
+        'tbl_hash_migracao_python',
+        'tbl_controle_migracao_python',
+    )
+
+    def __init__(self, cursor, flush_rows=None, flush_bytes=None):
+        self.cursor = cursor
+        self.flush_rows = max(1, flush_rows or Config.WRITER_FLUSH_ROWS)
+        self.flush_bytes = flush_bytes or Config.WRITER_FLUSH_BYTES
+        self.buffers = {table: [] for table in self.TABLE_ORDER}
+        self.pending_bytes = 0
+        self.bytes_written = 0
+        # Latência (s) de cada chamada ao banco, consumida pelo Throttle
+        self.latencies = []
+
+    def add(self, table, params):
+        """Enfileira uma linha para a tabela; descarrega se algum limite for atingido."""
+        self.buffers[table].append(params)
+        self.pending_bytes += sum(len(p) for p in params if isinstance(p, (bytes, bytearray, memoryview)))
+        if len(self.buffers[table]) >= self.flush_rows or self.pending_bytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        """Grava todos os buffers pendentes (pais antes dos filhos)."""
+        for table in self.TABLE_ORDER:
+            rows = self.buffers[table]
+            if not rows:
+                continue
+            sql = Repository.INSERT_SQL[table]
+            started = time.perf_counter()
+            if len(rows) == 1:
+                self.cursor.execute(sql, rows[0])
+            else:
+                self.cursor.fast_executemany = Config.FAST_EXECUTEMANY
+                try:
+                    self.cursor.executemany(sql, rows)
+                finally:
+                    self.cursor.fast_executemany = False
+            self.latencies.append(time.perf_counter() - started)
+            self.buffers[table] = []
+        self.bytes_written += self.pending_bytes
+        self.pending_bytes = 0
+
+    def take_latencies(self):
+        """Retorna e limpa as latências registradas desde a última chamada."""
+        samples, self.latencies = self.latencies, []
+        return samples
+
+    def discard(self):
+        """Descarta o que ainda não foi gravado (usado após rollback)."""
+        self.buffers = {table: [] for table in self.TABLE_ORDER}
+        self.pending_bytes = 0
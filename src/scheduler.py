@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from src.config import Config
+
+# Abreviações aceitas no calendário (português ou inglês) -> weekday()
+DAYS = {
+    'seg': 0, 'ter': 1, 'qua': 2, 'qui': 3, 'sex': 4, 'sab': 5, 'sáb': 5, 'dom': 6,
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6,
+}
+DAY_NAMES = ('Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom')
+WEEK_MINUTES = 7 * 1440
+
+
+class OperatingWindow:
+    """
+    Calendário semanal de funcionamento (OPERATING_WINDOWS).
+
+    Formato: entradas separadas por ';' no padrão "<dia>[-<dia>] HH:MM-HH:MM".
+    Um fim menor que o início atravessa a meia-noite (ex.: "seg-sex 18:00-05:00"
+    vai de 18h até 05h do dia seguinte). Janelas sobrepostas/contíguas são unidas,
+    inclusive na virada da semana, e as fronteiras são calculadas exatamente.
+    """
+    def __init__(self, spec=None, timezone=None):
+        self.spec = spec or Config.OPERATING_WINDOWS
+        self.tz = ZoneInfo(timezone or Config.OPERATING_TIMEZONE)
+        self.intervals = self._parse(self.spec)
+
+    @staticmethod
+    def _minutes(text):
+        hour, minute = text.strip().split(':')
+        value = int(hour) * 60 + int(minute)
+        if not 0 <= value <= 1440:
+            raise ValueError(f"Horário inválido: {text}")
+        return value
+
+    @classmethod
+    def _parse(cls, spec):
+        """Converte o calendário em intervalos [início, fim) em minutos desde Seg 00:00."""
+        weekly = []
+        for entry in filter(None, (e.strip() for e in spec.split(';'))):
+            try:
+                days, hours = entry.split()
+                first, _, last = days.lower().partition('-')
+                start_day, end_day = DAYS[first], DAYS[last or first]
+                start_text, end_text = hours.split('-')
+            except (ValueError, KeyError):
+                raise ValueError(f"Entrada inválida em OPERATING_WINDOWS: '{entry}'")
+            start, end = cls._minutes(start_text), cls._minutes(end_text)
+            length = (end - start) % 1440 or 1440 # Fim <= início: atravessa a meia-noite
+            day = start_day
+            while True:
+                begin = day * 1440 + start
+                weekly.append((begin, begin + length))
+                if day == end_day:
+                    break
+                day = (day + 1) % 7
+        if not weekly:
+            raise ValueError("OPERATING_WINDOWS não define nenhuma janela")
+
+        # Replica na semana anterior/seguinte para unir janelas que cruzam Dom -> Seg
+        expanded = sorted((s + k * WEEK_MINUTES, e + k * WEEK_MINUTES) for s, e in weekly for k in (-1, 0, 1, 2))
+        merged = [list(expanded[0])]
+        for start, end in expanded[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(i) for i in merged]
+
+    def _locate(self, now=None):
+        """(horário local sem tz, Seg 00:00 da semana, minuto da semana)."""
+        local = (now or datetime.now(self.tz)).astimezone(self.tz).replace(tzinfo=None)
+        monday = (local - timedelta(days=local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        return local, monday, (local - monday).total_seconds() / 60.0
+
+    def is_open(self, now=None):
+        _, _, minute = self._locate(now)
+        return any(start <= minute < end for start, end in self.intervals)
+
+    def closes_at(self, now=None):
+        """Fim da janela corrente (None se fechado)."""
+        _, monday, minute = self._locate(now)
+        for start, end in self.intervals:
+            if start <= minute < end:
+                return monday + timedelta(minutes=end)
+        return None
+
+    def opens_at(self, now=None):
+        """Início da próxima janela (agora, se já estiver aberta)."""
+        local, monday, minute = self._locate(now)
+        for start, end in self.intervals:
+            if start <= minute < end:
+                return local
+            if start > minute:
+                return monday + timedelta(minutes=start)
+        return None
+
+    def describe(self):
+        """Linhas legíveis da semana corrente (para o banner)."""
+        fmt = lambda m: f"{DAY_NAMES[(m // 1440) % 7]} {(m % 1440) // 60:02d}:{m % 60:02d}"
+        lines = [f"{fmt(start)} até {fmt(end)}" for start, end in self.intervals if 0 <= start < WEEK_MINUTES]
+        return lines or ["Semana inteira (24/7)"]
+
+
+class WindowScheduler:
+    """
+    Admissão de trabalho ciente da janela de funcionamento.
+
+    Fora da janela, dorme exatamente até a próxima abertura. Dentro dela, estima o
+    custo de cada paciente (bytes e itens pendentes x vazão medida, por média
+    móvel) e só admite o que termina antes do fechamento (menos uma margem),
+    começando pelos maiores pacientes para concentrá-los no início da janela.
+    """
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, window=None, enabled=None):
+        self.enabled = Config.CHECK_OPERATING_HOURS if enabled is None else enabled
+        self.window = window or (OperatingWindow() if self.enabled else None)
+        self.bytes_per_second = Config.WINDOW_INITIAL_MBPS * 1024 * 1024
+        self.items_per_second = Config.WINDOW_INITIAL_ITEMS_PER_SECOND
+
+    def is_open(self):
+        return not self.enabled or self.window.is_open()
+
+    def seconds_until_open(self):
+        local, _, _ = self.window._locate()
+        return max((self.window.opens_at() - local).total_seconds(), 0.0)
+
+    def seconds_left(self):
+        """Segundos até o fechamento da janela corrente (infinito sem restrição)."""
+        if not self.enabled:
+            return float('inf')
+        closes = self.window.closes_at()
+        if closes is None:
+            return 0.0
+        local, _, _ = self.window._locate()
+        return (closes - local).total_seconds()
+
+    def estimate(self, cost):
+        """Duração estimada (s) de um paciente; cost = (itens, bytes)."""
+        if not cost:
+            return 0.0
+        items, size = cost
+        return max(size / self.bytes_per_second, items / self.items_per_second)
+
+    def record(self, cost, seconds):
+        """Atualiza a vazão medida com um paciente concluído."""
+        if not cost or seconds <= 0:
+            return
+        items, size = cost
+        if size:
+            self.bytes_per_second += self.EWMA_ALPHA * (size / seconds - self.bytes_per_second)
+        if items:
+            self.items_per_second += self.EWMA_ALPHA * (items / seconds - self.items_per_second)
+
+    def admit(self, patient_ids, costs, limit, pause=0.0):
+        """
+        Seleciona até `limit` pacientes que cabem no restante da janela, maiores primeiro.
+        `costs` = { str(paciente): (itens, bytes) }; `pause` = pausa prevista entre pacientes.
+        """
+        if not self.enabled:
+            return list(patient_ids)[:limit]
+        budget = self.seconds_left() - Config.WINDOW_SAFETY_SECONDS
+        ordered = sorted(patient_ids, key=lambda p: costs.get(str(p), (0, 0))[1], reverse=True)
+        admitted = []
+        for patient_id in ordered:
+            needed = self.estimate(costs.get(str(patient_id))) + pause
+            if needed <= budget:
+                admitted.append(patient_id)
+                budget -= needed
+                if len(admitted) >= limit:
+                    break
+        return admitted
+
+    def can_start(self, cost):
+        """Confere, no momento de iniciar, se o paciente ainda termina antes do fechamento."""
+        if not self.enabled:
+            return True
+        return self.estimate(cost) <= self.seconds_left() - Config.WINDOW_SAFETY_SECONDS
+
+    def summary(self):
+        return f"Vazão estimada {self.bytes_per_second / (1024 * 1024):.1f} MB/s | {self.items_per_second:.1f} itens/s"
@@ -0,0 +1,72 @@
+import time
+from src.config import Config
+from src.repository import Repository
+
+class ProgressTracker:
+    """
+    Contadores de progresso em memória.
+
+    Objetivo: Evitar as duas varreduras completas de get_stats antes de cada lote.
+    Estratégia: Semeia os contadores uma vez (exato ou aproximado pelo catálogo) e
+    depois apenas aplica os totais de cada paciente, confirmados junto com o commit.
+    """
+    def __init__(self, mode=None, refresh_seconds=None):
+        self.mode = mode or Config.STATS_MODE
+        self.refresh_seconds = Config.STATS_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        self.approximate = self.mode == 'approx'
+        self.counts = None
+        self.last_seed = 0.0
+        # Deltas do lote em andamento (aplicados só após o commit)
+        self.staged = []
+
+    def seed(self, cursor):
+        """Carrega os contadores a partir do banco."""
+        if self.approximate:
+            self.counts = Repository.get_approx_stats(cursor)
+        else:
+            self.counts = Repository.get_stats(cursor)
+        self.last_seed = time.time()
+
+    def refresh_if_due(self, cursor):
+        """Semeia na primeira chamada e, se configurado, a cada STATS_REFRESH_SECONDS."""
+        if self.counts is None:
+            self.seed(cursor)
+        elif self.refresh_seconds > 0 and time.time() - self.last_seed >= self.refresh_seconds:
+            self.seed(cursor)
+
+    def record_patient(self, result):
+        """Registra os totais de um paciente (pendente até commit())."""
+        self.staged.append(result)
+
+    def commit(self):
+        """Aplica os deltas do lote confirmado."""
+        if self.counts is None:
+            self.staged = []
+            return
+        for result in self.staged:
+            # Vazios e duplicados também são marcados no controle
+            pdfs = result['saved_pdfs'] + result['skipped_pdfs'] + result['duplicate_pdfs']
+            imgs = (result['saved_imgs'] + result['skipped_empty'] - result['skipped_pdfs']
+                    + result['duplicates'] - result['duplicate_pdfs'])
+            if self.approximate:
+                self.counts['migrated_total'] += imgs + pdfs
+                self.counts['pending_total'] = max(self.counts['pending_total'] - imgs - pdfs, 0)
+            else:
+                self.counts['migrated_imgs'] += imgs
+                self.counts['migrated_pdfs'] += pdfs
+                self.counts['pending_imgs'] = max(self.counts['pending_imgs'] - imgs, 0)
+                self.counts['pending_pdfs'] = max(self.counts['pending_pdfs'] - pdfs, 0)
+        self.staged = []
+
+    def rollback(self):
+        """Descarta os deltas de um lote revertido."""
+        self.staged = []
+
+    def summary(self):
+        """Linha de status no mesmo formato do monitoramento original."""
+        c = self.counts
+        if c is None:
+            return "Sem dados"
+        if self.approximate:
+            return f"Migrados [~{c['migrated_total']} Itens] | Pendentes [~{c['pending_total']} Itens] (aprox.)"
+        return f"Migrados [{c['migrated_imgs']} Imgs | {c['migrated_pdfs']} PDFs] | Pendentes [{c['pending_imgs']} Imgs | {c['pending_pdfs']} PDFs]"
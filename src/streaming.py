@@ -0,0 +1,47 @@
+from src.config import Config
+from src.repository import Repository
+
+class BlobStreamer:
+    """
+    Busca sob demanda dos blobs de um paciente (fase 2 do modo STREAM_BLOBS).
+
+    A fase 1 traz apenas metadados (com DATALENGTH); aqui os blobs são lidos em
+    blocos de até STREAM_MAX_BYTES e cada um é entregue uma única vez (take) e
+    descartado do cache, limitando a memória do worker. `items` deve vir na ordem
+    exata dos take() (no worker, os grupos de group_images achatados); um bloco
+    nunca relê códigos que já estão no cache.
+    """
+    # Limite de códigos por consulta (parâmetros do SQL Server: máx. 2100)
+    MAX_CODES_PER_FETCH = 500
+
+    def __init__(self, cursor, items, max_bytes=None):
+        self.cursor = cursor
+        self.max_bytes = max_bytes or Config.STREAM_MAX_BYTES
+        self.order = [item.id_imagem_origem for item in items]
+        self.sizes = {item.id_imagem_origem: item.blob_size or 0 for item in items}
+        self.position = {code: idx for idx, code in enumerate(self.order)}
+        self.cache = {}
+
+    def _load_from(self, code):
+        """Carrega um bloco a partir de `code`, respeitando o teto de bytes (mínimo 1 item)."""
+        start = self.position[code]
+        codes = []
+        total = 0
+        for next_code in self.order[start:]:
+            if next_code in self.cache:
+                continue
+            size = self.sizes[next_code]
+            if codes and (total + size > self.max_bytes or len(codes) >= self.MAX_CODES_PER_FETCH):
+                break
+            codes.append(next_code)
+            total += size
+        self.cache.update(Repository.fetch_blobs(self.cursor, codes))
+        # Códigos sem blob retornado ficam como None (tratados como vazios)
+        for c in codes:
+            self.cache.setdefault(c, None)
+
+    def take(self, code):
+        """Retorna o blob do item e o remove do cache."""
+        if code not in self.cache:
+            self._load_from(code)
+        return self.cache.pop(code)
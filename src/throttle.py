@@ -0,0 +1,119 @@
+import time
+from src.config import Config
+from src.database import is_connection_error, is_timeout
+from src.repository import Repository
+
+class Throttle:
+    """
+    Controle de ritmo do worker (tamanho de lote e pausas).
+
+    Modo 'fixed': usa BATCH_SIZE / SLEEP_PATIENT / SLEEP_BATCH como antes.
+    Modo 'adaptive': mede por média móvel a latência dos commits e de um SELECT 1
+    na conexão de monitoramento e, opcionalmente, a carga do servidor (requisições
+    ativas). Os flushes do writer não entram: seu tempo cresce com o payload (linhas e
+    blobs) e um paciente pesado pareceria sobrecarga do banco. Com o banco ocioso
+    zera as pausas e aumenta o lote; com a latência acima do alvo dobra as pausas
+    e reduz o lote.
+    """
+    # Média móvel exponencial: peso da amostra mais recente
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, mode=None):
+        self.mode = mode or Config.THROTTLE_MODE
+        self.adaptive = self.mode == 'adaptive'
+        self.batch_size = Config.BATCH_SIZE
+        self.pause = Config.SLEEP_PATIENT
+        self.latency_ms = None
+        self.active_requests = None
+        self.load = 0.0
+        self.server_stats = Config.THROTTLE_SERVER_STATS
+
+    def observe(self, seconds):
+        """Registra uma amostra de latência (commit ou SELECT 1, em segundos)."""
+        if not self.adaptive:
+            return
+        ms = seconds * 1000.0
+        if self.latency_ms is None:
+            self.latency_ms = ms
+        else:
+            self.latency_ms = self.EWMA_ALPHA * ms + (1 - self.EWMA_ALPHA) * self.latency_ms
+
+    def _probe(self, cursor):
+        """Mede o SELECT 1 (ida e volta) e registra como amostra de latência."""
+        started = time.perf_counter()
+        try:
+            Repository.ping(cursor)
+        except Exception:
+            return # Falha do monitor: sem amostra neste ajuste (a conexão é testada pelo ConnectionManager)
+        self.observe(time.perf_counter() - started)
+
+    def _read_server_load(self, cursor):
+        """Requisições ativas de outras sessões no banco (requer VIEW SERVER STATE)."""
+        try:
+            self.active_requests = Repository.get_active_requests(cursor)
+        except Exception as e:
+            if is_connection_error(e) or is_timeout(e):
+                self.active_requests = None # Falha transitória: tenta de novo no próximo ajuste
+                return
+            print(f"⚠️  Throttle: estatísticas do servidor indisponíveis ({e}). Usando apenas latência.")
+            self.server_stats = False
+            self.active_requests = None
+
+    def adjust(self, cursor=None):
+        """Recalcula pausa e tamanho de lote a partir da carga observada."""
+        if not self.adaptive:
+            return
+        if cursor is not None:
+            self._probe(cursor)
+        if self.server_stats and cursor is not None:
+            self._read_server_load(cursor)
+
+        ratios = []
+        if self.latency_ms is not None:
+            ratios.append(self.latency_ms / Config.THROTTLE_TARGET_LATENCY_MS)
+        if self.active_requests is not None:
+            ratios.append(self.active_requests / Config.THROTTLE_MAX_ACTIVE_REQUESTS)
+        if not ratios:
+            return
+        self.load = max(ratios)
+
+        if self.load > 1.2:
+            # Banco ocupado: recua
+            self.pause = min(max(self.pause * 2, 0.5), Config.THROTTLE_MAX_PAUSE)
+            self.batch_size = max(1, self.batch_size // 2)
+        elif self.load < 0.8:
+            # Banco ocioso: acelera
+            self.pause = self.pause / 2 if self.pause > 0.1 else 0.0
+            self.batch_size = min(self.batch_size + 1, Config.THROTTLE_MAX_BATCH_SIZE)
+
+    def budget_scale(self):
+        """Fator do orçamento de bytes/itens do lote (BatchComposer) conforme a carga."""
+        return self.batch_size / Config.BATCH_SIZE if self.adaptive else 1.0
+
+    def patient_pause(self):
+        """Pausa entre pacientes."""
+        return self.pause if self.adaptive else Config.SLEEP_PATIENT
+
+    def batch_pause(self, batch_was_full):
+        """
+        Pausa após um lote. No modo adaptativo, um lote cheio indica que ainda há
+        fila, então usa apenas a pausa corrente em vez de SLEEP_BATCH.
+        """
+        if self.adaptive and batch_was_full:
+            return self.pause
+        return Config.SLEEP_BATCH
+
+    def state(self):
+        """Estado atual (para logs/métricas)."""
+        return {
+            'mode': self.mode,
+            'batch_size': self.batch_size,
+            'pause': self.pause if self.adaptive else Config.SLEEP_PATIENT,
+            'latency_ms': self.latency_ms,
+            'active_requests': self.active_requests,
+            'load': self.load,
+        }
+
+    def summary(self):
+        lat = f"{self.latency_ms:.0f}ms" if self.latency_ms is not None else "-"
+        return f"Lote {self.batch_size} | Pausa {self.pause:.1f}s | Latência {lat} | Carga {self.load:.2f}"
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from datetime import datetime
+import pyodbc
+from src.config import Config
+from src.metrics import metrics
+
+class SqlTracer:
+    """
+    Rastreamento por template de SQL (SQL_TRACE).
+
+    Cada instrução é reduzida a um template (espaços normalizados, literais
+    numéricos e listas de '?' colapsadas) com um rótulo curto "VERBO tabela #hash".
+    Por template são registrados latência (histograma sql_seconds), execuções,
+    linhas, bytes de parâmetros e erros no registro de métricas. Instruções acima
+    de SQL_SLOW_MS vão para o slow log (JSON por linha), opcionalmente com o plano
+    de execução em XML lido do cache de planos por uma conexão separada.
+    """
+    # Limite de templates memorizados (SQL gerado dinamicamente não cresce sem fim)
+    MAX_TEMPLATES = 2000
+
+    _SPACES = re.compile(r"\s+")
+    _NUMBERS = re.compile(r"\b\d+\b")
+    _PLACEHOLDERS = re.compile(r"\?(\s*,\s*\?)+")
+    _TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|MERGE(?:\s+INTO)?|TABLE)\s+([#\w.\[\]]+)", re.IGNORECASE)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # { texto SQL: (rótulo, template) }
+        self.templates = {}
+        # Conexão de captura de planos por thread (conexões pyodbc não são compartilhadas)
+        self.plan_local = threading.local()
+
+    def label(self, sql):
+        """(rótulo, template normalizado) do SQL, memorizado por texto."""
+        cached = self.templates.get(sql)
+        if cached:
+            return cached
+        template = self._SPACES.sub(" ", sql).strip()
+        template = self._PLACEHOLDERS.sub("?, ...", self._NUMBERS.sub("N", template))
+        verb = template.split(" ", 1)[0].upper() if template else "SQL"
+        table = self._TABLE.search(template)
+        digest = hashlib.md5(template.encode("utf-8")).hexdigest()[:8]
+        entry = (f"{verb} {table.group(1) if table else '-'} #{digest}", template)
+        with self.lock:
+            if len(self.templates) >= self.MAX_TEMPLATES:
+                self.templates.clear()
+            self.templates[sql] = entry
+        return entry
+
+    @staticmethod
+    def param_bytes(params):
+        """Tamanho aproximado dos parâmetros (blobs/strings pelo tamanho, demais 8 bytes)."""
+        total = 0
+        for value in params or ():
+            if isinstance(value, (bytes, bytearray, memoryview, str)):
+                total += len(value)
+            elif value is not None:
+                total += 8
+        return total
+
+    def record(self, sql, seconds, rows=0, param_bytes=0, error=None):
+        label, template = self.label(sql)
+        metrics.observe('sql_seconds', seconds, template=label)
+        metrics.inc('sql_statements_total', template=label)
+        if rows > 0:
+            metrics.inc('sql_rows_total', rows, template=label)
+        if param_bytes:
+            metrics.inc('sql_param_bytes_total', param_bytes, template=label)
+        if error is not None:
+            metrics.inc('sql_errors_total', template=label)
+        if seconds * 1000 >= Config.SQL_SLOW_MS:
+            self.slow(sql, label, template, seconds, rows, param_bytes, error)
+
+    def add_rows(self, sql, rows):
+        """Linhas lidas por fetch* (SELECTs só sabem o total depois da leitura)."""
+        if rows > 0:
+            metrics.inc('sql_rows_total', rows, template=self.label(sql)[0])
+
+    def slow(self, sql, label, template, seconds, rows, param_bytes, error):
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'template': label,
+            'ms': round(seconds * 1000, 1),
+            'rows': rows,
+            'param_bytes': param_bytes,
+            'error': repr(error) if error is not None else None,
+            'sql': template,
+        }
+        if Config.SQL_CAPTURE_PLAN:
+            entry['plan'] = self.capture_plan(sql)
+        if not Config.SQL_SLOW_LOG:
+            print(f"   🐢 SQL lento ({entry['ms']:.0f}ms): {label}")
+            return
+        with self.lock:
+            with open(Config.SQL_SLOW_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def capture_plan(self, sql):
+        """
+        XML do plano em cache da instrução (sys.dm_exec_cached_plans), buscado por um
+        trecho do texto em uma conexão própria da thread (a do worker pode ter resultados
+        pendentes), já depois da instrução e sem segurar o lock do rastreador. No cache
+        os '?' aparecem como @P1, @P2...: viram curinga no LIKE. Exige VIEW SERVER STATE;
+        falhas retornam None.
+        """
+        snippet = sql.strip()[:200]
+        for char in "[%_":
+            snippet = snippet.replace(char, f"[{char}]")
+        snippet = snippet.replace("?", "%")
+        try:
+            conn = getattr(self.plan_local, 'conn', None)
+            if conn is None:
+                conn = pyodbc.connect(Config.DB_CONNECTION_STRING, autocommit=True, timeout=Config.DB_LOGIN_TIMEOUT)
+                conn.timeout = Config.DB_MONITOR_TIMEOUT
+                self.plan_local.conn = conn
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT TOP 1 CAST(qp.query_plan AS NVARCHAR(MAX))
+                FROM sys.dm_exec_cached_plans cp
+                CROSS APPLY sys.dm_exec_sql_text(cp.plan_handle) st
+                CROSS APPLY sys.dm_exec_query_plan(cp.plan_handle) qp
+                WHERE st.text LIKE ? AND st.text NOT LIKE '%dm_exec_cached_plans%'
+                ORDER BY cp.usecounts DESC
+            """, (f"%{snippet}%",))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            self.plan_local.conn = None
+            return f"(plano indisponível: {e})"
+
+
+# Rastreador único do processo
+tracer = SqlTracer()
+
+
+class TracingCursor:
+    """Cursor instrumentado: mede execute/executemany/commit e repassa o restante ao pyodbc."""
+    __slots__ = ('_cursor', '_last_sql')
+
+    def __init__(self, cursor):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_last_sql', None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        # Ex.: fast_executemany precisa chegar ao cursor real
+        setattr(self._cursor, name, value)
+
+    def _run(self, sql, method, args, param_bytes):
+        object.__setattr__(self, '_last_sql', sql)
+        started = time.perf_counter()
+        try:
+            method(*args)
+        except Exception as e:
+            tracer.record(sql, time.perf_counter() - started, param_bytes=param_bytes, error=e)
+            raise
+        rows = self._cursor.rowcount
+        tracer.record(sql, time.perf_counter() - started, rows=rows if rows and rows > 0 else 0,
+                      param_bytes=param_bytes)
+        return self
+
+    def execute(self, sql, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            flat = params[0]
+        else:
+            flat = params
+        return self._run(sql, self._cursor.execute, (sql,) + params, tracer.param_bytes(flat))
+
+    def executemany(self, sql, seq_of_params):
+        rows = seq_of_params if isinstance(seq_of_params, list) else list(seq_of_params)
+        return self._run(sql, self._cursor.executemany, (sql, rows), sum(tracer.param_bytes(r) for r in rows))
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None and self._last_sql:
+            tracer.add_rows(self._last_sql, 1)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if self._last_sql:
+            tracer.add_rows(self._last_sql, len(rows))
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        if self._last_sql:
+            tracer.add_rows(self._last_sql, len(rows))
+        return rows
+
+    def commit(self):
+        started = time.perf_counter()
+        self._cursor.commit()
+        tracer.record("COMMIT", time.perf_counter() - started)
+
+    def rollback(self):
+        started = time.perf_counter()
+        self._cursor.rollback()
+        tracer.record("ROLLBACK", time.perf_counter() - started)
+
+
+class TracingConnection:
+    """Conexão instrumentada: cursores rastreados e commit/rollback medidos."""
+    __slots__ = ('_conn',)
+
+    def __init__(self, conn):
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # Ex.: autocommit/timeout precisam chegar à conexão real
+        setattr(self._conn, name, value)
+
+    def cursor(self):
+        return TracingCursor(self._conn.cursor())
+
+    def commit(self):
+        started = time.perf_counter()
+        self._conn.commit()
+        tracer.record("COMMIT", time.perf_counter() - started)
+
+    def rollback(self):
+        started = time.perf_counter()
+        self._conn.rollback()
+        tracer.record("ROLLBACK", time.perf_counter() - started)
@@ -0,0 +1,100 @@
+from src.config import Config
+from src.repository import Repository
+
+class CommitScope:
+    """
+    Granularidade de commit do lote e isolamento por paciente.
+
+    Cada paciente roda dentro de um SAVEPOINT: se falhar, apenas ele é desfeito e
+    os demais continuam. O commit acontece a cada COMMIT_EVERY_PATIENTS pacientes
+    (0 = só no fim do lote) ou quando os bytes gravados desde o último commit
+    passam de COMMIT_EVERY_BYTES (0 = desativado).
+
+    before_commit(pacientes) roda dentro da transação (ex.: baixa na fila);
+    after_commit(pacientes) roda após o commit (ex.: contadores de progresso).
+    checkpoint() confirma no meio de um paciente grande e reabre o savepoint.
+    mark_pending() registra escrita fora dos pacientes (ex.: quarentena de uma
+    falha), que também precisa de commit mesmo sem paciente concluído.
+    """
+    SAVEPOINT = "sp_paciente"
+
+    def __init__(self, conn, cursor, before_commit=None, after_commit=None,
+                 every_patients=None, every_bytes=None):
+        self.conn = conn
+        self.cursor = cursor
+        self.before_commit = before_commit
+        self.after_commit = after_commit
+        self.every_patients = Config.COMMIT_EVERY_PATIENTS if every_patients is None else every_patients
+        self.every_bytes = Config.COMMIT_EVERY_BYTES if every_bytes is None else every_bytes
+        # Pacientes e bytes desde o último commit
+        self.pending = []
+        self.pending_bytes = 0
+        # Escrita pendente fora dos pacientes (ex.: registro de quarentena)
+        self.dirty = False
+
+    def begin_patient(self):
+        """Marca o início do paciente (savepoint)."""
+        Repository.savepoint(self.cursor, self.SAVEPOINT)
+
+    def rollback_patient(self):
+        """
+        Desfaz apenas o paciente atual. Se a transação estiver condenada
+        (XACT_STATE = -1) a falha sobe para o rollback completo do lote.
+        """
+        if Repository.transaction_state(self.cursor) == -1:
+            raise RuntimeError("Transação condenada; rollback do lote necessário.")
+        Repository.rollback_to_savepoint(self.cursor, self.SAVEPOINT)
+
+    def patient_done(self, cod_paciente, bytes_written=0):
+        """Registra o paciente concluído. Retorna True se houve commit agora."""
+        self.pending.append(cod_paciente)
+        self.pending_bytes += bytes_written
+        if self.every_patients and len(self.pending) >= self.every_patients:
+            return self.commit()
+        if self.every_bytes and self.pending_bytes >= self.every_bytes:
+            return self.commit()
+        return False
+
+    def mark_pending(self):
+        """Há escrita na transação além dos pacientes (o próximo commit não pode ser pulado)."""
+        self.dirty = True
+
+    def _commit_pending(self):
+        committed = self.pending
+        if self.before_commit and committed:
+            self.before_commit(committed)
+        self.conn.commit()
+        # Nenhuma transação pode sobrar aberta (locks retidos / rollback de pacientes já confirmados)
+        open_count = Repository.transaction_count(self.cursor)
+        if open_count:
+            raise RuntimeError(f"Transação ainda aberta após o commit (@@TRANCOUNT = {open_count}).")
+        self.pending = []
+        self.pending_bytes = 0
+        self.dirty = False
+        if self.after_commit and committed:
+            self.after_commit(committed)
+
+    def commit(self):
+        """Confirma os pacientes (e escritas) pendentes. Retorna True se havia algo a confirmar."""
+        if not self.pending and not self.dirty:
+            return False
+        self._commit_pending()
+        return True
+
+    def checkpoint(self):
+        """
+        Commit no meio do paciente atual (bloco já marcado no controle) junto com os
+        pacientes pendentes, e novo savepoint para o restante: uma falha posterior
+        desfaz apenas o bloco em andamento.
+        """
+        self._commit_pending()
+        self.begin_patient()
+
+    def rollback(self):
+        """Rollback completo do que ainda não foi confirmado."""
+        self.conn.rollback()
+        discarded = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.dirty = False
+        return discarded
@@ -0,0 +1,64 @@
+import time
+from src.config import Config
+from src.repository import Repository
+
+class WorkQueue:
+    """
+    Fila persistente de pacientes pendentes (tbl_fila_migracao_python).
+
+    Objetivo: Evitar o anti-join completo de tblmigracao x controle a cada ciclo.
+    Estratégia: A fila é materializada uma vez (build-queue) e lida com TOP n por
+    prioridade usando um keyset watermark. Novos itens da origem entram por
+    refresh incremental a cada QUEUE_REFRESH_SECONDS.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        # Último (datPrioridade, strCodigoPaciente) entregue; None = início da fila
+        self.watermark = None
+        # Watermark antes do último next_batch e chaves entregues nele (para o rewind parcial)
+        self.batch_start = None
+        self.delivered = []
+        self.last_refresh = 0.0
+        Repository.ensure_queue_table(cursor)
+
+    def refresh_if_due(self):
+        """Executa o refresh incremental se o intervalo configurado já passou."""
+        if time.time() - self.last_refresh < Config.QUEUE_REFRESH_SECONDS:
+            return 0
+        added = Repository.refresh_queue(self.cursor)
+        self.cursor.commit()
+        self.last_refresh = time.time()
+        if added:
+            print(f"📥 Fila atualizada: +{added} pacientes.")
+        return added
+
+    def next_batch(self, limit):
+        """Retorna os próximos pacientes da fila a partir do watermark."""
+        self.refresh_if_due()
+        self.batch_start = self.watermark
+        rows = Repository.dequeue_batch(self.cursor, limit, self.watermark, exclude_quarantined=Config.QUARANTINE)
+        if not rows and self.watermark is not None:
+            # Fim da varredura: recomeça do topo (pega pacientes que falharam/voltaram)
+            self.watermark = self.batch_start = None
+            rows = Repository.dequeue_batch(self.cursor, limit, exclude_quarantined=Config.QUARANTINE)
+        self.delivered = [(row.datPrioridade, row.strCodigoPaciente) for row in rows]
+        if rows:
+            self.watermark = self.delivered[-1]
+        return [row.strCodigoPaciente for row in rows]
+
+    def rewind(self, admitted):
+        """
+        Volta o watermark até o primeiro paciente do último lote que não foi admitido:
+        ele e os seguintes voltam a ser candidatos, sem reler a fila desde o topo.
+        """
+        admitted = {str(p) for p in admitted}
+        position = self.batch_start
+        for key in self.delivered:
+            if str(key[1]) not in admitted:
+                break
+            position = key
+        self.watermark = position
+
+    def complete(self, patient_ids):
+        """Remove da fila os pacientes processados (dentro da transação do lote)."""
+        Repository.complete_queue_items(self.cursor, patient_ids)
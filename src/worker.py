@@ -1,268 +1,628 @@
+import atexit
 import pyodbc
 import time
 import uuid
-from datetime import datetime
-from zoneinfo import ZoneInfo
 from src.config import Config
-from src.database import get_db_connection, IdGenerator
-from src.repository import Repository
+from src.database import ConnectionManager, is_connection_error, IdGenerator, BlockIdAllocator, ClientAtendimentoCache
+from src.repository import Repository, BulkWriter
+from src.work_queue import WorkQueue
+from src.key_map import KeyMap
+from src.stats import ProgressTracker
+from src.lease import LeaseManager
+from src.pipeline import PatientReader
+from src.throttle import Throttle
+from src.transaction import CommitScope
+from src.quarantine import Quarantine
+from src.streaming import BlobStreamer
+from src.dedupe import ContentDedupe
+from src.metrics import metrics
+from src.planner import PlanReplay, group_images
+from src.scheduler import WindowScheduler
+from src.batching import BatchComposer
+
+def migrate_patient(cursor, id_gen, writer, cod_paciente, rows=None, dedupe=None, plan=None, checkpoint=None):
+    """
+    Migra todas as imagens/PDFs pendentes de um paciente.
+    `rows` permite receber as linhas já carregadas pelo loader de lote.
+    `dedupe` (ContentDedupe) descarta payloads idênticos aos já gravados.
+    `plan` (PlanReplay) usa o agrupamento/IDs pré-calculados quando o plano está íntegro.
+    `checkpoint` (callable que faz commit) divide pacientes grandes em blocos nas
+    fronteiras de grupo (PATIENT_CHUNK_ITEMS / PATIENT_CHUNK_BYTES); o controle
+    marcado em cada bloco confirmado é o ponto de retomada após uma queda.
+    As linhas são enfileiradas no BulkWriter e descarregadas ao final do paciente.
+    Retorna um dicionário com os contadores do paciente (ou None se nada pendente).
+    """
+    target_pac_id = int(cod_paciente)
+
+    # Busca Imagens
+    # Nos modos servidor/streaming apenas metadados trafegam (blob_data = NULL)
+    if rows is None and plan:
+        with metrics.timer('fetch_images'):
+            rows = plan.fetch(cursor, [cod_paciente], include_blobs=Config.INLINE_BLOBS).get(cod_paciente)
+    if rows is None:
+        with metrics.timer('fetch_images'):
+            rows = Repository.fetch_patient_images(cursor, cod_paciente, include_blobs=Config.INLINE_BLOBS)
+
+    # Deduplicação
+    unique_imgs = {r.id_imagem_origem: r for r in rows}
+    valid_rows = list(unique_imgs.values())
+
+    if not valid_rows:
+        return None
+
+    # --- 3. Inserção Atômica por Paciente ---
+    Repository.toggle_identity(cursor, "tbllaudoimagem", "ON")
+
+    # Mapeamento de IDs enviado ao servidor no modo SERVER_SIDE_BLOBS
+    staged_rows = []
+    if Config.SERVER_SIDE_BLOBS:
+        Repository.prepare_blob_stage(cursor)
+
+    saved_imgs = 0
+    saved_pdfs = 0
+    skipped_empty = 0
+    skipped_pdfs = 0
+
+    clean_rows = []
+    for row in valid_rows:
+        if not row.blob_size or not row.data_raw:
+            writer.add('tbl_controle_migracao_python', (row.id_imagem_origem,))
+            skipped_empty += 1
+            if row.extensao.lower() == 'pdf':
+                skipped_pdfs += 1
+        else:
+            clean_rows.append(row)
+
+    # Deduplicação por conteúdo (mesmo payload com outro strCodigo)
+    duplicates = duplicate_pdfs = bytes_saved = 0
+    if dedupe:
+        clean_rows, duplicates, duplicate_pdfs, bytes_saved = dedupe.filter(cursor, writer, target_pac_id, clean_rows)
+
+    # Bytes de blobs que passam pelo worker (inline: tudo; streaming: só os não duplicados)
+    bytes_read = 0
+    if Config.INLINE_BLOBS:
+        bytes_read = sum(r.blob_size or 0 for r in valid_rows)
+    elif Config.STREAM_BLOBS and not Config.SERVER_SIDE_BLOBS:
+        bytes_read = sum(r.blob_size or 0 for r in clean_rows)
+
+    migrated_dates = [] # Changed to list to collect all dates for logging
+
+    # --- 2.2. Agrupamento Inteligente ---
+    # Chave de Agrupamento: (Código Procedimento, Data Dia)
+    grouped_images = group_images(clean_rows)
+
+    # Streaming: blobs lidos em blocos limitados logo antes da inserção, na ordem dos
+    # grupos (a mesma do laço abaixo), para que o teto de bytes valha de fato
+    streamer = None
+    if Config.STREAM_BLOBS and not Config.SERVER_SIDE_BLOBS:
+        streamer = BlobStreamer(cursor, [item for group in grouped_images.values() for item in group['items']])
+
+    def flush_chunk():
+        # Grava o que restou no buffer enquanto IDENTITY_INSERT ainda está ON
+        writer.flush()
+        if staged_rows:
+            # Blobs copiados de tblmigracao dentro do servidor (set-based)
+            Repository.stage_blob_map(cursor, staged_rows)
+            Repository.apply_blob_map(cursor)
+            staged_rows.clear()
+        Repository.toggle_identity(cursor, "tbllaudoimagem", "OFF")
+
+    # Blocos: commit na fronteira de grupo ao passar do limite de itens/bytes
+    chunked = checkpoint is not None and (Config.PATIENT_CHUNK_ITEMS > 0 or Config.PATIENT_CHUNK_BYTES > 0)
+    chunks = 1
+    chunk_items = chunk_bytes = 0
+
+    # --- 2.3. Migração dos Grupos ---
+    for group_number, group in enumerate(grouped_images.values(), start=1):
+        header_img = group['header']
+        items = group['items']
+
+        if chunked and chunk_items and (
+            (Config.PATIENT_CHUNK_ITEMS > 0 and chunk_items >= Config.PATIENT_CHUNK_ITEMS) or
+            (Config.PATIENT_CHUNK_BYTES > 0 and chunk_bytes >= Config.PATIENT_CHUNK_BYTES)
+        ):
+            # Confirma os grupos anteriores (e suas marcações no controle) antes de seguir
+            flush_chunk()
+            checkpoint()
+            print(f"   💾 Bloco {chunks} confirmado ({chunk_items} itens). Continuando do grupo {group_number}/{len(grouped_images)}...")
+            Repository.toggle_identity(cursor, "tbllaudoimagem", "ON")
+            if Config.SERVER_SIDE_BLOBS:
+                Repository.prepare_blob_stage(cursor)
+            chunks += 1
+            chunk_items = chunk_bytes = 0
+        chunk_items += len(items)
+        chunk_bytes += sum(i.blob_size or 0 for i in items)
+
+        # Skip if header data is missing
+        if not header_img.blob_size or not header_img.data_raw:
+            for item_img in items:
+                writer.add('tbl_controle_migracao_python', (item_img.id_imagem_origem,))
+            continue
+
+        # Gera IDs MESTRES (Para o grupo inteiro)
+        atend_id = id_gen.get_atendimento_id_by_client(target_pac_id)
+        # Replay do plano: fatura/laudo já reservados no planejamento (ID_ALLOCATION=block)
+        fatura_id = getattr(header_img, 'plan_fatura_id', None) or id_gen.next_global_fatura_id()
+        # REGRA: ID Laudo Cliente DEVE ser igual ao ID Fatura Atendimento
+        laudo_cli_id = fatura_id 
+
+        # LOG DETALHADO (Solicitado pelo Usuário)
+        data_fmt = header_img.data_raw.strftime('%d/%m/%Y')
+
+        count_imgs = sum(1 for i in items if i.extensao.lower() != 'pdf')
+        count_pdfs = len(items) - count_imgs
+
+        print(f"   ► Grupo: Proc {header_img.cod_proc} em {data_fmt} ({count_imgs} imgs | {count_pdfs} pdfs) -> AtendID: {atend_id} | FatID: {fatura_id}")
+
+        # Insert 1: Atendimento (Pai)
+        writer.add('tblatendimento', (atend_id, header_img.data_raw, 1, target_pac_id, 1, 61, header_img.data_raw, 'FECHADO', 'T', 2))
+
+        # Insert 2: Fatura (Filho)
+        writer.add('tblfaturaatendimento', (fatura_id, target_pac_id, atend_id, header_img.cod_proc, header_img.nome_proc, 1.0, 0.0, 1, 61, header_img.data_raw, 'FECHADO'))
+
+        # Insert 3: Laudo Cliente (Neto)
+        writer.add('tbllaudocliente', (
+            laudo_cli_id, target_pac_id, atend_id, fatura_id,
+            header_img.cod_proc, header_img.nome_proc,
+            'ASSINADO', 1, 61, 1,
+            header_img.data_raw, header_img.data_raw, None, None
+        ))
+
+        # Insert 4: Imagens ou PDFs (Bisnetos - Loop interno)
+        for info_img in items:
+            # Skip if content data is missing
+            if not info_img.blob_size or not info_img.data_raw:
+                writer.add('tbl_controle_migracao_python', (info_img.id_imagem_origem,))
+                continue
+
+            is_pdf = (info_img.extensao.lower() == 'pdf')
+
+            blob_data = info_img.blob_data
+            if streamer:
+                blob_data = streamer.take(info_img.id_imagem_origem)
+                if not blob_data:
+                    # Conteúdo sumiu/esvaziou entre as fases: trata como vazio
+                    writer.add('tbl_controle_migracao_python', (info_img.id_imagem_origem,))
+                    skipped_empty += 1
+                    if is_pdf:
+                        skipped_pdfs += 1
+                    continue
+
+            if Config.SERVER_SIDE_BLOBS:
+                # --- Modo Servidor: apenas o mapeamento de IDs ---
+                img_id = None
+                fn = None
+                if not is_pdf:
+                    img_id = getattr(info_img, 'plan_img_id', None) or id_gen.next_global_img_id()
+                    fn = f"{header_img.cod_proc}-{fatura_id}-{str(uuid.uuid4())[:4]}.{info_img.extensao}"
+                staged_rows.append((
+                    info_img.id_imagem_origem, is_pdf, img_id, fn,
+                    target_pac_id, atend_id, fatura_id, laudo_cli_id,
+                    header_img.cod_proc, header_img.nome_proc,
+                    header_img.data_raw, info_img.data_raw
+                ))
+            elif is_pdf:
+                # --- Inserção de PDF ---
+                writer.add('tbllaudopdfanexo', (
+                    target_pac_id, atend_id, laudo_cli_id,
+                    pyodbc.Binary(blob_data), 1, 61,
+                    info_img.data_raw, 1, 0,
+                    pyodbc.Binary(blob_data)
+                ))
+            else:
+                # --- Inserção de Imagem (Legado) ---
+                img_id = getattr(info_img, 'plan_img_id', None) or id_gen.next_global_img_id()
+                fn = f"{header_img.cod_proc}-{fatura_id}-{str(uuid.uuid4())[:4]}.{info_img.extensao}"
+
+                writer.add('tbllaudoimagem', (
+                    img_id, fn, target_pac_id, atend_id, fatura_id,
+                    header_img.cod_proc, header_img.nome_proc, 0, 'MIGRACAO', 
+                    pyodbc.Binary(blob_data), 61, 1, header_img.data_raw, 'N', laudo_cli_id
+                ))
+
+            # Marca cada item (img ou pdf) individualmente como migrado
+            # (no modo servidor a marcação é feita em apply_blob_map)
+            if not Config.SERVER_SIDE_BLOBS:
+                writer.add('tbl_controle_migracao_python', (info_img.id_imagem_origem,))
+            if is_pdf:
+                saved_pdfs += 1
+            else:
+                saved_imgs += 1
+
+            # Coleta data para log
+            if info_img.data_raw:
+                migrated_dates.append(info_img.data_raw.strftime('%m/%Y'))
+
+    flush_chunk()
+
+    return {
+        'saved_imgs': saved_imgs,
+        'saved_pdfs': saved_pdfs,
+        'skipped_empty': skipped_empty,
+        'skipped_pdfs': skipped_pdfs,
+        'duplicates': duplicates,
+        'duplicate_pdfs': duplicate_pdfs,
+        'bytes_saved': bytes_saved,
+        'bytes_read': bytes_read,
+        'chunks': chunks,
+        'dates': sorted(set(migrated_dates)),
+    }
+
+def _sleep(seconds):
+    """time.sleep contabilizado na fase 'sleep' das métricas."""
+    if seconds <= 0:
+        return
+    with metrics.timer('sleep'):
+        time.sleep(seconds)
 
 def run_worker():
     print(f"{'='*80}")
     print(f"🚀 INICIANDO V3.0 - WORKER DE MIGRAÇÃO PROFISSIONAL")
     print(f"📦 Batch Size: {Config.BATCH_SIZE} | 🕒 Sleep Batch: {Config.SLEEP_BATCH}s")
-    print(f"⏰ Horário de Funcionamento: ")
-    if Config.CHECK_OPERATING_HOURS:
-        print(f"   - Fim de Semana: Sex 18h até Seg 05h (Sem Parar)")
-        print(f"   - Dias Úteis:    Noite (18h às 05h)")
+    if Config.ID_ALLOCATION == 'block':
+        print(f"🔢 IDs por blocos de {Config.ID_BLOCK_SIZE} (tbl_chave_migracao_python)")
+    if Config.MULTI_WORKER:
+        print(f"👥 Multi-worker: leases de {Config.LEASE_SECONDS:.0f}s por paciente (Worker: {Config.WORKER_ID or 'auto'})")
+    if Config.THROTTLE_MODE == 'adaptive':
+        print(f"🎚️  Throttle adaptativo: alvo {Config.THROTTLE_TARGET_LATENCY_MS:.0f}ms por commit/SELECT 1 (lote até {Config.THROTTLE_MAX_BATCH_SIZE})")
+    if Config.DEDUPE_CONTENT:
+        print("♻️  Dedupe por conteúdo (SHA-256) ativado")
+    if Config.STREAM_BLOBS:
+        print(f"🌊 Streaming de blobs: blocos de até {Config.STREAM_MAX_BYTES // (1024 * 1024)} MB")
+    if Config.PIPELINE:
+        print(f"🔀 Pipeline leitura/escrita: até {Config.PIPELINE_MAX_BYTES // (1024 * 1024)} MB em trânsito")
+    if Config.USE_WORK_QUEUE:
+        print(f"📋 Fila persistente: tbl_fila_migracao_python (refresh a cada {Config.QUEUE_REFRESH_SECONDS:.0f}s)")
+    if Config.USE_PLAN:
+        print("🗺️  Replay do plano pré-calculado (tbl_plano_migracao_python) com verificação da origem")
+    if Config.SERVER_SIDE_BLOBS:
+        print("🗄️  Modo Servidor: blobs copiados via INSERT ... SELECT (sem tráfego pelo worker)")
+    # Janela de funcionamento: calendário exato + admissão pelo custo estimado
+    scheduler = WindowScheduler()
+
+    # Lotes por orçamento de bytes/itens (BATCH_SIZE deixa de ser o limite principal)
+    composer = BatchComposer()
+    if composer.enabled:
+        print(f"⚖️  Lotes por orçamento: {Config.BATCH_MAX_BYTES // (1024 * 1024)} MB | {Config.BATCH_MAX_ITEMS or '∞'} itens | até {composer.max_patients} pacientes")
+    print(f"⏰ Horário de Funcionamento ({Config.OPERATING_TIMEZONE}): ")
+    if scheduler.enabled:
+        for line in scheduler.window.describe():
+            print(f"   - {line}")
+        print(f"   - Só inicia pacientes que terminam {Config.WINDOW_SAFETY_SECONDS:.0f}s antes do fechamento (maiores primeiro)")
     else:
         print(f"   - 🟢 RESTRIÇÃO DE HORÁRIO DESATIVADA (Operando 24/7)")
+    if Config.METRICS_PORT:
+        print(f"📈 Métricas: http://0.0.0.0:{Config.METRICS_PORT}/metrics")
     print(f"{'='*80}\n")
-    
-    conn = get_db_connection()
+
+    metrics.start_http()
+
+    # Conexões por papel (escrita do lote, leitura do pipeline, monitoramento) com reconexão
+    db = ConnectionManager()
+    atexit.register(db.close_all) # Fecha write/read/monitor ao encerrar
+    conn = db.get('write')
     cursor = conn.cursor()
+    # Mapa de chaves img_rcl (python main.py prepare): usado automaticamente se existir
+    key_map = KeyMap(cursor) if Repository.has_key_map(cursor) else None
+    if key_map:
+        print(f"🔑 Mapa de chaves img_rcl ativo (refresh a cada {Config.KEY_MAP_REFRESH_SECONDS:.0f}s)")
+    work_queue = WorkQueue(cursor) if Config.USE_WORK_QUEUE else None
+
+    def attach(new_cursor):
+        """Religa os componentes que guardam o cursor de escrita."""
+        for component in (work_queue, key_map):
+            if component:
+                component.cursor = new_cursor
+
+    def bind(new_conn):
+        """Troca a conexão de escrita e religa os componentes que guardam o cursor."""
+        new_cursor = new_conn.cursor()
+        attach(new_cursor)
+        return new_conn, new_cursor
+    progress = ProgressTracker()
+    lease = LeaseManager(cursor) if Config.MULTI_WORKER else None
+
+    # Alocador por blocos persiste entre lotes; sobras são devolvidas ao encerrar
+    allocator = None
+    if Config.ID_ALLOCATION == 'block':
+        allocator = BlockIdAllocator()
+        atexit.register(allocator.release)
+
+    # MAX(intAtendimentoId) por cliente, reaproveitado entre lotes
+    client_cache = ClientAtendimentoCache()
+
+    # Plano offline (python main.py plan): agrupamento/IDs calculados fora da janela
+    plan = PlanReplay(cursor) if Config.USE_PLAN else None
+
+    # Pipeline: leitura do próximo paciente em outra thread/conexão
+    reader = PatientReader(plan=plan, db=db) if Config.PIPELINE else None
+
+    # Ritmo: tamanho de lote e pausas (fixos ou adaptativos à carga do banco)
+    throttle = Throttle()
+
+    # Quarentena: pacientes que falham saem da seleção com backoff exponencial
+    quarantine = Quarantine(cursor) if Config.QUARANTINE else None
+
+    # Dedupe por hash de conteúdo (índice persistente por paciente/procedimento)
+    dedupe = ContentDedupe(cursor) if Config.DEDUPE_CONTENT else None
 
     total_session_migrated = 0
     batch_count = 0
+    # Falhas de conexão seguidas na busca do lote (backoff entre reconexões)
+    fetch_failures = 0
 
     while True:
-        # --- 0. Checagem de Horário (Brasília) ---
-        if Config.CHECK_OPERATING_HOURS:
-            br_tz = ZoneInfo('America/Sao_Paulo')
-            now = datetime.now(br_tz)
-            weekday = now.weekday() # 0=Seg, 4=Sex, 5=Sab, 6=Dom
-            hour = now.hour
-
-            is_operating = False
-            status_msg = ""
-
-            # Lógica de Fim de Semana (Sexta 18h -> Segunda 05h)
-            if weekday == 4 and hour >= 18:
-                is_operating = True # Sexta a noite
-            elif weekday == 5 or weekday == 6:
-                is_operating = True # Sábado e Domingo inteiros
-            elif weekday == 0 and hour < 5:
-                is_operating = True # Segunda madrugada
-            
-            # Lógica de Dias Úteis (Terça, Quarta, Quinta, Sexta-Madrugada, Segunda-Noite)
-            else:
-                # Funciona das 18h até as 05h
-                if hour >= 18 or hour < 5:
-                    is_operating = True
-            
+        # --- 0. Janela de Funcionamento ---
+        if scheduler.enabled:
+            is_operating = scheduler.is_open()
+            metrics.set_gauge('operating_hours', 1 if is_operating else 0)
             if not is_operating:
-                print(f"💤 Fora do horário ({now.strftime('%A %H:%M')} - Brasília). Aguardando turno da noite (18h)...")
-                time.sleep(300) 
+                wait = scheduler.seconds_until_open()
+                print(f"💤 Fora do horário. Próxima janela em {scheduler.window.opens_at():%d/%m %H:%M} ({wait / 60:.0f} min)...")
+                metrics.write_textfile()
+                _sleep(wait + 1) # Acorda logo após a fronteira exata
                 continue
+            metrics.set_gauge('window_seconds_left', scheduler.seconds_left())
 
         start_time = time.time()
+
+        # Conexão de escrita testada após ociosidade (pausas longas, janela fechada)
+        current = db.get('write')
+        if current is not conn:
+            conn, cursor = bind(current)
         
         # --- 1. Monitoramento ---
+        # Contadores incrementais (re-sincronizados apenas a cada STATS_REFRESH_SECONDS)
         try:
-            stats = Repository.get_stats(cursor)
-            print(f"📊 STATUS: Migrados [{stats['migrated_imgs']} Imgs | {stats['migrated_pdfs']} PDFs] | Pendentes [{stats['pending_imgs']} Imgs | {stats['pending_pdfs']} PDFs]")
+            progress.refresh_if_due(db.cursor('monitor'))
+            print(f"📊 STATUS: {progress.summary()}")
         except Exception as e:
             print(f"⚠️  Erro ao buscar stats: {e}")
+            if is_connection_error(e):
+                db.discard('monitor')
 
         # --- 1. Busca Lote ---
         try:
-            pacientes = Repository.fetch_batch(cursor)
+            # Seleção do lote (anti-join/fila) com limite próprio por instrução, em cursor da fase
+            with db.phase('write', Config.DB_FETCH_TIMEOUT) as fetch_cursor:
+                attach(fetch_cursor)
+                try:
+                    # Com leases buscamos candidatos extras, pois outros workers podem ter assumido alguns
+                    batch_size = throttle.batch_size
+                    # Com orçamento de bytes, o nº de pacientes é apenas um teto secundário
+                    patient_limit = composer.max_patients if composer.enabled else batch_size
+                    fetch_limit = patient_limit * Config.LEASE_OVERFETCH if lease else patient_limit
+                    # Admissão pela janela: candidatos extras para escolher os maiores que ainda cabem
+                    candidate_limit = fetch_limit * Config.WINDOW_OVERFETCH if scheduler.enabled else fetch_limit
+                    if key_map:
+                        key_map.refresh_if_due() # Antes da fila: linhas novas precisam estar no mapa
+                    with metrics.timer('fetch_batch'):
+                        if work_queue:
+                            pacientes = work_queue.next_batch(candidate_limit)
+                        else:
+                            pacientes = Repository.fetch_batch(fetch_cursor, limit=candidate_limit, exclude_leased=lease is not None,
+                                                               exclude_quarantined=quarantine is not None)
+                        costs = Repository.fetch_patient_costs(fetch_cursor, pacientes) if scheduler.enabled or composer.enabled else {}
+                    candidates = pacientes
+                    if scheduler.enabled and pacientes:
+                        pacientes = scheduler.admit(candidates, costs, fetch_limit, throttle.patient_pause())
+                        if not pacientes:
+                            wait = max(scheduler.seconds_left(), 0)
+                            print(f"⏳ Nenhum dos {len(candidates)} pacientes candidatos termina antes do fim da janela. Aguardando {wait / 60:.0f} min...")
+                            if work_queue:
+                                work_queue.rewind([]) # Os grandes abrem a próxima janela
+                            conn.commit()
+                            metrics.write_textfile()
+                            _sleep(wait + 1)
+                            continue
+                    if composer.enabled and pacientes:
+                        # O throttle adaptativo escala o orçamento (lote maior/menor conforme a carga)
+                        pacientes = composer.compose(pacientes, costs, throttle.budget_scale())
+                    if work_queue and len(pacientes) < len(candidates):
+                        work_queue.rewind(pacientes) # Não admitidos continuam na fila
+                    if lease:
+                        pacientes = lease.claim(fetch_cursor, pacientes, patient_limit)
+                finally:
+                    attach(cursor)
+            fetch_failures = 0
         except Exception as e:
-            print(f"⚠️  Erro de Conexão. Reconectando em 10s... ({e})")
-            time.sleep(10)
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                continue
-            except:
-                time.sleep(30)
-                continue
+            if is_connection_error(e) or not db.is_alive(conn):
+                # Backoff também entre reconexões bem-sucedidas que voltam a falhar na busca
+                fetch_failures += 1
+                delay = db.backoff_delay(fetch_failures)
+                print(f"⚠️  Erro de Conexão ao buscar o lote. Reconectando em {delay:.1f}s... ({e})")
+                time.sleep(delay)
+                conn, cursor = bind(db.reconnect('write'))
+            else:
+                print(f"⚠️  Erro ao buscar o lote: {e}. Nova tentativa em 10s...")
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                time.sleep(10)
+            continue
 
         if not pacientes:
             print(f"💤 Fila vazia. Aguardando {Config.SLEEP_BATCH}s... (Total Sessão: {total_session_migrated})")
-            time.sleep(Config.SLEEP_BATCH)
+            metrics.write_textfile()
+            _sleep(Config.SLEEP_BATCH)
             continue
 
         # --- 2. Processamento ---
-        id_gen = IdGenerator(cursor)
+        id_gen = IdGenerator(cursor, allocator, client_cache)
+        # No streaming o buffer do writer também respeita o teto de memória
+        writer = BulkWriter(cursor, flush_bytes=min(Config.WRITER_FLUSH_BYTES, Config.STREAM_MAX_BYTES) if Config.STREAM_BLOBS else None)
         batch_count += 1
-        print(f"📦 LOTE #{batch_count} | Pacientes: {len(pacientes)} | Processando...")
-        
+        metrics.inc('batches_total')
+        budget_str = f" | {composer.summary()}" if composer.enabled else ""
+        print(f"📦 LOTE #{batch_count} | Pacientes: {len(pacientes)}{budget_str} | Processando...")
+        patient_rows = None
+        current_patient = None
+
+        def before_commit(committed):
+            if work_queue:
+                work_queue.complete(committed)
+            if quarantine:
+                quarantine.clear(cursor, committed)
+            if plan:
+                plan.complete(cursor, committed)
+
+        def after_commit(committed):
+            nonlocal current_patient
+            # Já confirmado: uma falha daqui em diante não pode levá-lo à quarentena
+            if current_patient in committed:
+                current_patient = None
+            progress.commit()
+            if lease:
+                # Fora da transação do lote (monitor em autocommit): outros workers veem na hora
+                try:
+                    lease.release(db.cursor('monitor'), committed)
+                except Exception:
+                    pass # Lease expira sozinho após LEASE_SECONDS
+
+        # Commit por paciente / a cada N pacientes / por bytes, com savepoint por paciente
+        scope = CommitScope(conn, cursor, before_commit=before_commit, after_commit=after_commit)
+
+        def checkpoint():
+            # Paciente grande: commit no meio do paciente, na fronteira de grupo
+            scope.checkpoint()
+            metrics.inc('patient_chunks_total')
+
         try:
-            for cod_paciente in pacientes:
-                target_pac_id = int(cod_paciente)
-                print(f"🔄 Processando Paciente {target_pac_id}...")
-                
-                # Busca Imagens
-                rows = Repository.fetch_patient_images(cursor, cod_paciente)
-                
-                # Deduplicação
-                unique_imgs = {r.id_imagem_origem: r for r in rows}
-                valid_rows = list(unique_imgs.values())
-
-                if not valid_rows:
+            # Uma única consulta para os atendimentos de todos os pacientes do lote
+            id_gen.prefetch_atendimento_maxima(pacientes)
+
+            if reader:
+                # Pipeline: o paciente N+1 é lido enquanto o N é inserido
+                patient_rows = reader.iterate(pacientes)
+            else:
+                # Loader de lote: uma consulta para as imagens de todos os pacientes
+                batch_rows = {}
+                if Config.BATCH_LOADER:
+                    with metrics.timer('fetch_images'):
+                        if plan:
+                            batch_rows = plan.fetch(cursor, pacientes, include_blobs=Config.INLINE_BLOBS)
+                        unplanned = [p for p in pacientes if p not in batch_rows]
+                        batch_rows.update(Repository.fetch_batch_images(cursor, unplanned, include_blobs=Config.INLINE_BLOBS))
+                patient_rows = ((p, batch_rows.pop(p, None)) for p in pacientes)
+
+            for cod_paciente, rows in patient_rows:
+                cost = costs.get(str(cod_paciente))
+                if not scheduler.can_start(cost):
+                    print(f"⏳ Paciente {cod_paciente} (~{scheduler.estimate(cost):.0f}s) não termina antes do fim da janela. Encerrando o lote.")
+                    patient_rows.close()
+                    break
+                if lease and not lease.renew(db.cursor('monitor'), cod_paciente):
+                    print(f"   🔒 Paciente {cod_paciente}: lease expirado e assumido por outro worker. Pulando.")
                     continue
+                print(f"🔄 Processando Paciente {int(cod_paciente)}...")
 
-                # --- 3. Inserção Atômica por Paciente ---
-                Repository.toggle_identity(cursor, "tbllaudoimagem", "ON")
-                
-                saved_count = 0
-                saved_imgs = 0
-                saved_pdfs = 0
-                skipped_empty = 0
-                
-                clean_rows = []
-                for row in valid_rows:
-                    if not row.blob_data or not row.data_raw:
-                        Repository.mark_as_migrated(cursor, row.id_imagem_origem)
-                        skipped_empty += 1
-                    else:
-                        clean_rows.append(row)
-
-                migrated_dates = [] # Changed to list to collect all dates for logging
-                
-                # --- 2.2. Agrupamento Inteligente ---
-                # Chave de Agrupamento: (Código Procedimento, Data Dia)
-                # Objetivo: Unificar múltiplas imagens do mesmo exame/dia em um único Atendimento
-                grouped_images = {}
-                
-                for img in clean_rows:
-                    # img = (id_origem, blob, ext, data_full, cod_proc, nome_proc, cod_pac)
-                    # Extrai apenas a DATA (Ignora Hora) para agrupar
-                    data_dia = img.data_raw.date() if img.data_raw else datetime.min.date()
-                    key = (img.cod_proc, data_dia)
-                    
-                    if key not in grouped_images:
-                        grouped_images[key] = {
-                            'header': img, # Usa os dados da primeira imagem como cabeçalho
-                            'items': []
-                        }
-                    grouped_images[key]['items'].append(img)
-
-                # --- 2.3. Migração dos Grupos ---
-                for key, group in grouped_images.items():
-                    header_img = group['header']
-                    items = group['items']
-                    
-                    # Skip if header data is missing
-                    if not header_img.blob_data or not header_img.data_raw:
-                        for item_img in items:
-                            Repository.mark_as_migrated(cursor, item_img.id_imagem_origem)
-                        continue
-
-                    # Gera IDs MESTRES (Para o grupo inteiro)
-                    atend_id = id_gen.get_atendimento_id_by_client(target_pac_id)
-                    fatura_id = id_gen.next_global_fatura_id()
-                    # REGRA: ID Laudo Cliente DEVE ser igual ao ID Fatura Atendimento
-                    laudo_cli_id = fatura_id 
-                    
-                    # LOG DETALHADO (Solicitado pelo Usuário)
-                    data_fmt = header_img.data_raw.strftime('%d/%m/%Y')
-                    
-                    count_imgs = sum(1 for i in items if i.extensao.lower() != 'pdf')
-                    count_pdfs = len(items) - count_imgs
-                    
-                    print(f"   ► Grupo: Proc {header_img.cod_proc} em {data_fmt} ({count_imgs} imgs | {count_pdfs} pdfs) -> AtendID: {atend_id} | FatID: {fatura_id}")
-
-                    # Insert 1: Atendimento (Pai)
-                    cursor.execute("""
-                        INSERT INTO tblatendimento (
-                            intAtendimentoId, datAtende, intProfissionalId, intClienteId, 
-                            intEmpresaId, intUsuarioId, datAtendimento, strStatus, bolCheck, intTipoAtendimentoId
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (atend_id, header_img.data_raw, 1, target_pac_id, 1, 61, header_img.data_raw, 'FECHADO', 'T', 2))
-
-                    # Insert 2: Fatura (Filho)
-                    cursor.execute("""
-                        INSERT INTO tblfaturaatendimento (
-                            intFaturaAtendimentoId, intClienteId, intAtendimentoId, 
-                            strProcedimento, strDescrProcedimento, numQuantidade, numValor, 
-                            intEmpresaId, intUsuarioId, datFaturaAtendimento, strStatusFat
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (fatura_id, target_pac_id, atend_id, header_img.cod_proc, header_img.nome_proc, 1.0, 0.0, 1, 61, header_img.data_raw, 'FECHADO'))
-
-                    # Insert 3: Laudo Cliente (Neto)
-                    cursor.execute("""
-                        INSERT INTO tbllaudocliente (
-                           intLaudoClienteId, intClienteId, intAtendimentoId, intFaturaAtendimentoId,
-                           strCodigoProcedimento, strDescrProcedimento, 
-                           strStatus, intMedicoId, intUsuarioId, intEmpresaId,
-                           datLaudoCliente, datLiberacao, bolCheck, bolConcluido
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        laudo_cli_id, target_pac_id, atend_id, fatura_id,
-                        header_img.cod_proc, header_img.nome_proc,
-                        'ASSINADO', 1, 61, 1,
-                        header_img.data_raw, header_img.data_raw, None, None
-                    ))
-
-                    # Insert 4: Imagens ou PDFs (Bisnetos - Loop interno)
-                    for info_img in items:
-                        # Skip if content data is missing
-                        if not info_img.blob_data or not info_img.data_raw:
-                            Repository.mark_as_migrated(cursor, info_img.id_imagem_origem)
-                            continue
+                patient_started = time.perf_counter()
+                current_patient = cod_paciente
+                scope.begin_patient()
+                bytes_before = writer.bytes_written
+                try:
+                    with metrics.timer('patient'):
+                        result = migrate_patient(cursor, id_gen, writer, cod_paciente, rows, dedupe, plan, checkpoint)
+                except Exception as e:
+                    metrics.inc('patient_failures_total')
+                    # Desfaz só este paciente; os anteriores do lote seguem válidos
+                    print(f"   ❌ Paciente {cod_paciente}: {e}. Revertendo apenas este paciente.")
+                    scope.rollback_patient()
+                    writer.discard()
+                    client_cache.invalidate(int(cod_paciente))
+                    Repository.toggle_identity(cursor, "tbllaudoimagem", "OFF")
+                    if quarantine:
+                        quarantine.record(cursor, cod_paciente, e)
+                        # Mesmo que todos falhem, o commit do lote precisa soltar o lock do MERGE
+                        scope.mark_pending()
+                    current_patient = None
+                    continue
 
-                        is_pdf = (info_img.extensao.lower() == 'pdf')
-
-                        if is_pdf:
-                            # --- Inserção de PDF ---
-                            cursor.execute("""
-                                INSERT INTO tbllaudopdfanexo (
-                                    intClienteId, intAtendimentoId, intLaudoClienteId, 
-                                    strLaudoPDFAnexo, bolLiberado, intUsuarioId, 
-                                    datLaudoPDFAnexo, intEmpresaId, bolImportado, 
-                                    strLaudoPDFAnexoSemTimbre
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, (
-                                target_pac_id, atend_id, laudo_cli_id,
-                                pyodbc.Binary(info_img.blob_data), 1, 61,
-                                info_img.data_raw, 1, 0,
-                                pyodbc.Binary(info_img.blob_data)
-                            ))
-                        else:
-                            # --- Inserção de Imagem (Legado) ---
-                            img_id = id_gen.next_global_img_id()
-                            fn = f"{header_img.cod_proc}-{fatura_id}-{str(uuid.uuid4())[:4]}.{info_img.extensao}"
-                            
-                            cursor.execute("""
-                                INSERT INTO tbllaudoimagem (
-                                    intLaudoImagemId, strLaudoImagem, intClienteId, intAtendimentoId, intFaturaAtendimentoId, 
-                                    strCodigoProcedimento, strDescrProcedimento, intOrdem, strTerminal, 
-                                    imgImagem, intUsuarioId, intEmpresaId, datLaudoImagem, bolImpressao, intLaudoClienteId
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, (
-                                img_id, fn, target_pac_id, atend_id, fatura_id,
-                                header_img.cod_proc, header_img.nome_proc, 0, 'MIGRACAO', 
-                                pyodbc.Binary(info_img.blob_data), 61, 1, header_img.data_raw, 'N', laudo_cli_id
-                            ))
-
-                        # Marca cada item (img ou pdf) individualmente como migrado
-                        Repository.mark_as_migrated(cursor, info_img.id_imagem_origem)
-                        saved_count += 1
-                        if is_pdf:
-                            saved_pdfs += 1
-                        else:
-                            saved_imgs += 1
-                        
-                        # Coleta data para log
-                        if info_img.data_raw:
-                            migrated_dates.append(info_img.data_raw.strftime('%m/%Y'))
-                
-                Repository.toggle_identity(cursor, "tbllaudoimagem", "OFF")
-                
-                dates_str = ", ".join(sorted(list(set(migrated_dates)))) # Use set for unique dates in log
-                print(f"   ✅ Paciente {cod_paciente}: {saved_imgs} imgs | {saved_pdfs} pdfs | ⚠️ {skipped_empty} vazios. [Ref: {dates_str}]")
-                total_session_migrated += saved_count
-                time.sleep(Config.SLEEP_PATIENT)
-
-            conn.commit()
+                if result is not None:
+                    dates_str = ", ".join(result['dates'])
+                    dedupe_str = ""
+                    if dedupe:
+                        dedupe_str = f" | ♻️ {result['duplicates']} duplicados ({result['bytes_saved'] / (1024 * 1024):.1f} MB economizados)"
+                    chunks_str = f" | 💾 {result['chunks']} blocos" if result['chunks'] > 1 else ""
+                    print(f"   ✅ Paciente {cod_paciente}: {result['saved_imgs']} imgs | {result['saved_pdfs']} pdfs | ⚠️ {result['skipped_empty']} vazios{dedupe_str}{chunks_str}. [Ref: {dates_str}]")
+                    total_session_migrated += result['saved_imgs'] + result['saved_pdfs']
+                    progress.record_patient(result)
+                    metrics.record_patient(result, writer.bytes_written - bytes_before)
+
+                for seconds in writer.take_latencies():
+                    # Só métrica: o tempo do flush cresce com o payload e não mede a carga do banco
+                    metrics.observe('phase_seconds', seconds, phase='insert')
+                commit_started = time.perf_counter()
+                committed = scope.patient_done(cod_paciente, writer.bytes_written - bytes_before)
+                current_patient = None
+                if committed:
+                    commit_seconds = time.perf_counter() - commit_started
+                    throttle.observe(commit_seconds)
+                    metrics.observe('phase_seconds', commit_seconds, phase='commit')
+                scheduler.record(cost, time.perf_counter() - patient_started)
+                throttle.adjust(db.cursor('monitor') if throttle.adaptive else None)
+                metrics.set_throttle_state(throttle.state())
+                # Pausa apenas fora de transação (logo após um commit)
+                if committed:
+                    _sleep(throttle.patient_pause())
+
+            commit_started = time.perf_counter()
+            if scope.commit():
+                commit_seconds = time.perf_counter() - commit_started
+                throttle.observe(commit_seconds)
+                metrics.observe('phase_seconds', commit_seconds, phase='commit')
+            if lease:
+                lease.release(cursor, pacientes) # Restantes (falhas/pulados); os confirmados já foram liberados
+            throttle.adjust(db.cursor('monitor') if throttle.adaptive else None)
+            metrics.set_throttle_state(throttle.state())
+            metrics.observe('phase_seconds', time.time() - start_time, phase='batch')
+            metrics.write_textfile()
             elapsed = time.time() - start_time
-            print(f"   ⏱️  Lote em {elapsed:.2f}s. Pausa de {Config.SLEEP_BATCH}s...")
-            time.sleep(Config.SLEEP_BATCH)
+            batch_full = composer.full if composer.enabled else len(pacientes) >= batch_size
+            batch_pause = throttle.batch_pause(batch_full)
+            print(f"   ⏱️  Lote em {elapsed:.2f}s. Pausa de {batch_pause:.1f}s...")
+            if throttle.adaptive:
+                print(f"   🎚️  Throttle: {throttle.summary()}")
+            if scheduler.enabled:
+                print(f"   ⏰ Janela: {scheduler.seconds_left() / 60:.0f} min restantes | {scheduler.summary()}")
+            _sleep(batch_pause)
 
         except Exception as e:
-            conn.rollback()
+            # Timeout com a conexão viva segue o caminho normal (quarentena do paciente)
+            lost = False
+            try:
+                scope.rollback()
+            except Exception:
+                lost = True # Conexão perdida: o servidor desfaz a transação aberta
+            writer.discard()
+            if patient_rows is not None:
+                patient_rows.close() # Encerra a thread leitora do pipeline
+            progress.rollback()
+            client_cache.invalidate()
+            if lease:
+                try:
+                    lease.release(cursor, pacientes)
+                except Exception:
+                    pass # Lease expira sozinho após LEASE_SECONDS
             print(f"\n❌ ERRO NO LOTE: {e}")
+            if lost or not db.is_alive(conn):
+                # Falha de rede/servidor não é culpa do paciente: sem quarentena, só reconecta
+                print("🔌 Conexão de escrita perdida. Reconectando...")
+                conn, cursor = bind(db.reconnect('write'))
+                time.sleep(5)
+                continue
             Repository.toggle_identity(cursor, "tbllaudoimagem", "OFF")
+            if quarantine and current_patient is not None:
+                try:
+                    quarantine.record(cursor, current_patient, e)
+                    scope.mark_pending()
+                    scope.commit()
+                except Exception:
+                    # Conexão possivelmente perdida; o paciente será tentado de novo.
+                    # Sem commit, o rollback solta o lock do MERGE antes da pausa.
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
             time.sleep(5)
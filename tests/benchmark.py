@@ -0,0 +1,412 @@
+"""
+Benchmark do worker com dados sintéticos, sem SQL Server.
+
+Gera tblmigracao / img_rcl / procedimentos sintéticos (distribuições log-normais
+de tamanho de blob e de itens por grupo) em um banco falso em memória, que
+substitui as consultas do Repository e responde às escritas do BulkWriter.
+Roda o loop real de run_worker (pausas zeradas, sem checagem de horário) para
+cada tamanho de lote e reporta pacientes/s, imagens/s, MB/s e pico de memória.
+
+Uso:
+    python -m tests.benchmark --patients 300 --batch-sizes 1,10,50
+    python -m tests.benchmark --json atual.json --baseline base.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta
+from unittest import mock
+
+from src.config import Config
+from src.repository import Repository
+from src import database, worker, pipeline
+
+# Mesmas colunas de Repository._PATIENT_IMAGES_SQL
+ImageRow = namedtuple('ImageRow', 'id_imagem_origem blob_data blob_size content_hash extensao data_raw cod_proc nome_proc cod_origem')
+SourceItem = namedtuple('SourceItem', 'code size extensao data_raw cod_proc')
+
+MAX_BLOB_BYTES = 16 * 1024 * 1024
+IMAGE_EXTENSIONS = ('jpg', 'jpg', 'jpg', 'jpeg', 'png', 'bmp')
+
+
+class BenchmarkFinished(BaseException):
+    """Fila esgotada: encerra run_worker (BaseException passa pelos except Exception do loop)."""
+
+
+class SyntheticDatabase:
+    """Dados de origem sintéticos + estado de destino/controle em memória."""
+
+    def __init__(self, patients, seed=42, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.Lock()
+        rnd = random.Random(seed)
+        # Um único payload aleatório; cada blob é uma fatia (cópia) dele
+        self.payload = rnd.randbytes(MAX_BLOB_BYTES)
+        self.procs = {str(1000 + i): f"PROCEDIMENTO SINTETICO {i}" for i in range(200)}
+        self.items = {}
+        self.total_bytes = 0
+        now = datetime(2024, 1, 1)
+        code = 1
+        for p in range(patients):
+            patient_id = str(100000 + p)
+            rows = []
+            # Grupos (procedimento, dia) por paciente e itens por grupo: cauda longa
+            for _ in range(1 + int(rnd.expovariate(0.6))):
+                day = now - timedelta(days=rnd.randint(0, 5 * 365))
+                cod_proc = rnd.choice(list(self.procs))
+                for _ in range(max(1, int(rnd.lognormvariate(1.0, 0.8)))):
+                    is_pdf = rnd.random() < 0.15
+                    median = 500 * 1024 if is_pdf else 200 * 1024
+                    size = min(int(rnd.lognormvariate(0, 1.0) * median), MAX_BLOB_BYTES)
+                    if rnd.random() < 0.02:
+                        size = 0 # Registro vazio
+                    data_raw = day + timedelta(seconds=rnd.randint(0, 86399))
+                    if rnd.random() < 0.01:
+                        data_raw = None # Data inválida na origem
+                    rows.append(SourceItem(str(code), size, 'pdf' if is_pdf else rnd.choice(IMAGE_EXTENSIONS), data_raw, cod_proc))
+                    self.total_bytes += size
+                    code += 1
+            self.items[patient_id] = rows
+        # Prioridade de fetch_batch: data mais recente primeiro
+        self.order = sorted(self.items, key=lambda p: max((r.data_raw for r in self.items[p] if r.data_raw), default=datetime.min), reverse=True)
+        self.reset()
+
+    def reset(self):
+        self.migrated = set()
+        self.quarantined = set()
+        self.row_counts = {table: 0 for table in Repository.INSERT_SQL}
+        self.max_ids = {'tbllaudoimagem': 0, 'tblfaturaatendimento': 0}
+        self.max_atend = {}
+        self.round_trips = 0
+
+    @property
+    def total_items(self):
+        return sum(len(rows) for rows in self.items.values())
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def pending_rows(self, patient_id):
+        with self.lock:
+            return [r for r in self.items.get(str(patient_id), []) if r.code not in self.migrated]
+
+    def image_row(self, patient_id, item, include_blobs):
+        blob = self.payload[:item.size] if include_blobs and item.size else None
+        return ImageRow(item.code, blob, item.size, None, item.extensao, item.data_raw,
+                        item.cod_proc, self.procs[item.cod_proc], str(patient_id))
+
+    def apply(self, pending):
+        """Efetiva as escritas de uma transação."""
+        with self.lock:
+            for table, params in pending:
+                self.row_counts[table] += 1
+                if table == 'tbl_controle_migracao_python':
+                    self.migrated.add(params[0])
+                elif table == 'tbllaudoimagem':
+                    self.max_ids['tbllaudoimagem'] = max(self.max_ids['tbllaudoimagem'], params[0])
+                elif table == 'tblfaturaatendimento':
+                    self.max_ids['tblfaturaatendimento'] = max(self.max_ids['tblfaturaatendimento'], params[0])
+                elif table == 'tblatendimento':
+                    self.max_atend[params[3]] = max(self.max_atend.get(params[3], 0), params[0])
+
+
+class FakeConnection:
+    """Conexão falsa: acumula as escritas até commit()/rollback()."""
+
+    def __init__(self, db):
+        self.db = db
+        self.pending = []
+        self.savepoint_mark = 0
+        self.timeout = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.round_trip()
+        self.db.apply(self.pending)
+        self.pending = []
+        self.savepoint_mark = 0
+
+    def rollback(self):
+        self.pending = []
+        self.savepoint_mark = 0
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    """
+    Cursor falso: reconhece os INSERTs de Repository.INSERT_SQL, savepoints e as
+    consultas de MAX de IdGenerator; o restante é aceito sem efeito.
+    """
+    TABLE_BY_SQL = {sql: table for table, sql in Repository.INSERT_SQL.items()}
+
+    def __init__(self, conn):
+        self.connection = conn
+        self.db = conn.db
+        self.fast_executemany = False
+        self.rowcount = 0
+        self.result = []
+        self.temp_clients = []
+
+    def execute(self, sql, params=()):
+        self.db.round_trip()
+        self.result = []
+        table = self.TABLE_BY_SQL.get(sql)
+        if table:
+            self.connection.pending.append((table, params))
+        elif "SAVE TRANSACTION" in sql:
+            self.connection.savepoint_mark = len(self.connection.pending)
+        elif sql == "SELECT @@TRANCOUNT":
+            self.result = [(0,)]
+        elif sql.startswith("ROLLBACK TRANSACTION"):
+            del self.connection.pending[self.connection.savepoint_mark:]
+        elif "#clientes_lote c" in sql:
+            self.result = [(c, self.db.max_atend.get(c, 0)) for c in self.temp_clients]
+        elif "MAX(intAtendimentoId)" in sql:
+            self.result = [(self.db.max_atend.get(params[0], 0),)]
+        elif "MAX(intLaudoImagemId)" in sql:
+            self.result = [(self.db.max_ids['tbllaudoimagem'],)]
+        elif "MAX(intFaturaAtendimentoId)" in sql:
+            self.result = [(self.db.max_ids['tblfaturaatendimento'],)]
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.db.round_trip()
+        rows = list(seq_of_params)
+        table = self.TABLE_BY_SQL.get(sql)
+        if table:
+            self.connection.pending.extend((table, params) for params in rows)
+        elif "#clientes_lote" in sql:
+            self.temp_clients = [r[0] for r in rows]
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        rows, self.result = self.result, []
+        return rows
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        pass
+
+
+class FakeRepository:
+    """Implementações em memória das consultas de leitura do Repository."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def patches(self):
+        names = ('get_stats', 'get_approx_stats', 'fetch_batch', 'fetch_patient_costs', 'fetch_patient_images',
+                 'fetch_batch_images', 'fetch_blobs', 'transaction_state', 'ensure_quarantine_table', 'record_quarantine_failure',
+                 'clear_quarantine')
+        return [mock.patch.object(Repository, name, staticmethod(getattr(self, name))) for name in names]
+
+    def get_stats(self, cursor):
+        self.db.round_trip()
+        with self.db.lock:
+            all_rows = [r for rows in self.db.items.values() for r in rows]
+            done = [r for r in all_rows if r.code in self.db.migrated]
+            pend = [r for r in all_rows if r.code not in self.db.migrated]
+        count = lambda rows, pdf: sum(1 for r in rows if (r.extensao == 'pdf') == pdf)
+        return {'migrated_imgs': count(done, False), 'migrated_pdfs': count(done, True),
+                'pending_imgs': count(pend, False), 'pending_pdfs': count(pend, True)}
+
+    def get_approx_stats(self, cursor):
+        stats = self.get_stats(cursor)
+        migrated = stats['migrated_imgs'] + stats['migrated_pdfs']
+        return {'migrated_total': migrated, 'pending_total': stats['pending_imgs'] + stats['pending_pdfs']}
+
+    def fetch_batch(self, cursor, limit=None, exclude_leased=False, exclude_quarantined=False):
+        self.db.round_trip()
+        limit = int(limit or Config.BATCH_SIZE)
+        batch = []
+        for patient_id in self.db.order:
+            if patient_id in self.db.quarantined:
+                continue
+            if self.db.pending_rows(patient_id):
+                batch.append(patient_id)
+                if len(batch) >= limit:
+                    break
+        if not batch:
+            raise BenchmarkFinished()
+        return batch
+
+    def fetch_patient_costs(self, cursor, patient_ids):
+        self.db.round_trip()
+        costs = {}
+        for patient_id in patient_ids:
+            rows = self.db.pending_rows(patient_id)
+            costs[str(patient_id)] = (len(rows), sum(r.size for r in rows))
+        return costs
+
+    def fetch_patient_images(self, cursor, patient_id, include_blobs=True):
+        self.db.round_trip()
+        rows = sorted(self.db.pending_rows(patient_id), key=lambda r: r.data_raw or datetime.min)
+        return [self.db.image_row(patient_id, r, include_blobs) for r in rows]
+
+    def fetch_batch_images(self, cursor, patient_ids, include_blobs=True):
+        self.db.round_trip()
+        return {p: self.fetch_patient_images(cursor, p, include_blobs) for p in patient_ids}
+
+    def fetch_blobs(self, cursor, codes):
+        self.db.round_trip()
+        wanted = set(codes)
+        blobs = {}
+        for rows in self.db.items.values():
+            for r in rows:
+                if r.code in wanted and r.size:
+                    blobs[r.code] = self.db.payload[:r.size]
+        return blobs
+
+    def transaction_state(self, cursor):
+        return 1
+
+    def ensure_quarantine_table(self, cursor):
+        pass
+
+    def record_quarantine_failure(self, cursor, patient_id, error_class, error_message, base_seconds, max_seconds, max_attempts):
+        self.db.quarantined.add(str(patient_id))
+        return 1, datetime.now()
+
+    def clear_quarantine(self, cursor, patient_ids):
+        pass
+
+
+def _config_overrides(batch_size):
+    """Pausas zeradas e apenas recursos que o banco falso modela."""
+    overrides = {
+        'BATCH_SIZE': batch_size,
+        'SLEEP_PATIENT': 0,
+        'SLEEP_BATCH': 0,
+        'CHECK_OPERATING_HOURS': False,
+        'MULTI_WORKER': False,
+        'USE_WORK_QUEUE': False,
+        'ID_ALLOCATION': 'max',
+        'SERVER_SIDE_BLOBS': False,
+        'DEDUPE_CONTENT': False,
+        'USE_PLAN': False,
+        'THROTTLE_SERVER_STATS': False,
+        'METRICS_PORT': 0,
+        'METRICS_TEXTFILE': '',
+    }
+    overrides['INLINE_BLOBS'] = not Config.STREAM_BLOBS
+    return [mock.patch.object(Config, name, value) for name, value in overrides.items()]
+
+
+def run_once(db, batch_size, trace_memory=True):
+    """Executa run_worker até esvaziar a fila sintética. Retorna as métricas da rodada."""
+    db.reset()
+    repo = FakeRepository(db)
+    patches = _config_overrides(batch_size) + repo.patches() + [
+        mock.patch.object(database, 'get_db_connection', lambda timeout=None: FakeConnection(db)),
+        mock.patch.object(pipeline, 'get_db_connection', lambda timeout=None: FakeConnection(db)),
+    ]
+    with contextlib.ExitStack() as stack:
+        for p in patches:
+            stack.enter_context(p)
+        # O log do worker é parte do custo, mas não deve poluir o relatório
+        stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            worker.run_worker()
+        except BenchmarkFinished:
+            pass
+        elapsed = time.perf_counter() - started
+        peak = 0
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    patients = sum(1 for rows in db.items.values() if any(r.code in db.migrated for r in rows))
+    images = db.row_counts['tbllaudoimagem'] + db.row_counts['tbllaudopdfanexo']
+    mb = sum(r.size for rows in db.items.values() for r in rows if r.code in db.migrated) / (1024 * 1024)
+    return {
+        'batch_size': batch_size,
+        'patients': patients,
+        'images': images,
+        'mb': round(mb, 2),
+        'seconds': round(elapsed, 3),
+        'patients_per_s': round(patients / elapsed, 2),
+        'images_per_s': round(images / elapsed, 2),
+        'mb_per_s': round(mb / elapsed, 2),
+        'peak_memory_mb': round(peak / (1024 * 1024), 2),
+        'round_trips': db.round_trips,
+        'unmigrated_items': db.total_items - len(db.migrated),
+    }
+
+
+def print_report(results, baseline=None):
+    base = {r['batch_size']: r for r in (baseline or [])}
+    print(f"{'Lote':>6} | {'Pacientes/s':>12} | {'Imagens/s':>10} | {'MB/s':>8} | {'Pico MB':>8} | {'Idas ao banco':>13} | {'Tempo':>8}")
+    print("-" * 84)
+    for r in results:
+        line = (f"{r['batch_size']:>6} | {r['patients_per_s']:>12.2f} | {r['images_per_s']:>10.2f} | {r['mb_per_s']:>8.2f} | "
+                f"{r['peak_memory_mb']:>8.2f} | {r['round_trips']:>13} | {r['seconds']:>7.2f}s")
+        ref = base.get(r['batch_size'])
+        if ref and ref['images_per_s']:
+            delta = (r['images_per_s'] / ref['images_per_s'] - 1) * 100
+            flag = "⚠️ " if delta < -10 else ""
+            line += f" | {flag}{delta:+.1f}% vs base"
+        print(line)
+        if r['unmigrated_items']:
+            print(f"       ❌ {r['unmigrated_items']} itens não migrados nesta rodada!")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark do worker com dados sintéticos (sem SQL Server)")
+    parser.add_argument("--patients", type=int, default=200, help="Pacientes sintéticos")
+    parser.add_argument("--batch-sizes", default="1,10,50", help="Tamanhos de lote separados por vírgula")
+    parser.add_argument("--seed", type=int, default=42, help="Semente dos dados (reprodutível)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latência simulada por ida ao banco")
+    parser.add_argument("--no-memory", action="store_true", help="Não mede pico de memória (tracemalloc tem custo)")
+    parser.add_argument("--json", help="Grava os resultados em JSON")
+    parser.add_argument("--baseline", help="JSON de uma rodada anterior para comparação")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"🧪 Gerando {args.patients} pacientes sintéticos (seed {args.seed})...")
+    db = SyntheticDatabase(args.patients, seed=args.seed, latency_ms=args.latency_ms)
+    print(f"   {db.total_items} itens | {db.total_bytes / (1024 * 1024):.1f} MB\n")
+
+    results = []
+    for size in [int(s) for s in args.batch_sizes.split(",") if s.strip()]:
+        print(f"▶️  Lote {size}...", flush=True)
+        results.append(run_once(db, size, trace_memory=not args.no_memory))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)['results']
+    print()
+    print_report(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'patients': args.patients, 'seed': args.seed, 'latency_ms': args.latency_ms,
+                       'results': results}, f, indent=2)
+        print(f"\n💾 Resultados gravados em {args.json}")
+    sys.exit(1 if any(r['unmigrated_items'] for r in results) else 0)
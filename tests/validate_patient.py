@@ -9,14 +9,15 @@ def validate_patient(patient_id):
 
     # 1. Check Source Data (tblmigracao + img_rcl)
     # Get ALL items for this patient, regardless of migration status
-    sql_source = """
+    img_join, _ = Repository._img_source(cursor)
+    sql_source = f"""
         SELECT 
             m.strCodigo as id_imagem_origem,
             m.strextensao as extensao,
             m.strCodigoPaciente,
             i.IMG_RCL_RCL_DTHR as data_raw
         FROM tblmigracao m WITH (NOLOCK)
-        INNER JOIN img_rcl i WITH (NOLOCK) ON m.strCodigo = CAST(i.IMG_RCL_IND AS VARCHAR(50))
+        {img_join}
         WHERE m.strCodigoPaciente = ?
     """
     cursor.execute(sql_source, (patient_id,))